@@ -8,7 +8,9 @@ from os import environ
 import jsonschema
 
 from ..schemas import JSON_SCHEMA_LOCATION_GPS_POINT
-from ..utils import db_test_case_factory, records_to_dict, convert_to_datetime
+from ..utils import db_test_case_factory, records_to_dict, convert_to_datetime, getLogger
+
+logger = getLogger('location.db')
 
 
 SQL_CREATE_TABLE_GPS_POINT = '''
@@ -29,7 +31,9 @@ CREATE TABLE gps_point
   -- but at least it's global so we don't have to mess with local projections
   ptz                     geography(POINTZ,4326),
   sog                     FLOAT,
-  cog                     FLOAT
+  cog                     FLOAT,
+  -- Terrain elevation from DEM, NULL if unknown
+  ground_m_msl            FLOAT
 );
 -- Fast joins
 CREATE INDEX gps_point_user_id_index ON gps_point(user_id);
@@ -38,17 +42,30 @@ CREATE INDEX gps_point_timestamp_index on gps_point(timestamp);
 CREATE INDEX gps_point_ptz_index ON gps_point USING BRIN (ptz);
 '''
 
+SQL_MIGRATE_TABLE_GPS_POINT = '''
+ALTER TABLE gps_point ADD COLUMN IF NOT EXISTS ground_m_msl FLOAT;
+'''
+
 
 def parsept(p):
     return [float(c) for c in p.split('(')[-1].split(')')[0].split()]
 
 
+def height_agl(coords, ground_m_msl):
+    "Height above ground level, None if ground elevation unknown"
+    if ground_m_msl is None:
+        return None
+    return coords[2] - ground_m_msl
+
+
 def gps_points_customformat(recs):
     "Convert records to custom, efficient json format"
+    coordinates = [parsept(r['ptz']) for r in recs]
     # *user_id* will be the same for every point
     return {"user_id": recs[0]['user_id'],
-            "coordinates": [parsept(r['ptz']) for r in recs],
-            "timestamps": [r['timestamp'].isoformat() for r in recs]}
+            "coordinates": coordinates,
+            "timestamps": [r['timestamp'].isoformat() for r in recs],
+            "agl": [height_agl(c, r['ground_m_msl']) for c, r in zip(coordinates, recs)]}
 
 
 class Db():
@@ -62,35 +79,68 @@ class Db():
     async def create_tables(self):
         return await self.conn.execute(SQL_CREATE_TABLE_GPS_POINT)
 
-    async def insert_gps_point(self, gps_point_dict, validate=True, return_self=True):
+    async def migrate_tables(self):
+        return await self.conn.execute(SQL_MIGRATE_TABLE_GPS_POINT)
+
+    @staticmethod
+    def gps_point_to_row(gps_point_dict, received, validate=True):
+        "Validate point and convert to tuple of column values, in insert order"
         # Don't mess with input data
         d = gps_point_dict.copy()
         # For convenience
         v = lambda n: d.get(n)
         # To string and later back to datetime.datetime so it can be validated
-        d['received'] = datetime.datetime.utcnow().isoformat()
+        d['received'] = received.isoformat()
         if validate:
             # Throws ValidationError
             jsonschema.validate(d, JSON_SCHEMA_LOCATION_GPS_POINT)
-        # Parse timestamps to datetime so asyncpg driver can handle them
-        d['received'] = convert_to_datetime(v('received'))
-        d['timestamp'] = convert_to_datetime(v('timestamp'))
-
         # Six decimal digits for about 1/9m precision
         pt_wkt = "SRID=4326;POINTZ({longitude:.6f} {latitude:.6f} {height_m_msl:.2f})".format(**v('ptz'))
+        # Parse timestamps to datetime so asyncpg driver can handle them
+        return (v('user_id'), convert_to_datetime(v('timestamp')), received, pt_wkt,
+                v('speed_over_ground_kmh'), v('course_over_ground_deg'), v('source'), v('ground_m_msl'))
 
+    async def insert_gps_point(self, gps_point_dict, validate=True, return_self=True):
+        row = self.gps_point_to_row(gps_point_dict, datetime.datetime.utcnow(), validate=validate)
         gps_point_id = await self.conn.fetchval('''
-        INSERT INTO gps_point (id, user_id, timestamp, received, ptz, sog, cog, source)
-        VALUES (DEFAULT, $1, $2, $3, ST_GeogFromText($4), $5, $6, $7)
-        RETURNING id;''', v('user_id'), v('timestamp'), v('received'), pt_wkt,
-                                      v('speed_over_ground_kmh'), v('course_over_ground_deg'), v('source'))
+        INSERT INTO gps_point (id, user_id, timestamp, received, ptz, sog, cog, source, ground_m_msl)
+        VALUES (DEFAULT, $1, $2, $3, ST_GeogFromText($4), $5, $6, $7, $8)
+        RETURNING id;''', *row)
         # Retrieve point and return it in custom format
         if return_self:
             return await self.get_gps_point_by_id(gps_point_id)
 
+    async def insert_gps_points(self, gps_point_dicts, validate=True):
+        """
+        Insert many points in one statement. Invalid points are skipped.
+        :return: {<user_id>: <points in custom format>} of inserted points
+        """
+        received = datetime.datetime.utcnow()
+        rows = []
+        for d in gps_point_dicts:
+            try:
+                rows.append(self.gps_point_to_row(d, received, validate=validate))
+            except (jsonschema.exceptions.ValidationError, KeyError, TypeError):
+                logger.warning("Skipping invalid gps point %s", d, exc_info=True)
+        if not rows:
+            return {}
+        # Transpose to column arrays for unnest
+        cols = [list(c) for c in zip(*rows)]
+        recs = await self.conn.fetch('''
+        INSERT INTO gps_point (user_id, timestamp, received, ptz, sog, cog, source, ground_m_msl)
+        SELECT u, t, r, ST_GeogFromText(p), s, c, src::gps_point_source, g
+        FROM unnest($1::INTEGER[], $2::TIMESTAMP[], $3::TIMESTAMP[], $4::TEXT[],
+                    $5::FLOAT[], $6::FLOAT[], $7::TEXT[], $8::FLOAT[]) AS x(u, t, r, p, s, c, src, g)
+        RETURNING user_id, timestamp, received, ground_m_msl, ST_AsText(ptz) ptz;
+        ''', *cols)
+        by_user = {}
+        for rec in sorted(recs, key=lambda r: (r['user_id'], r['timestamp'])):
+            by_user.setdefault(rec['user_id'], []).append(rec)
+        return {user_id: gps_points_customformat(user_recs) for user_id, user_recs in by_user.items()}
+
     async def get_gps_point_by_id(self, gps_point_id):
         rec = await self.conn.fetchrow('''
-        SELECT user_id, timestamp, received, ST_AsText(ptz) ptz
+        SELECT user_id, timestamp, received, ground_m_msl, ST_AsText(ptz) ptz
         FROM gps_point
         WHERE gps_point.id = $1;
         ''', gps_point_id)
@@ -106,7 +156,7 @@ class Db():
         :return: 
         """
         recs = await self.conn.fetch('''
-        SELECT user_id, timestamp, received, source, ST_AsText(ptz) ptz
+        SELECT user_id, timestamp, received, source, ground_m_msl, ST_AsText(ptz) ptz
         FROM gps_point
         WHERE user_id=$1 AND gps_point.timestamp >= $2 AND gps_point.timestamp <= $3
         ORDER BY gps_point.timestamp ASC;
@@ -150,6 +200,18 @@ class SomeTestCase(db_test_case_factory(Db)):
         validpts_retrieved_f = self.lru(self.db.get_gps_points_by_user_id(-10))
         self.assertEqual(validpts_retrieved_f, {"coordinates": [[5,6,900]], "timestamps": [t]})
 
+    def test_insert_many(self):
+        t = datetime.datetime.utcnow()
+        pts = [{"user_id": uid, "timestamp": (t + datetime.timedelta(seconds=i)).isoformat(),
+                "ptz": {"longitude": 5, "latitude": 6, "height_m_msl": 900 + i}}
+               for uid in (-10, -11) for i in range(3)]
+        # Invalid point should be skipped
+        pts.append({"user_id": None})
+        inserted = self.lru(self.db.insert_gps_points(pts))
+        self.assertEqual(set(inserted.keys()), {-10, -11})
+        self.assertEqual([c[2] for c in inserted[-10]['coordinates']], [900, 901, 902])
+        self.assertEqual(len(self.lru(self.db.get_gps_points_by_user_id(-11, return_vanilla=True))), 3)
+
 
 
 if __name__=="__main__":
@@ -157,6 +219,8 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--create', action='store_true',
                         help="Create db tables and indexes")
+    parser.add_argument('--migrate', action='store_true',
+                        help="Add columns that are missing in existing tables")
     parser.add_argument('--test', action='store_true',
                         help="Test db")
     args = parser.parse_args()
@@ -166,6 +230,11 @@ if __name__=="__main__":
         db = l.run_until_complete(Db.create())
         l.run_until_complete(db.create_tables())
 
+    if args.migrate:
+        l = asyncio.get_event_loop()
+        db = l.run_until_complete(Db.create())
+        l.run_until_complete(db.migrate_tables())
+
     if args.test:
         # Pass only system name, ignore other args
         unittest.main(verbosity=1, argv=sys.argv[:1])
@@ -0,0 +1,145 @@
+import sys
+import math
+import logging
+import unittest
+import tempfile
+import os.path as osp
+from collections import OrderedDict
+
+import numpy as np
+
+logger = logging.getLogger('location.elevation')
+
+# Value used in SRTM tiles for missing data
+HGT_VOID = -32768
+
+
+def hgt_tile_name(longitude, latitude):
+    "Name of the 1x1 degree tile that contains this point, e.g. N43W002"
+    lat, lon = math.floor(latitude), math.floor(longitude)
+    return '{}{:02d}{}{:03d}'.format('N' if lat >= 0 else 'S', abs(lat),
+                                     'E' if lon >= 0 else 'W', abs(lon))
+
+
+class Elevation:
+    """
+    Terrain elevation from SRTM/Copernicus *.hgt* tiles in a local directory.
+    Tiles are memory-mapped, so only the pages that are actually used get read from disk,
+    and the most recently used ones are kept open.
+    """
+    def __init__(self, dem_root, max_open_tiles=16):
+        self.dem_root = dem_root
+        self.max_open_tiles = max_open_tiles
+        # {<tile name>: <np.memmap or None if we don't have it>}, least recently used first
+        self.tiles = OrderedDict()
+
+    def tile(self, name):
+        "Get memory-mapped tile, or None if not available"
+        try:
+            self.tiles.move_to_end(name)
+            return self.tiles[name]
+        except KeyError:
+            pass
+        tile = None
+        path = osp.join(self.dem_root, name + '.hgt')
+        if osp.isfile(path):
+            # Tiles are square grids of big-endian int16, 1201x1201 for 3" and 3601x3601 for 1"
+            size = int(round(math.sqrt(osp.getsize(path) / 2)))
+            tile = np.memmap(path, dtype='>i2', mode='r', shape=(size, size))
+            logger.debug("Opened DEM tile %s of %sx%s", path, size, size)
+        else:
+            logger.warning("No DEM tile %s, elevation unknown in this area", path)
+        # Also remember missing tiles, to avoid hitting the filesystem for every point
+        self.tiles[name] = tile
+        if len(self.tiles) > self.max_open_tiles:
+            self.tiles.popitem(last=False)
+        return tile
+
+    def get(self, longitude, latitude):
+        "Bilinear-interpolated terrain height in meters above MSL, None if unknown"
+        h = self.get_many([longitude], [latitude])[0]
+        return None if np.isnan(h) else float(h)
+
+    def get_many(self, longitudes, latitudes):
+        "Vectorized version of *get*, returns float array with NaN where unknown"
+        lons = np.asarray(longitudes, dtype=np.float64)
+        lats = np.asarray(latitudes, dtype=np.float64)
+        out = np.full(lons.shape, np.nan)
+        tile_lons = np.floor(lons)
+        tile_lats = np.floor(lats)
+        # Handle points per tile, usually they're all in one or two tiles
+        for tile_lon, tile_lat in set(zip(tile_lons.tolist(), tile_lats.tolist())):
+            tile = self.tile(hgt_tile_name(tile_lon, tile_lat))
+            if tile is None:
+                continue
+            mask = (tile_lons == tile_lon) & (tile_lats == tile_lat)
+            out[mask] = self._interpolate(tile, lons[mask] - tile_lon, lats[mask] - tile_lat)
+        return out
+
+    @staticmethod
+    def _interpolate(tile, dx, dy):
+        "Bilinear interpolation within tile, *dx* and *dy* are offsets from its SW corner in degrees"
+        n = tile.shape[0] - 1
+        # First row is the northern edge
+        row = (1 - dy) * n
+        col = dx * n
+        r0 = np.clip(np.floor(row).astype(np.intp), 0, n - 1)
+        c0 = np.clip(np.floor(col).astype(np.intp), 0, n - 1)
+        fr = row - r0
+        fc = col - c0
+        # Fancy indexing only touches the needed pages of the memmap
+        corners = [tile[r0, c0], tile[r0, c0 + 1], tile[r0 + 1, c0], tile[r0 + 1, c0 + 1]]
+        corners = [np.where(c == HGT_VOID, np.nan, c.astype(np.float64)) for c in corners]
+        top = corners[0] * (1 - fc) + corners[1] * fc
+        bottom = corners[2] * (1 - fc) + corners[3] * fc
+        return top * (1 - fr) + bottom * fr
+
+
+class ElevationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        # Tiny 3x3 tile sloping up towards the east, with a void in the NW corner
+        grid = np.array([[HGT_VOID, 100, 200],
+                         [0, 100, 200],
+                         [0, 100, 200]], dtype='>i2')
+        grid.tofile(osp.join(self.tmpdir.name, 'N45E006.hgt'))
+        self.elevation = Elevation(self.tmpdir.name, max_open_tiles=1)
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_tile_name(self):
+        self.assertEqual(hgt_tile_name(6.5, 45.5), 'N45E006')
+        self.assertEqual(hgt_tile_name(-1.5, -0.5), 'S01W002')
+
+    def test_interpolation(self):
+        self.assertAlmostEqual(self.elevation.get(6.25, 45.25), 50)
+        self.assertAlmostEqual(self.elevation.get(6.75, 45.0), 150)
+        # Eastern edge
+        self.assertAlmostEqual(self.elevation.get(6.9999999, 45.5), 200, places=3)
+
+    def test_unknown(self):
+        # Void value
+        self.assertIsNone(self.elevation.get(6.0, 46.0 - 1e-9))
+        # Missing tile
+        self.assertIsNone(self.elevation.get(7.5, 45.5))
+
+    def test_many(self):
+        h = self.elevation.get_many([6.25, 7.5, 6.75], [45.25, 45.5, 45.0])
+        self.assertAlmostEqual(h[0], 50)
+        self.assertTrue(np.isnan(h[1]))
+        self.assertAlmostEqual(h[2], 150)
+        # Cache is limited to one tile
+        self.assertEqual(len(self.elevation.tiles), 1)
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--test', action='store_true',
+                        help="Test elevation lookups on synthetic tile")
+    args = parser.parse_args()
+
+    if args.test:
+        # Pass only system name, ignore other args
+        unittest.main(verbosity=1, argv=sys.argv[:1])
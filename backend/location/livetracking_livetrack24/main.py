@@ -1,18 +1,97 @@
+import time
 import asyncio
 import datetime
 
 from autobahn.wamp.exception import ApplicationError
 from aiohttp import web
 
-from ...utils import BackendAppSession, getLogger
+from ...utils import BackendAppSession, getLogger, TTLCache
 
 logger = getLogger('location.livetrack24.main')
 
+# Auth codes rarely change, but don't let a revoked code work for too long
+AUTH_CODE_TTL = 10 * 60
+# Phones retry wrong codes often, but a user might fix the code and try again
+AUTH_CODE_NEGATIVE_TTL = 30
 
-async def site_factory(wampsess):
+
+class PointForwarder():
+    """
+    Bounded buffer of track points that are forwarded to the location service in batches,
+    so that phones get their reply without waiting for the database.
+    """
+    def __init__(self, wampsess, maxsize=10000, batch_size=200, flush_interval=1,
+                 late_after=30, retries=3):
+        self.wampsess = wampsess
+        self.queue = asyncio.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        # Points that take longer than this to reach the location service count as late
+        self.late_after = late_after
+        self.retries = retries
+        self.counters = {'queued': 0, 'forwarded': 0, 'dropped': 0, 'late': 0, 'failed': 0, 'batches': 0}
+
+    def put(self, trackpt):
+        "Returns False if the buffer is full and the point is dropped"
+        try:
+            self.queue.put_nowait((time.monotonic(), trackpt))
+        except asyncio.QueueFull:
+            self.counters['dropped'] += 1
+            return False
+        self.counters['queued'] += 1
+        return True
+
+    async def consume(self):
+        "Run forever, forwarding batches"
+        while True:
+            batch = [await self.queue.get()]
+            # Give the buffer a moment to fill up, unless there's a full batch already
+            if self.queue.qsize() < self.batch_size - 1:
+                await asyncio.sleep(self.flush_interval)
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                await self.forward(batch)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Nothing restarts this task, so keep consuming whatever goes wrong
+                logger.exception("Could not forward batch of %s points", len(batch))
+                self.counters['failed'] += len(batch)
+
+    async def forward(self, batch):
+        pts = [pt for _, pt in batch]
+        for attempt in range(self.retries):
+            try:
+                await self.wampsess.call('at.location.insert_gps_points', pts)
+                break
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # Also e.g. TransportLost while the router restarts, not only ApplicationError
+                logger.exception("Could not forward %s points, attempt %s", len(pts), attempt + 1)
+                await asyncio.sleep(2 ** attempt)
+        else:
+            self.counters['failed'] += len(pts)
+            return
+        now = time.monotonic()
+        self.counters['late'] += sum(1 for enqueued, _ in batch if now - enqueued > self.late_after)
+        self.counters['forwarded'] += len(pts)
+        self.counters['batches'] += 1
+
+    def stats(self):
+        return dict(self.counters, queue_depth=self.queue.qsize())
+
+
+async def site_factory(wampsess, forwarder, auth_cache):
     """
     Creates aiohttp server listening on specified port
     :param wampsession:
+    :param forwarder: PointForwarder that receives track points
+    :param auth_cache: TTLCache for user ids by auth code
     """
 
     async def client(request):
@@ -25,10 +104,15 @@ async def site_factory(wampsess):
             # Livetrack24 returns status 200 on basically any error
             return web.Response(status=200, text='0')
         try:
-            user_id = await wampsess.call('at.users.get_user_id_by_authcode', user_auth_code)
-        except ApplicationError:
-            logger.exception("Could not reach user service!")
-            return web.HTTPInternalServerError(reason="Internal communication error")
+            user_id = auth_cache[user_auth_code]
+        except KeyError:
+            try:
+                user_id = await wampsess.call('at.users.get_user_id_by_authcode', user_auth_code)
+            except ApplicationError:
+                logger.exception("Could not reach user service!")
+                return web.HTTPInternalServerError(reason="Internal communication error")
+            # Also cache failures, phones keep retrying with the same wrong code
+            auth_cache[user_auth_code] = user_id
         if user_id:
             logger.info("Correct credentials for user id %s", user_id)
             # Send back actual user ID
@@ -51,26 +135,33 @@ async def site_factory(wampsess):
             logger.info("Leolive is not 4 but %s", leolive)
             return web.Response(status=200)
 
-        trackpt = {
-            "source": 'mobile',
-            # Rightmost 3 bits are user ID, see spec
-            "user_id": int(sessionid) & 0x00ffffff,
-            # Unix GPS timestamp in GMT
-            "timestamp": datetime.datetime.utcfromtimestamp(int(g('tm'))).isoformat(),
-            "ptz": {
-                # Lat/lon in decimal notation
-                "longitude": float(g('lon')),
-                "latitude": float(g('lat')),
-                # Altitude in meters above MSL (not geoid), no decimals
-                "height_m_msl": float(g('alt'))
-            },
-            # Speed over ground in km/h, no decimals
-            "speed_over_ground_kmh": float(g('sog')),
-            # Course over ground in degrees 0-360, no decimals
-            "course_over_ground_deg": float(g('cog'))
-        }
-
-        await wampsess.call('at.location.insert_gps_point', trackpt)
+        try:
+            trackpt = {
+                "source": 'mobile',
+                # Rightmost 3 bits are user ID, see spec
+                "user_id": int(sessionid) & 0x00ffffff,
+                # Unix GPS timestamp in GMT
+                "timestamp": datetime.datetime.utcfromtimestamp(int(g('tm'))).isoformat(),
+                "ptz": {
+                    # Lat/lon in decimal notation
+                    "longitude": float(g('lon')),
+                    "latitude": float(g('lat')),
+                    # Altitude in meters above MSL (not geoid), no decimals
+                    "height_m_msl": float(g('alt'))
+                },
+                # Speed over ground in km/h, no decimals
+                "speed_over_ground_kmh": float(g('sog')),
+                # Course over ground in degrees 0-360, no decimals
+                "course_over_ground_deg": float(g('cog'))
+            }
+        except (TypeError, ValueError):
+            logger.info("Invalid track point: %s", request.query_string)
+            return web.Response(status=200, text="NOK : Invalid track point")
+
+        # Don't wait for the database, forwarder sends it to location service
+        if not forwarder.put(trackpt):
+            logger.warning("Track point buffer full, dropped point for user id %s", trackpt['user_id'])
+            return web.Response(status=200, text="NOK : Server busy")
         return web.Response(status=200)
 
     app = web.Application()
@@ -87,7 +178,30 @@ class SiteComponent(BackendAppSession):
 
     async def onJoin(self, details):
         logger.info("session joined")
-        await site_factory(self)
+
+        self.forwarder = PointForwarder(self)
+        self.auth_cache = TTLCache(AUTH_CODE_TTL, negative_ttl=AUTH_CODE_NEGATIVE_TTL)
+        asyncio.ensure_future(self.forwarder.consume())
+
+        async def get_stats():
+            "Counters of track point buffer and auth code cache"
+            return dict(self.forwarder.stats(),
+                        auth_cache_hits=self.auth_cache.hits,
+                        auth_cache_misses=self.auth_cache.misses)
+
+        self.register(get_stats, 'at.location.livetrack24.get_stats')
+
+        await site_factory(self, self.forwarder, self.auth_cache)
+
+        # Log counters regularly so we can see trouble in the logs
+        while True:
+            await asyncio.sleep(60)
+            logger.info("Stats: %s", await get_stats())
+
+    async def cleanup(self, loop):
+        # Prevent AttributeError if not joined
+        if getattr(self, 'forwarder', None) and self.forwarder.queue.qsize():
+            logger.error("Unforwarded track points! %s points left in buffer", self.forwarder.queue.qsize())
 
 
 if __name__=="__main__":
@@ -1,8 +1,11 @@
+import os
+import math
 import datetime
 
 from autobahn.wamp.exception import ApplicationError
 
 from .db import Db
+from .elevation import Elevation
 from ..utils import BackendAppSession, getLogger, convert_to_datetime
 
 logger = getLogger('location.main')
@@ -16,11 +19,33 @@ class LocationComponent(BackendAppSession):
         db = await Db.create()
         self.db = db
 
-        async def insert_gps_point(gps_pt):
-            # Returns the point in the same format as db.get_gps_points_by_user_id
-            gps_points = await db.insert_gps_point(gps_pt)
-            # Now emit on personal channel
-            user_id = gps_pt['user_id']
+        # Ground elevation is optional, only available if DEM tiles are provided
+        dem_root = os.environ.get('AT_DEM_ROOT')
+        self.elevation = Elevation(dem_root) if dem_root else None
+
+        def add_ground_elevation(gps_pts):
+            "Returns copies of points with ground elevation, if known"
+            if not self.elevation or not gps_pts:
+                return gps_pts
+            grounds = self.elevation.get_many([p['ptz']['longitude'] for p in gps_pts],
+                                              [p['ptz']['latitude'] for p in gps_pts])
+            out = []
+            for gps_pt, ground in zip(gps_pts, grounds.tolist()):
+                # NaN if unknown
+                if not math.isnan(ground):
+                    gps_pt = dict(gps_pt, ground_m_msl=ground)
+                    # Telegram locations have no height, assume that the user is on the ground
+                    if gps_pt.get('source') == 'telegram':
+                        gps_pt['ptz'] = dict(gps_pt['ptz'], height_m_msl=ground)
+                out.append(gps_pt)
+            return out
+
+        async def publish_gps_points(user_id, gps_points):
+            "Emit points in custom format on personal and adventure channels"
+            # Let other services know that locations in this time window might have changed
+            timestamps = gps_points['timestamps']
+            self.publish('at.location.points_inserted', {'user_id': user_id,
+                                                         'start': min(timestamps), 'end': max(timestamps)})
             try:
                 user_id_hash = await self.call('at.users.get_user_hash_by_id', user_id)
                 user_channel = 'at.public.location.user.{}'.format(user_id_hash)
@@ -39,6 +64,20 @@ class LocationComponent(BackendAppSession):
             except ApplicationError:
                 logger.exception("Could not retrieve adventures for user_id or emit gps point on adventure channel")
 
+        async def insert_gps_point(gps_pt):
+            gps_pt = add_ground_elevation([gps_pt])[0]
+            # Returns the point in the same format as db.get_gps_points_by_user_id
+            gps_points = await db.insert_gps_point(gps_pt)
+            await publish_gps_points(gps_pt['user_id'], gps_points)
+
+        async def insert_gps_points(gps_pts):
+            "Insert batch of points, publishes once per user. Returns number of points inserted."
+            gps_pts = add_ground_elevation(gps_pts)
+            inserted = await db.insert_gps_points(gps_pts)
+            for user_id, gps_points in inserted.items():
+                await publish_gps_points(user_id, gps_points)
+            return sum(len(p['timestamps']) for p in inserted.values())
+
         async def get_tracks_by_user_id_hash(user_id_hash):
             # TODO: Add start, end keywords
             user = await self.call('at.users.get_user_by_hash', user_id_hash)
@@ -70,36 +109,46 @@ class LocationComponent(BackendAppSession):
                         out.append(gps_points)
                 return out
 
-        async def guess_coords_by_user_id(user_id, timestamp):
+        async def guess_coords_by_user_id(user_id, timestamp, with_point_after=False):
             """
             Interpolate user location by finding location within
             60 minutes from message timestamp. This gives a 120-minute window.
             If multiple points are found, linearly interpolate between them.
+            With *with_point_after* returns {'coordinates': [...], 'point_after': <bool>}, if there was
+            a point after timestamp, points that arrive later won't change the result.
             """
+            coords, point_after = await interpolate(user_id, timestamp)
+            if with_point_after and coords:
+                return {'coordinates': coords, 'point_after': point_after}
+            return coords
+
+        async def interpolate(user_id, timestamp):
+            "Coordinates or None, and whether there was a point after timestamp"
             timestamp = convert_to_datetime(timestamp)
-            way_before = timestamp - datetime.timedelta(minutes=-60)
+            way_before = timestamp - datetime.timedelta(minutes=60)
             way_after = timestamp + datetime.timedelta(minutes=60)
             # Will return None if no pts found
             pts_before = await self.db.get_gps_points_by_user_id(user_id, start=way_before, end=timestamp)
             pts_after = await self.db.get_gps_points_by_user_id(user_id, start=timestamp, end=way_after)
             if not pts_before and not pts_after:
-                return None
+                return None, False
             # If only points before timestamp known, take last of prev pts
             if pts_before and not pts_after:
-                return pts_before['coordinates'][-1]
+                return pts_before['coordinates'][-1], False
             # If only points after timestamp known, take first next pt
             if not pts_before and pts_after:
-                return pts_after['coordinates'][0]
+                return pts_after['coordinates'][0], True
             # If both points before and after timestamp known, linearly interpolate
             timestamp_lastpt_before = convert_to_datetime(pts_before['timestamps'][-1])
             timestamp_firstpt_after = convert_to_datetime(pts_after['timestamps'][0])
             # How far between points this timestamp lies
-            a = (timestamp - timestamp_lastpt_before) / (timestamp_lastpt_before + timestamp_firstpt_after)
+            span = timestamp_firstpt_after - timestamp_lastpt_before
+            a = (timestamp - timestamp_lastpt_before) / span if span else 0
             # Coordinates of points between which timestamp lies
             p1 = pts_before['coordinates'][-1]
             p2 = pts_after['coordinates'][0]
             return [a * (p2[0]-p1[0]) + p1[0],
-                    a * (p2[1]-p1[1]) + p1[1]]
+                    a * (p2[1]-p1[1]) + p1[1]], True
 
         async def get_pts_by_user_id(user_id):
             "Gets latest points for a specific user"
@@ -107,6 +156,7 @@ class LocationComponent(BackendAppSession):
 
 
         self.register(insert_gps_point, 'at.location.insert_gps_point')
+        self.register(insert_gps_points, 'at.location.insert_gps_points')
         self.register(get_tracks_by_user_id_hash, 'at.public.location.get_tracks_by_user_id_hash')
         self.register(guess_coords_by_user_id, 'at.location.guess_coords_by_user_id')
         self.register(get_tracks_by_adventure_id_hash, 'at.public.location.get_tracks_by_adventure_id_hash')
@@ -1,17 +1,17 @@
+import html
 import logging
 import asyncio
 import datetime
-from os import environ
 import json
 
-import asyncpg
-
-from ..utils import record_to_dict, records_to_dict, convert_to_datetime
+from ..utils import convert_to_datetime, create_pool, RecordConverter, encode_json, iter_json_records, import_chunks
 
 logger = logging.getLogger('messages.db')
 
 
 SQL_CREATE_TABLE_MESSAGE = '''
+CREATE TYPE message_location_source AS ENUM ('telegram', 'exif', 'interpolated');
+
 CREATE TABLE message
 (
   id                  SERIAL PRIMARY KEY,
@@ -23,7 +23,15 @@ CREATE TABLE message
   -- Might be a video or voice message, so title/text can be omitted
   title               TEXT,
   text                TEXT,
-  telegram_message    JSONB
+  telegram_message    JSONB,
+  -- Where the message was sent from, if known
+  lon                 FLOAT,
+  lat                 FLOAT,
+  location_source     message_location_source,
+  -- Interpolated with a GPS point after the message, so points that arrive later won't change it
+  location_final      BOOLEAN,
+  -- Full-text search, maintained by trigger (Postgres 9.6 has no generated columns)
+  search_vector       TSVECTOR
 )
 '''
 
@@ -56,89 +64,420 @@ CREATE TABLE media
 CREATE INDEX media_msg_id_index ON media (msg_id);
 '''
 
+SQL_CREATE_TABLE_LATEST_MESSAGE = '''
+-- Most recent message of every user, maintained on insert, so the frontpage doesn't scan all messages
+CREATE TABLE latest_message_per_user
+(
+  user_id           INTEGER PRIMARY KEY,
+  msg_id            INTEGER REFERENCES message(id),
+  timestamp         TIMESTAMP NOT NULL
+);
+CREATE INDEX latest_message_per_user_timestamp ON latest_message_per_user (timestamp DESC);
+'''
+
+# Messages are in any language, so don't stem
+SEARCH_CONFIG = 'simple'
+
+SQL_CREATE_SEARCH_TRIGGER = '''
+CREATE OR REPLACE FUNCTION message_search_vector_update() RETURNS trigger AS $$
+BEGIN
+  NEW.search_vector := setweight(to_tsvector('{0}', coalesce(NEW.title, '')), 'A') ||
+                       setweight(to_tsvector('{0}', coalesce(NEW.text, '')), 'B');
+  RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+DROP TRIGGER IF EXISTS message_search_vector ON message;
+CREATE TRIGGER message_search_vector BEFORE INSERT OR UPDATE OF title, text ON message
+  FOR EACH ROW EXECUTE PROCEDURE message_search_vector_update();
+'''.format(SEARCH_CONFIG)
+
+SQL_CREATE_INDEX_MESSAGE = '''
+-- Messages of a user, newest first
+CREATE INDEX message_user_id_timestamp ON message (user_id, timestamp DESC);
+-- Messages that might get a (better) location when GPS points arrive
+CREATE INDEX message_to_locate ON message (user_id, timestamp)
+  WHERE location_source IS NULL OR location_source = 'interpolated';
+CREATE INDEX message_search ON message USING GIN (search_vector);
+'''
+
+MESSAGE_IMPORT_COLUMNS = ('user_id', 'timestamp', 'received', 'title', 'text', 'telegram_message', 'lon', 'lat',
+                          'location_source')
+
+# Staging table to COPY into, json and enum as text because COPY can't use the connection's text codecs
+SQL_CREATE_MESSAGE_IMPORT = '''
+CREATE TEMPORARY TABLE IF NOT EXISTS message_import
+(
+  user_id             INTEGER NOT NULL,
+  timestamp           TIMESTAMP,
+  received            TIMESTAMP NOT NULL,
+  title               TEXT,
+  text                TEXT,
+  telegram_message    TEXT,
+  lon                 FLOAT,
+  lat                 FLOAT,
+  location_source     TEXT
+);
+'''
+
+# Same as insertmsg, but for all staged messages at once
+SQL_IMPORT_MSGS = '''
+WITH msg AS (
+  INSERT INTO message (user_id, timestamp, received, title, text, telegram_message, lon, lat, location_source)
+  SELECT user_id, timestamp, received, title, text, telegram_message::JSONB, lon, lat,
+    location_source::message_location_source
+  FROM message_import
+  RETURNING id, user_id, timestamp
+), latest AS (
+  INSERT INTO latest_message_per_user (user_id, msg_id, timestamp)
+  SELECT DISTINCT ON (user_id) user_id, id, timestamp FROM msg WHERE timestamp IS NOT NULL
+  ORDER BY user_id, timestamp DESC, id DESC
+  ON CONFLICT (user_id) DO UPDATE SET msg_id = EXCLUDED.msg_id, timestamp = EXCLUDED.timestamp
+    WHERE EXCLUDED.timestamp >= latest_message_per_user.timestamp
+)
+SELECT count(*) FROM msg;
+'''
+
+SQL_MIGRATE_TABLE_MESSAGE = '''
+CREATE INDEX IF NOT EXISTS message_user_id_timestamp ON message (user_id, timestamp DESC);
+-- No CREATE TYPE IF NOT EXISTS in Postgres 9.6
+DO $$ BEGIN
+  CREATE TYPE message_location_source AS ENUM ('telegram', 'exif', 'interpolated');
+EXCEPTION WHEN duplicate_object THEN NULL;
+END $$;
+ALTER TABLE message ADD COLUMN IF NOT EXISTS lon FLOAT,
+  ADD COLUMN IF NOT EXISTS lat FLOAT,
+  ADD COLUMN IF NOT EXISTS location_source message_location_source,
+  ADD COLUMN IF NOT EXISTS location_final BOOLEAN;
+CREATE INDEX IF NOT EXISTS message_to_locate ON message (user_id, timestamp)
+  WHERE location_source IS NULL OR location_source = 'interpolated';
+CREATE TABLE IF NOT EXISTS latest_message_per_user
+(
+  user_id           INTEGER PRIMARY KEY,
+  msg_id            INTEGER REFERENCES message(id),
+  timestamp         TIMESTAMP NOT NULL
+);
+CREATE INDEX IF NOT EXISTS latest_message_per_user_timestamp ON latest_message_per_user (timestamp DESC);
+INSERT INTO latest_message_per_user (user_id, msg_id, timestamp)
+  SELECT DISTINCT ON (user_id) user_id, id, timestamp FROM message
+  WHERE timestamp IS NOT NULL ORDER BY user_id, timestamp DESC, id DESC
+ON CONFLICT (user_id) DO NOTHING;
+ALTER TABLE message ADD COLUMN IF NOT EXISTS search_vector TSVECTOR;
+''' + SQL_CREATE_SEARCH_TRIGGER + '''
+-- Fill in search vector of existing messages through trigger
+UPDATE message SET title = title WHERE search_vector IS NULL;
+CREATE INDEX IF NOT EXISTS message_search ON message USING GIN (search_vector);
+'''
+
 # Fields not to include, both for message and media
 MESSAGE_SENSITIVE_FIELDS = {'telegram_message', 'log'}
 
+# Only select what we send out, telegram_message and the transcoder log can be large
+MESSAGE_PUBLIC_COLUMNS = ('id', 'user_id', 'received', 'timestamp', 'title', 'text', 'lon', 'lat', 'location_source')
+# For admins, but still without search_vector, that's only for querying
+MESSAGE_FULL_COLUMNS = MESSAGE_PUBLIC_COLUMNS + ('telegram_message', 'location_final')
+MEDIA_PUBLIC_COLUMNS = ('id', 'msg_id', 'path', 'type', 'received', 'timestamp', 'original',
+                        'width', 'height', 'duration', 'conf_name')
+
+SQL_SELECT_MSGS = """
+SELECT {columns}, m.media FROM message {lateral_media}
+  WHERE {where} AND message.timestamp >= $2 AND message.timestamp <= $3
+  -- Keyset cursor, only messages before ($4, $5) in (timestamp, id) order
+  AND (message.timestamp < $4 OR (message.timestamp = $4 AND message.id < $5))
+  ORDER BY message.timestamp DESC, message.id DESC LIMIT $6;
+"""
+
+WHERE_MSGS_BY_USER = 'message.user_id=$1'
+# Several users at once, e.g. everyone in an adventure
+WHERE_MSGS_BY_USERS = 'message.user_id = ANY($1::INTEGER[])'
+
+
+# Public and full message rows, with media aggregated
+PUBLIC_MSG_CONVERTER = RecordConverter(exclude=MESSAGE_SENSITIVE_FIELDS)
+FULL_MSG_CONVERTER = RecordConverter()
+# Search results also have rank and snippet
+SEARCH_CONVERTER = RecordConverter(exclude=MESSAGE_SENSITIVE_FIELDS)
+# Timestamps as ISO strings, they're sent to the location service
+LOCATE_CONVERTER = RecordConverter(parse_media=False, parse_ptz=False)
+
+
+def msg_converter(exclude_sensitive=True):
+    return PUBLIC_MSG_CONVERTER if exclude_sensitive else FULL_MSG_CONVERTER
+
+
+def msg_columns(exclude_sensitive=True):
+    columns = MESSAGE_PUBLIC_COLUMNS if exclude_sensitive else MESSAGE_FULL_COLUMNS
+    return ', '.join('message.' + c for c in columns)
+
+
+def lateral_media(exclude_sensitive=True):
+    "Aggregate media per message, instead of grouping the whole media table and joining on that"
+    columns = ', '.join(MEDIA_PUBLIC_COLUMNS) if exclude_sensitive else '*'
+    return '''
+    LEFT JOIN LATERAL (SELECT json_agg(r) AS media FROM
+      (SELECT {} FROM media WHERE media.msg_id = message.id) AS r) AS m ON TRUE
+    '''.format(columns)
+
+
+def select_msgs_sql(where, exclude_sensitive=True):
+    return SQL_SELECT_MSGS.format(columns=msg_columns(exclude_sensitive), lateral_media=lateral_media(exclude_sensitive),
+                                  where=where)
+
+
+# Highlight markers that can't be in messages, replaced after escaping the snippet
+HIGHLIGHT_START, HIGHLIGHT_STOP = '\x02', '\x03'
+
+# Ranked and paginated by (rank, id), only messages on the page get a snippet
+SQL_SEARCH_MSGS = """
+SELECT {columns}, m.media, page.rank,
+  ts_headline('{config}', coalesce(message.title, '') || E'\\n' || coalesce(message.text, ''),
+              plainto_tsquery('{config}', $2), $8) AS snippet
+FROM (
+  SELECT hits.id, hits.rank FROM (
+    SELECT message.id, ts_rank(message.search_vector, plainto_tsquery('{config}', $2))::FLOAT AS rank
+    FROM message
+    WHERE message.search_vector @@ plainto_tsquery('{config}', $2) AND message.user_id = ANY($1::INTEGER[])
+      AND message.timestamp >= $3 AND message.timestamp <= $4
+  ) AS hits
+  -- Keyset cursor, only results after ($5, $6) in (rank, id) order
+  WHERE hits.rank < $5 OR (hits.rank = $5 AND hits.id < $6)
+  ORDER BY hits.rank DESC, hits.id DESC LIMIT $7
+) AS page
+JOIN message ON message.id = page.id
+{lateral_media}
+ORDER BY page.rank DESC, page.id DESC;
+""".format(columns=msg_columns(), lateral_media=lateral_media(), config=SEARCH_CONFIG)
+
+SEARCH_HEADLINE_OPTIONS = 'StartSel={}, StopSel={}, MaxWords=30, MinWords=10, MaxFragments=2'.format(
+    HIGHLIGHT_START, HIGHLIGHT_STOP)
+
+
+def snippet_to_html(snippet):
+    "Escape message text, then mark the matches"
+    return html.escape(snippet or '').replace(HIGHLIGHT_START, '<mark>').replace(HIGHLIGHT_STOP, '</mark>')
+
+
+# Largest id that fits in SERIAL
+MAX_ID = 2 ** 31 - 1
+
+
+def parse_cursor(before):
+    "From [<iso timestamp>, <id>] to (datetime, id), None stays None"
+    if not before:
+        return None
+    timestamp, msg_id = before
+    return convert_to_datetime(timestamp), int(msg_id)
+
+
+def cursor_key(msg):
+    "Sort key of message dict in cursor order"
+    return convert_to_datetime(msg['timestamp']), msg['id']
+
+
+def add_coordinates(msg):
+    "Stored location as [lon, lat] in *coordinates*, like the client expects"
+    if msg.get('lon') is not None and msg.get('lat') is not None:
+        msg['coordinates'] = [msg['lon'], msg['lat']]
+    return msg
+
+
+def msg_row(msg, received):
+    "Values of message columns in MESSAGE_IMPORT_COLUMNS order from msg json"
+    timestamp = msg.get('timestamp', None)
+    if timestamp:
+        # Parse if ISO string
+        timestamp = convert_to_datetime(timestamp)
+    # Location sent along with message, if any
+    lon, lat = msg.get('coordinates') or (None, None)
+    location_source = msg.get('location_source', 'telegram') if lon is not None else None
+    telegram_message = msg.get('telegram_message')
+    if telegram_message is not None:
+        telegram_message = encode_json(telegram_message)
+    return (msg['user_id'], timestamp, received, msg.get('title', None), msg.get('text', None), telegram_message,
+            lon, lat, location_source)
+
+
+def msgs_page(msgs, limit, cursor_fields=('timestamp', 'id')):
+    """
+    Take first *limit* of newest-first *msgs*, pass at least *limit* + 1 to know if there's a next page.
+    Returns {'messages': [...], 'next': <cursor for next page or None>}
+    """
+    msgs = list(msgs)
+    page = msgs[:limit]
+    nxt = None
+    if len(msgs) > limit and page:
+        nxt = [page[-1][f] for f in cursor_fields]
+    return {'messages': page, 'next': nxt}
+
 
 class Db():
     @classmethod
     async def create(cls):
         "Use like `await Db.create()` to enable use of async methods"
         db = Db()
-        db.pool = await asyncpg.create_pool(dsn=environ["DB_URI_ATSITE"])
+        db.pool = await create_pool()
         return db
 
     async def create_tables(self, existingconn=None):
         conn = existingconn or self.pool
         stat = await conn.execute(SQL_CREATE_TABLE_MESSAGE)
         stat += await conn.execute(SQL_CREATE_TABLE_MEDIA)
+        stat += await conn.execute(SQL_CREATE_TABLE_LATEST_MESSAGE)
+        stat += await conn.execute(SQL_CREATE_SEARCH_TRIGGER)
+        stat += await conn.execute(SQL_CREATE_INDEX_MESSAGE)
         return stat
 
+    async def migrate_tables(self, existingconn=None):
+        conn = existingconn or self.pool
+        return await conn.execute(SQL_MIGRATE_TABLE_MESSAGE)
+
     async def getmsg(self, msg_id, exclude_sensitive=True, existingconn=None):
         conn = existingconn or self.pool
         # Postgres is amazing. It joins with media and puts media in json list
         row = await conn.fetchrow('''
-        SELECT * FROM message LEFT OUTER JOIN
-            (SELECT msg_id, json_agg(r) AS media FROM media AS r GROUP BY r.msg_id)
-          AS m ON message.id=m.msg_id WHERE message.id=$1;
-        ''', msg_id)
+        SELECT {}, m.media FROM message {} WHERE message.id=$1;
+        '''.format(msg_columns(exclude_sensitive), lateral_media(exclude_sensitive)), msg_id)
         if not row:
             return None
-        return await record_to_dict(row, exclude=MESSAGE_SENSITIVE_FIELDS)
+        return add_coordinates(msg_converter(exclude_sensitive)(row))
 
-    async def getmsgs(self, user_id, start=datetime.datetime.min, end=datetime.datetime.max, exclude_sensitive=True, existingconn=None):
+    async def getmsgs(self, user_id, start=datetime.datetime.min, end=datetime.datetime.max, exclude_sensitive=True,
+                      limit=None, before=None, existingconn=None):
+        """
+        Newest messages first. Pass *limit* to get at most that many,
+        and *before* as [<timestamp>, <id>] cursor to only get messages older than that.
+        """
+        return await self._getmsgs(WHERE_MSGS_BY_USER, user_id, start, end, exclude_sensitive, limit, before,
+                                   existingconn)
+
+    async def getmsgs_by_user_ids(self, user_ids, start=datetime.datetime.min, end=datetime.datetime.max,
+                                  exclude_sensitive=True, limit=None, before=None, existingconn=None):
+        "Messages of all given users in one list, newest first, see getmsgs"
+        return await self._getmsgs(WHERE_MSGS_BY_USERS, list(user_ids), start, end, exclude_sensitive, limit, before,
+                                   existingconn)
+
+    async def _getmsgs(self, where, user_id, start, end, exclude_sensitive, limit, before, existingconn):
         # Allow passing in an existing connection for unittesting
         conn = existingconn or self.pool
         # Make sure they're datetime.datetime
         start = convert_to_datetime(start)
         end = convert_to_datetime(end)
+        before = parse_cursor(before) or (datetime.datetime.max, MAX_ID)
         # Convert to json list of msgs
-        rows = await conn.fetch('''
-        SELECT * FROM message LEFT OUTER JOIN
-            (SELECT msg_id, json_agg(r) AS media FROM media AS r GROUP BY msg_id)
-          AS m ON message.id=m.msg_id
-          WHERE message.user_id=$1 AND message.timestamp >= $2 AND message.timestamp <= $3
-          ORDER BY message.timestamp DESC;
-          ''', user_id, start, end)
-        return await records_to_dict(rows, exclude=MESSAGE_SENSITIVE_FIELDS)
+        rows = await conn.fetch(select_msgs_sql(where, exclude_sensitive), user_id, start, min(end, before[0]),
+                                before[0], before[1], limit)
+        return [add_coordinates(m) for m in msg_converter(exclude_sensitive).many(rows)]
+
+    async def search(self, user_ids, query, start=datetime.datetime.min, end=datetime.datetime.max,
+                     limit=20, before=None, existingconn=None):
+        """
+        Messages of users matching full-text *query*, best match first, with an html *snippet*
+        with matches in <mark>. Pass [<rank>, <id>] of last result as *before* for the next page.
+        """
+        conn = existingconn or self.pool
+        rank, msg_id = before or (float('inf'), MAX_ID)
+        rows = await conn.fetch(SQL_SEARCH_MSGS, list(user_ids), query, convert_to_datetime(start),
+                                convert_to_datetime(end), float(rank), int(msg_id), limit, SEARCH_HEADLINE_OPTIONS)
+        msgs = [add_coordinates(m) for m in SEARCH_CONVERTER.many(rows)]
+        for msg in msgs:
+            msg['snippet'] = snippet_to_html(msg['snippet'])
+        return msgs
 
     async def uniquemsgs(self, n=5, exclude_sensitive=True, existingconn=None):
         "Return last n most recent messages, max. one per user"
         conn = existingconn or self.pool
         rows = await conn.fetch('''
-        SELECT DISTINCT ON (message.user_id) * FROM message LEFT OUTER JOIN
-          (SELECT msg_id, json_agg(r) AS media FROM media AS r GROUP BY msg_id)
-        AS m ON message.id=m.msg_id ORDER BY message.user_id, message.timestamp DESC LIMIT $1;
-        ''', n)
-        return await records_to_dict(rows, exclude=MESSAGE_SENSITIVE_FIELDS)
+        SELECT {}, m.media FROM
+          (SELECT msg_id FROM latest_message_per_user ORDER BY timestamp DESC LIMIT $1) AS latest
+        JOIN message ON message.id = latest.msg_id
+        {}
+        ORDER BY message.timestamp DESC;
+        '''.format(msg_columns(exclude_sensitive), lateral_media(exclude_sensitive)), n)
+        return [add_coordinates(m) for m in msg_converter(exclude_sensitive).many(rows)]
 
     async def insertmsg(self, msg, existingconn=None):
         """
         Parses msg json and inserts into db.
         """
         conn = existingconn or self.pool
-        received = datetime.datetime.utcnow()
-        user_id = msg['user_id']
-        timestamp = msg.get('timestamp', None)
-        if timestamp:
-            # Parse if ISO string
-            timestamp = convert_to_datetime(timestamp)
-        title = msg.get('title', None)
-        text = msg.get('text', None)
-        # Let Postgres return generated id and fetch its value
+        # Let Postgres return generated id and fetch its value, and keep latest message of user up to date
         id = await conn.fetchval('''
-        INSERT INTO message (id, user_id, timestamp, received, title, text, telegram_message)
-        VALUES (DEFAULT, $1, $2, $3, $4, $5, $6) RETURNING id
-        ''', user_id, timestamp, received, title, text, msg.get('telegram_message'))
+        WITH msg AS (
+          INSERT INTO message (id, user_id, timestamp, received, title, text, telegram_message, lon, lat, location_source)
+          VALUES (DEFAULT, $1, $2, $3, $4, $5, $6, $7, $8, $9) RETURNING id, user_id, timestamp
+        ), latest AS (
+          INSERT INTO latest_message_per_user (user_id, msg_id, timestamp)
+          SELECT user_id, id, timestamp FROM msg WHERE timestamp IS NOT NULL
+          ON CONFLICT (user_id) DO UPDATE SET msg_id = EXCLUDED.msg_id, timestamp = EXCLUDED.timestamp
+            WHERE EXCLUDED.timestamp >= latest_message_per_user.timestamp
+        )
+        SELECT id FROM msg;
+        ''', *msg_row(msg, datetime.datetime.utcnow()))
         return id
 
+    async def import_msgs(self, msgs, chunk_size=1000, existingconn=None):
+        """
+        Bulk insert an iterable of msg json, e.g. from iter_json_records, with COPY in chunks
+        of *chunk_size* messages. Every chunk is a transaction. Returns number of messages imported.
+        """
+        async def import_chunk(conn, chunk):
+            received = datetime.datetime.utcnow()
+            async with conn.transaction():
+                await conn.copy_records_to_table('message_import', records=[msg_row(m, received) for m in chunk],
+                                                 columns=MESSAGE_IMPORT_COLUMNS)
+                n = await conn.fetchval(SQL_IMPORT_MSGS)
+                await conn.execute('TRUNCATE message_import;')
+            return n
+
+        async def run(conn):
+            await conn.execute(SQL_CREATE_MESSAGE_IMPORT)
+            return await import_chunks(msgs, lambda chunk: import_chunk(conn, chunk), chunk_size, 'messages')
+
+        if existingconn:
+            return await run(existingconn)
+        async with self.pool.acquire() as conn:
+            return await run(conn)
+
+    async def set_msg_location(self, msg_id, lon, lat, location_source, final=None, existingconn=None):
+        """
+        Store message location, *final* if interpolated with a point after the message.
+        An interpolated location never overwrites one from telegram or EXIF. Returns True if changed.
+        """
+        conn = existingconn or self.pool
+        stat = await conn.execute('''
+        UPDATE message SET lon = $2, lat = $3, location_source = $4, location_final = $5
+        WHERE id = $1 AND (location_source IS NULL OR location_source = 'interpolated' OR $4 <> 'interpolated')
+          AND (lon, lat, location_source, location_final) IS DISTINCT FROM ($2, $3, $4, $5);
+        ''', msg_id, lon, lat, location_source, final)
+        return stat == 'UPDATE 1'
+
+    async def get_msgs_to_locate(self, user_id=None, start=datetime.datetime.min, end=datetime.datetime.max,
+                                 include_interpolated=False, after_id=0, limit=None, existingconn=None):
+        """
+        Messages without location, ordered by id. Also the ones with an interpolated location that isn't final
+        if *include_interpolated*, e.g. because new GPS points arrived. Includes path of original image, if any.
+        Timestamps are ISO strings, so they can be sent over WAMP.
+        """
+        conn = existingconn or self.pool
+        rows = await conn.fetch('''
+        SELECT message.id, message.user_id, message.timestamp, img.path AS image_path FROM message
+        LEFT JOIN LATERAL
+          (SELECT path FROM media WHERE media.msg_id = message.id AND original AND type = 'image' LIMIT 1)
+          AS img ON TRUE
+        WHERE (message.location_source IS NULL
+               OR ($1 AND message.location_source = 'interpolated' AND message.location_final IS NOT TRUE))
+          AND ($2::INTEGER IS NULL OR message.user_id = $2)
+          AND message.timestamp >= $3 AND message.timestamp <= $4 AND message.id > $5
+        ORDER BY message.id LIMIT $6;
+        ''', include_interpolated, user_id, convert_to_datetime(start), convert_to_datetime(end), after_id, limit)
+        return LOCATE_CONVERTER.many(rows)
+
     async def insertmedia(self, media, existingconn=None):
         conn = existingconn or self.pool
         received = datetime.datetime.utcnow()
         id = await conn.fetchval('''
         INSERT INTO media (id, msg_id, received, timestamp, original, type, path, log, conf_name, width, height, duration)
         VALUES (DEFAULT, $1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11) RETURNING id''',
-        media['msg_id'], received, media.get('timestamp'), media.get('original', False), media['type'], media['path'],
+        media['msg_id'], received, convert_to_datetime(media.get('timestamp')), media.get('original', False), media['type'], media['path'],
         media.get('log'), media.get('conf_name'), media.get('width'), media.get('height'), media.get('duration'))
         return id
 
@@ -167,12 +506,358 @@ async def test_db_basics(db):
                 msgs = await db.getmsgs(intmin, existingconn=conn)
                 assert len(msgs) == 1
                 assert msgs[0]['title'] == 'Titre'
+                assert 'coordinates' not in msgs[0]
+                # Interpolated location is stored, but doesn't replace a known one
+                msg_id = msgs[0]['id']
+                assert [m['id'] for m in await db.get_msgs_to_locate(user_id=intmin, existingconn=conn)] == [msg_id]
+                assert await db.set_msg_location(msg_id, 1.0, 43.0, 'interpolated', existingconn=conn)
+                assert await db.get_msgs_to_locate(user_id=intmin, existingconn=conn) == []
+                assert await db.get_msgs_to_locate(user_id=intmin, include_interpolated=True, existingconn=conn)
+                # Same location again is no change, with a point after it is final
+                assert not await db.set_msg_location(msg_id, 1.0, 43.0, 'interpolated', existingconn=conn)
+                assert await db.set_msg_location(msg_id, 1.0, 43.0, 'interpolated', final=True, existingconn=conn)
+                assert await db.get_msgs_to_locate(user_id=intmin, include_interpolated=True, existingconn=conn) == []
+                assert await db.set_msg_location(msg_id, 1.1, 43.1, 'exif', existingconn=conn)
+                assert not await db.set_msg_location(msg_id, 1.2, 43.2, 'interpolated', existingconn=conn)
+                msg = await db.getmsg(msg_id, existingconn=conn)
+                assert msg['coordinates'] == [1.1, 43.1] and msg['location_source'] == 'exif'
+                # Latest message per user, newest first, also when inserted out of order
+                future = datetime.datetime(2100, 1, 1)
+                for user_id, days in ((intmin, 2), (intmin, 1), (intmin + 1, 3), (intmin + 1, 4)):
+                    await db.insertmsg({'user_id': user_id, 'title': str(days),
+                                        'timestamp': future + datetime.timedelta(days=days)}, existingconn=conn)
+                msgs = await db.uniquemsgs(n=2, existingconn=conn)
+                assert [(m['user_id'], m['title']) for m in msgs] == [(intmin + 1, '4'), (intmin, '2')]
                 # Roll back transaction
                 raise RollbackException
         except RollbackException:
             pass
 
 
+async def test_pagination(db):
+    "Pages should cover all messages once, also with equal timestamps"
+    intmin = -2147483648
+    t = datetime.datetime(2017, 6, 1, 12)
+    async with db.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                for user_id in (intmin, intmin + 1):
+                    for minutes in (0, 1, 1, 1, 2, 5, 8):
+                        await db.insertmsg({'user_id': user_id, 'timestamp': t + datetime.timedelta(minutes=minutes)},
+                                           existingconn=conn)
+                allmsgs = await db.getmsgs(intmin, existingconn=conn)
+                assert [cursor_key(m) for m in allmsgs] == sorted(map(cursor_key, allmsgs), reverse=True)
+                # Walk through pages of one user
+                paged, before = [], None
+                while True:
+                    msgs = await db.getmsgs(intmin, limit=3, before=before, existingconn=conn)
+                    page = msgs_page(msgs, 2)
+                    paged.extend(page['messages'])
+                    before = page['next']
+                    if not before:
+                        break
+                assert [m['id'] for m in paged] == [m['id'] for m in allmsgs]
+                # Both users at once are in global order
+                msgs = await db.getmsgs_by_user_ids([intmin, intmin + 1], limit=5, existingconn=conn)
+                page = msgs_page(msgs, 4)
+                keys = [cursor_key(m) for m in page['messages']]
+                assert len(keys) == 4 and keys == sorted(keys, reverse=True)
+                assert {m['user_id'] for m in page['messages']} == {intmin, intmin + 1}
+                assert keys[0][0] == t + datetime.timedelta(minutes=8)
+                msgs = await db.getmsgs_by_user_ids([intmin, intmin + 1], start=t + datetime.timedelta(minutes=2),
+                                                    end=t + datetime.timedelta(minutes=5), existingconn=conn)
+                assert len(msgs) == 4
+                raise RollbackException
+        except RollbackException:
+            pass
+
+
+async def test_locate_msg(db):
+    "Messages to locate go over WAMP as they are, and one failing call doesn't stop the others"
+    from .main import locate_msg
+    intmin = -2147483648
+    calls = []
+
+    async def call(procedure, user_id, timestamp, **kwargs):
+        # Like autobahn's serializer
+        json.dumps([user_id, timestamp, kwargs])
+        calls.append(timestamp)
+        if len(calls) == 1:
+            raise RuntimeError("Transport lost")
+        return {'coordinates': [1.0, 43.0], 'point_after': True}
+
+    async with db.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                t = datetime.datetime(2017, 6, 1, 12)
+                for minutes in (0, 1):
+                    await db.insertmsg({'user_id': intmin, 'timestamp': t + datetime.timedelta(minutes=minutes)},
+                                       existingconn=conn)
+                msgs = await db.get_msgs_to_locate(user_id=intmin, existingconn=conn)
+                assert msgs[0]['timestamp'] == t.isoformat()
+                located = [await locate_msg(db, call, m['id'], m['user_id'], m['timestamp'], m['image_path'],
+                                            existingconn=conn) for m in msgs]
+                assert located == [False, True]
+                assert [m['id'] for m in await db.get_msgs_to_locate(user_id=intmin, existingconn=conn)] == \
+                    [msgs[0]['id']]
+                # With a point after it, new points don't relocate it
+                assert [m['id'] for m in await db.get_msgs_to_locate(user_id=intmin, include_interpolated=True,
+                                                                     existingconn=conn)] == [msgs[0]['id']]
+                # Unchanged location is no update
+                assert not await locate_msg(db, call, msgs[1]['id'], intmin, msgs[1]['timestamp'], existingconn=conn)
+                raise RollbackException
+        except RollbackException:
+            pass
+
+
+async def explain_analyze(conn, query, *args):
+    "Returns list of (<node type>, <relation name>) in plan, and execution time in ms"
+    # The plan is json, decoded already by the codec of create_pool
+    plan = (await conn.fetchval('EXPLAIN (ANALYZE, FORMAT JSON) ' + query, *args))[0]
+    nodes = []
+    def walk(node):
+        nodes.append((node['Node Type'], node.get('Relation Name')))
+        for child in node.get('Plans', []):
+            walk(child)
+    walk(plan['Plan'])
+    return nodes, plan['Execution Time']
+
+
+async def test_media_join_scales(db):
+    "Fetching a user's messages should not depend on how much media other users have"
+    intmin = -2147483648
+    seed = '''
+    WITH msgs AS (
+      INSERT INTO message (user_id, received, timestamp, title)
+      SELECT $1 - (i % $3), now(), now() - i * interval '1 minute', 'Seed' FROM generate_series(1, $2) AS i
+      RETURNING id)
+    INSERT INTO media (msg_id, path, type, original)
+    SELECT id, 'seed.jpg', 'image', TRUE FROM msgs, generate_series(1, $4);
+    '''
+    async with db.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                # User we fetch, 20 messages with 3 media each
+                await conn.execute(seed, intmin, 20, 1, 3)
+                results = []
+                # Other users, first a little and then a lot of messages
+                for n in (2000, 100000):
+                    await conn.execute(seed, -1000, n, 1000, 2)
+                    await conn.execute('ANALYZE message; ANALYZE media;')
+                    nodes, ms = await explain_analyze(
+                        conn, select_msgs_sql(WHERE_MSGS_BY_USER), intmin, datetime.datetime.min, datetime.datetime.max,
+                        datetime.datetime.max, MAX_ID, None)
+                    logger.info("Fetching messages with %s other messages took %.2fms, plan: %s", n, ms, nodes)
+                    results.append((nodes, ms))
+                    assert ('Seq Scan', 'message') not in nodes, "Should use index on message"
+                    assert ('Seq Scan', 'media') not in nodes, "Should only look up media of fetched messages"
+                    msgs = await db.getmsgs(intmin, existingconn=conn)
+                    assert len(msgs) == 20 and all(len(m['media']) == 3 for m in msgs)
+                # 50 times more data should not make it much slower, leave margin for noise
+                (_, small), (_, large) = results
+                assert large < max(3 * small, small + 5), "{:.2f}ms vs {:.2f}ms".format(small, large)
+                raise RollbackException
+        except RollbackException:
+            pass
+
+
+async def test_search(db):
+    "Search should find words in title and text, title first, highlight matches and page by rank"
+    intmin = -2147483648
+    t = datetime.datetime(2017, 6, 1, 12)
+    async with db.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                for minutes, title, text in ((0, 'Col du Tourmalet', 'Long climb <b>in</b> the fog'),
+                                             (1, 'Lunch', 'Crepes after the col'),
+                                             (2, 'Tourmalet', None),
+                                             (3, 'Rest day', 'Nothing to see')):
+                    await db.insertmsg({'user_id': intmin, 'timestamp': t + datetime.timedelta(minutes=minutes),
+                                        'title': title, 'text': text}, existingconn=conn)
+                msgs = await db.search([intmin], 'col', existingconn=conn)
+                # Match in title ranks higher than in text
+                assert [m['title'] for m in msgs] == ['Col du Tourmalet', 'Lunch']
+                assert '<mark>Col</mark>' in msgs[0]['snippet']
+                # Message text is escaped, only highlights are html
+                assert '<b>' not in msgs[0]['snippet'] and '&lt;b&gt;' in msgs[0]['snippet']
+                assert 'telegram_message' not in msgs[0]
+                # All words have to match
+                msgs = await db.search([intmin], 'Tourmalet fog', existingconn=conn)
+                assert [m['title'] for m in msgs] == ['Col du Tourmalet']
+                assert await db.search([intmin + 1], 'col', existingconn=conn) == []
+                assert await db.search([intmin], 'col', end=t, existingconn=conn)[0]['title'] == 'Col du Tourmalet'
+                # Updated text is searchable
+                await conn.execute("UPDATE message SET text = 'Sunny' WHERE user_id = $1 AND title = 'Rest day';",
+                                   intmin)
+                assert len(await db.search([intmin], 'sunny', existingconn=conn)) == 1
+                # Pages by (rank, id)
+                allmsgs = await db.search([intmin], 'tourmalet', existingconn=conn)
+                paged, before = [], None
+                while True:
+                    page = msgs_page(await db.search([intmin], 'tourmalet', limit=2, before=before,
+                                                     existingconn=conn), 1, cursor_fields=('rank', 'id'))
+                    paged.extend(page['messages'])
+                    before = page['next']
+                    if not before:
+                        break
+                assert len(allmsgs) == 2 and [m['id'] for m in paged] == [m['id'] for m in allmsgs]
+                raise RollbackException
+        except RollbackException:
+            pass
+
+
+def is_lfs_pointer(path):
+    "Test data is in git LFS, and might not have been fetched"
+    with open(path) as f:
+        return f.read(40).startswith('version https://git-lfs')
+
+
+async def test_import_msgs(db, path='testdata/stjean/msgs.json'):
+    "Bulk import should give the same messages as inserting them one by one"
+    import io
+    intmin = -2147483648
+    # In the future, so they're the latest messages of all
+    t = datetime.datetime(2100, 1, 1)
+    msgs = [{'user_id': intmin + i % 2, 'timestamp': (t + datetime.timedelta(minutes=i)).isoformat(),
+             'title': 'Import {}'.format(i), 'text': 'Bulk', 'coordinates': [1.0, 43.0] if i % 3 else None,
+             'telegram_message': {'message_id': i}}
+            for i in range(2500)]
+    ndjson = io.StringIO(''.join(json.dumps(m) + '\n' for m in msgs))
+    async with db.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                assert await db.import_msgs(iter_json_records(ndjson), chunk_size=1000, existingconn=conn) == 2500
+                stored = await db.getmsgs(intmin, exclude_sensitive=False, existingconn=conn)
+                assert len(stored) == 1250
+                assert stored[0]['title'] == 'Import 2498' and stored[0]['telegram_message'] == {'message_id': 2498}
+                assert stored[0]['coordinates'] == [1.0, 43.0] and stored[0]['location_source'] == 'telegram'
+                assert 'search_vector' not in stored[0]
+                assert len(await db.search([intmin], 'bulk', limit=3000, existingconn=conn)) == 1250
+                latest = await db.uniquemsgs(n=2, existingconn=conn)
+                assert [m['title'] for m in latest] == ['Import 2499', 'Import 2498']
+                if is_lfs_pointer(path):
+                    logger.warning("%s not fetched from git LFS, skipping", path)
+                else:
+                    with open(path) as f:
+                        n = len(json.load(f))
+                    with open(path) as f:
+                        assert await db.import_msgs(iter_json_records(f), existingconn=conn) == n
+                raise RollbackException
+        except RollbackException:
+            pass
+
+
+def fake_telegram_message(i, user_id):
+    "Roughly what python-telegram-bot's Message.to_dict() gives for a photo with caption"
+    user = {'id': 100000000 + user_id % 1000, 'first_name': 'Athlete', 'last_name': 'Test',
+            'username': 'athlete{}'.format(user_id % 1000), 'language_code': 'en-US'}
+    return json.dumps({
+        'message_id': i, 'date': 1496318400 + i * 60, 'from': user,
+        'chat': dict(user, type='private'),
+        'caption': 'Day {} of the crossing, windy but good progress'.format(i),
+        'photo': [{'file_id': 'AgADBAAD{:0>60}'.format(i * 4 + k), 'width': w, 'height': w * 3 // 4,
+                   'file_size': w * 120} for k, w in enumerate((90, 320, 800, 1280))],
+        'entities': [], 'caption_entities': [], 'new_chat_members': [], 'new_chat_photo': [],
+        'delete_chat_photo': False, 'group_chat_created': False, 'supergroup_chat_created': False,
+        'channel_chat_created': False})
+
+
+def fake_transcoder_log(conf_name):
+    "ffmpeg stderr is usually a few hundred lines of progress"
+    header = 'ffmpeg version 3.2.4 Copyright (c) 2000-2017 the FFmpeg developers\n' + \
+             '  configuration: --enable-gpl --enable-libx264 --enable-libvpx\n' * 10
+    progress = ''.join('frame={:5d} fps= 30 q=28.0 size={:6d}kB time=00:00:{:05.2f} bitrate=2454.2kbits/s speed=1.2x\n'
+                       .format(f, f * 10, f / 30) for f in range(0, 3000, 15))
+    return header + progress + 'video:{} audio:0kB muxing overhead: 0.5%\n'.format(conf_name)
+
+
+async def benchmark_projection(db, n_msgs=200, repeat=20):
+    "Bytes and time per getmsgs call with all columns vs only public columns"
+    import time
+    intmin = -2147483648
+    t = datetime.datetime(2017, 6, 1, 12)
+    async with db.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                for i in range(n_msgs):
+                    msg_id = await db.insertmsg({'user_id': intmin, 'timestamp': t + datetime.timedelta(minutes=i),
+                                                 'title': 'Message {}'.format(i), 'text': 'Lorem ipsum ' * 20,
+                                                 'telegram_message': fake_telegram_message(i, intmin)},
+                                                existingconn=conn)
+                    for conf_name in ('thumb', '360p', '720p', '1080p'):
+                        await db.insertmedia({'msg_id': msg_id, 'type': 'video', 'path': 'video/{}.mp4'.format(i),
+                                              'conf_name': conf_name, 'width': 640, 'height': 360, 'duration': 12.3,
+                                              'log': fake_transcoder_log(conf_name)}, existingconn=conn)
+                args = (intmin, datetime.datetime.min, datetime.datetime.max, datetime.datetime.max, MAX_ID, None)
+                results = {}
+                for name, exclude_sensitive in (('all_columns', False), ('public_columns', True)):
+                    query = select_msgs_sql(WHERE_MSGS_BY_USER, exclude_sensitive).strip().rstrip(';')
+                    # Text representation of rows, close to what goes over the wire
+                    nbytes = await conn.fetchval('SELECT sum(octet_length(q::text)) FROM ({}) AS q;'.format(query),
+                                                 *args)
+                    start = time.perf_counter()
+                    for _ in range(repeat):
+                        await db.getmsgs(intmin, exclude_sensitive=exclude_sensitive, existingconn=conn)
+                    ms = 1000 * (time.perf_counter() - start) / repeat
+                    results[name] = {'bytes': nbytes, 'ms_per_call': round(ms, 2)}
+                    logger.info("getmsgs with %s: %s bytes, %.2fms per call for %s messages",
+                                name, nbytes, ms, n_msgs)
+                raise RollbackException
+        except RollbackException:
+            pass
+    return results
+
+
+async def benchmark_search(db, n_msgs=1000000, n_users=2000, adventure_users=20, repeat=10):
+    """
+    Search time in an adventure with *n_msgs* messages in the table, seeded in a nested transaction.
+    Messages are random sentences from a vocabulary of a few thousand words, with a Zipf-like distribution.
+    """
+    import time
+    intmin = -2147483648
+    t = datetime.datetime(2017, 6, 1, 12)
+    seed = '''
+    INSERT INTO message (user_id, received, timestamp, title, text)
+    SELECT $1 + (i % $3), now(), $4::TIMESTAMP - i * interval '1 second',
+      (SELECT string_agg('w' || floor(pow(random(), 3) * 5000)::INT, ' ') FROM generate_series(1, 3 + i % 2)),
+      (SELECT string_agg('w' || floor(pow(random(), 3) * 5000)::INT, ' ') FROM generate_series(1, 20 + i % 2))
+    FROM generate_series(1, $2) AS i;
+    '''
+    results = {}
+    async with db.pool.acquire() as conn:
+        try:
+            async with conn.transaction():
+                start = time.perf_counter()
+                # Subqueries refer to i, so they're evaluated for every row
+                await conn.execute(seed, intmin, n_msgs, n_users, t)
+                await conn.execute('ANALYZE message;')
+                logger.info("Seeded %s messages in %.1fs", n_msgs, time.perf_counter() - start)
+                user_ids = [intmin + i for i in range(adventure_users)]
+                # Common, medium and rare words, and two words at once
+                for query in ('w0', 'w10', 'w100', 'w3000', 'w1 w20'):
+                    nodes, _ = await explain_analyze(
+                        conn, SQL_SEARCH_MSGS, user_ids, query, datetime.datetime.min, datetime.datetime.max,
+                        float('inf'), MAX_ID, 20, SEARCH_HEADLINE_OPTIONS)
+                    timings = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        msgs = await db.search(user_ids, query, existingconn=conn)
+                        timings.append(1000 * (time.perf_counter() - start))
+                    timings.sort()
+                    results[query] = {'hits_on_page': len(msgs), 'median_ms': round(timings[len(timings) // 2], 2),
+                                      'max_ms': round(timings[-1], 2)}
+                    logger.info("Searching %r in %s users: %s, plan: %s", query, adventure_users, results[query],
+                                nodes)
+                    assert ('Seq Scan', 'message') not in nodes, "Should use an index on message"
+                slow = {q: r for q, r in results.items() if r['median_ms'] > 50}
+                if slow:
+                    logger.warning("Slower than 50ms: %s", slow)
+                raise RollbackException
+        except RollbackException:
+            pass
+    return results
+
+
 if __name__=="__main__":
     # Nice output when run on cmdline
     logging.basicConfig(
@@ -184,10 +869,18 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--create', action='store_true',
                         help="Create database tables")
+    parser.add_argument('--migrate', action='store_true',
+                        help="Add indexes to existing tables")
     parser.add_argument('--test', action='store_true',
                         help="Test on real db using nested transactions")
     parser.add_argument('--importmsgs',
-                        help="Import json file with list of messages into db")
+                        help="Import json file with list of messages, or one message per line, into db")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="Messages per COPY when importing")
+    parser.add_argument('--benchmark', action='store_true',
+                        help="Compare fetching messages with and without heavy columns, using nested transactions")
+    parser.add_argument('--benchmark-search', action='store_true',
+                        help="Time full-text search with a million messages, using nested transactions")
     args = parser.parse_args()
 
     l = asyncio.get_event_loop()
@@ -198,19 +891,30 @@ if __name__=="__main__":
         stat = l.run_until_complete(db.create_tables())
         logger.info("Created tables, status: %s", stat)
 
+    if args.migrate:
+        stat = l.run_until_complete(db.migrate_tables())
+        logger.info("Migrated tables, status: %s", stat)
+
+    if args.benchmark:
+        l.run_until_complete(benchmark_projection(db))
+
+    if args.benchmark_search:
+        l.run_until_complete(benchmark_search(db))
+
     if args.test or args.importmsgs:
         try:
             if args.test:
                 l.run_until_complete(test_db_basics(db))
+                l.run_until_complete(test_pagination(db))
+                l.run_until_complete(test_locate_msg(db))
+                l.run_until_complete(test_media_join_scales(db))
+                l.run_until_complete(test_search(db))
+                l.run_until_complete(test_import_msgs(db))
             elif args.importmsgs:
-                with open(args.importmsgs, 'r') as f:
-                    msgs = json.load(f)
-                if not 'y' in input("Continue loading {} messages? [y/N] ".format(len(msgs))).lower():
+                if not 'y' in input("Continue loading messages from {}? [y/N] ".format(args.importmsgs)).lower():
                     raise Warning("Exiting...")
-                coros = [db.insertmsg(msg) for msg in msgs]
-                l.run_until_complete(asyncio.wait(coros))
-                logger.info("Inserted all messages")
+                with open(args.importmsgs, 'r') as f:
+                    l.run_until_complete(db.import_msgs(iter_json_records(f), chunk_size=args.chunk_size))
         finally:
-            l.run_until_complete(db.finish_queues())
             l.close()
         logger.info("Completed successfully")
@@ -0,0 +1,43 @@
+from PIL import Image
+
+# EXIF tag that holds the GPS IFD
+GPSINFO_TAG = 34853
+# Keys within GPS IFD
+GPS_LATITUDE_REF = 1
+GPS_LATITUDE = 2
+GPS_LONGITUDE_REF = 3
+GPS_LONGITUDE = 4
+
+
+def rational(v):
+    "Older Pillow gives (numerator, denominator) tuples, newer an IFDRational"
+    if isinstance(v, tuple):
+        return v[0] / v[1]
+    return float(v)
+
+
+def dms_to_deg(dms, ref):
+    "Degrees, minutes, seconds to decimal degrees, negative for south and west"
+    d, m, s = (rational(v) for v in dms)
+    deg = d + m / 60 + s / 3600
+    if isinstance(ref, bytes):
+        ref = ref.decode('ascii', 'ignore')
+    return -deg if ref in ('S', 'W') else deg
+
+
+def exif_coords(path):
+    "[lon, lat] from EXIF GPS info of image, None if not available. Blocking, run in executor."
+    try:
+        with Image.open(path) as img:
+            exif = img._getexif() if hasattr(img, '_getexif') else None
+    except (OSError, SyntaxError, ValueError):
+        return None
+    gps = (exif or {}).get(GPSINFO_TAG)
+    if not gps or GPS_LATITUDE not in gps or GPS_LONGITUDE not in gps:
+        return None
+    try:
+        lat = dms_to_deg(gps[GPS_LATITUDE], gps.get(GPS_LATITUDE_REF))
+        lon = dms_to_deg(gps[GPS_LONGITUDE], gps.get(GPS_LONGITUDE_REF))
+    except (TypeError, ValueError, ZeroDivisionError):
+        return None
+    return [lon, lat]
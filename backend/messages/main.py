@@ -1,12 +1,68 @@
+import os
+import asyncio
 import datetime
 
 from autobahn.wamp.exception import ApplicationError
 
-from .db import Db
-from ..utils import BackendAppSession, getLogger
+from .db import Db, msgs_page
+from .exif import exif_coords
+from ..utils import BackendAppSession, getLogger, TTLCache, convert_to_datetime
 
 logger = getLogger('messages.main')
 
+# Max number of messages in one page
+MAX_PAGE_SIZE = 200
+# Adventure messages are cached until a message of one of its users is published,
+# expire anyway in case users are added to the adventure
+ADVENTURE_MSGS_TTL = 5 * 60
+# Same window as location service uses to interpolate, new points within this
+# time from a message can change its interpolated location
+LOCATE_WINDOW = datetime.timedelta(minutes=60)
+# While live tracking, points of a user arrive every few seconds, locate messages once
+# they've stopped coming in for this many seconds, but at least this often
+LOCATE_DEBOUNCE = 10
+LOCATE_MAX_DELAY = 60
+# Latest messages are invalidated on every new message, expire anyway to be safe
+UNIQUEMSGS_TTL = 60
+# Transcoding results of one upload arrive in quick succession, publish them as one update
+# once they've stopped coming in for this many seconds...
+PUBLISH_DEBOUNCE = 3
+# ...but don't postpone the update for longer than this, e.g. while a 1080p video is transcoding
+PUBLISH_MAX_DELAY = 30
+# User hashes never change
+USER_HASH_TTL = 60 * 60
+# A user might join an adventure or an adventure might start
+ACTIVE_ADVENTURES_TTL = 60
+
+
+async def locate_msg(db, call, msg_id, user_id, timestamp, image_path=None, existingconn=None):
+    """
+    Store message location, from EXIF of original image if possible,
+    otherwise interpolated from user's GPS track with WAMP *call*. Returns True if it changed.
+    *timestamp* is sent over WAMP, so an ISO string as get_msgs_to_locate returns it.
+    """
+    coords, source, final = None, None, None
+    if image_path:
+        path = os.path.join(os.environ.get('AT_MEDIA_ROOT', ''), image_path)
+        # Don't block the loop with file access
+        coords = await asyncio.get_event_loop().run_in_executor(None, exif_coords, path)
+        source = 'exif'
+    if not coords and timestamp:
+        try:
+            # Will return None if not able to find coords
+            guess = await call('at.location.guess_coords_by_user_id', user_id, timestamp, with_point_after=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # Not only ApplicationError, e.g. a lost transport shouldn't abort a whole batch
+            logger.exception("Could not guess coordinates of message id=%s", msg_id)
+            return False
+        if guess:
+            coords, source, final = guess['coordinates'], 'interpolated', guess['point_after']
+    if not coords:
+        return False
+    return await db.set_msg_location(msg_id, coords[0], coords[1], source, final=final, existingconn=existingconn)
+
 
 class MessagesComponent(BackendAppSession):
 
@@ -16,28 +72,51 @@ class MessagesComponent(BackendAppSession):
         db = await Db.create()
         self.db = db
 
+        # {<n>: <messages>}, the frontpage asks for the same thing on every view
+        self.uniquemsgs_cache = TTLCache(UNIQUEMSGS_TTL)
+        # Incremented on every new message, see adventure_msgs
+        self.uniquemsgs_generation = 0
+
         async def uniquemsgs(n=5):
-            return await db.uniquemsgs(n=n)
-
-        async def add_location(msgs):
-            for msg in msgs:
-                # Only add if not present yet
-                if not msg.get('location'):
-                    user_id = msg['user_id']
-                    timestamp = msg['timestamp']
-                    # Will return None if not able to find coords
-                    coords = await self.call('at.location.guess_coords_by_user_id', user_id, timestamp)
-                    if coords:
-                        msg['coordinates'] = coords
+            try:
+                return self.uniquemsgs_cache[n]
+            except KeyError:
+                pass
+            generation = self.uniquemsgs_generation
+            msgs = await db.uniquemsgs(n=n)
+            # Don't store if invalidated while querying
+            if generation == self.uniquemsgs_generation:
+                self.uniquemsgs_cache[n] = msgs
             return msgs
 
-        async def get_msgs_by_user_id_hash(user_id_hash):
+        async def get_msgs_by_user_id_hash(user_id_hash, limit=None, before=None):
+            """
+            All messages of user, newest first. If *limit* or *before* is given, returns one page as
+            {'messages': [...], 'next': <cursor>}, pass cursor as *before* to get the next page.
+            Pages are at most MAX_PAGE_SIZE messages.
+            """
             user_id = await self.call('at.users.get_user_id_by_hash', user_id_hash)
-            msgs = await db.getmsgs(user_id, exclude_sensitive=True)
-            return await add_location(msgs)
+            if limit is None and before is None:
+                return await db.getmsgs(user_id, exclude_sensitive=True)
+            limit = min(int(MAX_PAGE_SIZE if limit is None else limit), MAX_PAGE_SIZE)
+            # One extra to know if there's a next page
+            msgs = await db.getmsgs(user_id, exclude_sensitive=True, limit=limit + 1, before=before)
+            return msgs_page(msgs, limit)
+
+        # {(<adventure url hash>, <limit>, <cursor>): ({<user id>: <generation>}, <messages>)}
+        self.adventure_msgs = TTLCache(ADVENTURE_MSGS_TTL, maxsize=1000)
+        # {<user id>: <generation>}, incremented on new messages of user. Cached messages are only used
+        # if the generations of all users are still those from before they were queried.
+        self.user_generations = {}
 
-        async def get_msgs_by_adventure_hash(adventure_url_hash):
-            out = []
+        def invalidate_adventure_msgs(user_id):
+            self.user_generations[user_id] = self.user_generations.get(user_id, 0) + 1
+            # Might be one of the latest messages as well
+            self.uniquemsgs_generation += 1
+            self.uniquemsgs_cache.invalidate()
+
+        async def get_adventure_users(adventure_url_hash):
+            "Returns adventure id, user ids and start and end of adventure"
             # Get adventure ID first
             adv = await self.call('at.adventures.get_adventure_by_hash', adventure_url_hash)
             if not adv:
@@ -46,23 +125,81 @@ class MessagesComponent(BackendAppSession):
             # Now get all links with users
             links = await self.call('at.adventures.get_adventure_links_by_adv_id', adv_id)
             logger.debug("Found %s links for adventure id=%s name=%s", len(links), adv_id, adv['name'])
-            # Get all user content from start of adventure to end
-            for link in links:
-                user_id = link['user_id']
-                role = link['role']
-                # Make sure to set values if the value of adv['start'] is None
-                start = adv.get('start') or datetime.datetime.min
-                end = adv.get('stop') or datetime.datetime.max
-                msgs = await db.getmsgs(user_id, start=start, end=end, exclude_sensitive=True)
-                logger.debug("Found %s messages for user id=%s in adventure id=%s start=%s end=%s", len(msgs), user_id, adv_id, start, end)
-                out.extend(msgs)
-            return await add_location(out)
+            user_ids = {link['user_id'] for link in links}
+            # Make sure to set values if the value of adv['start'] is None
+            start = adv.get('start') or datetime.datetime.min
+            end = adv.get('stop') or datetime.datetime.max
+            return adv_id, user_ids, start, end
+
+        async def get_msgs_by_adventure_hash(adventure_url_hash, limit=None, before=None):
+            """
+            Messages of all users in adventure, newest first when paginated with *limit* and *before*
+            like get_msgs_by_user_id_hash.
+            """
+            if limit is not None:
+                limit = min(int(limit), MAX_PAGE_SIZE)
+            key = (adventure_url_hash, limit, tuple(before) if before else None)
+            try:
+                generations, out = self.adventure_msgs[key]
+                if all(self.user_generations.get(u, 0) == g for u, g in generations.items()):
+                    return out
+            except KeyError:
+                pass
+            adv_id, user_ids, start, end = await get_adventure_users(adventure_url_hash)
+            # Before querying, so messages published meanwhile make this result stale
+            generations = {u: self.user_generations.get(u, 0) for u in user_ids}
+            # Get all user content from start of adventure to end, in one query
+            msgs = await db.getmsgs_by_user_ids(user_ids, start=start, end=end, exclude_sensitive=True,
+                                                limit=limit + 1 if limit is not None else None, before=before)
+            logger.debug("Found %s messages for adventure id=%s start=%s end=%s", len(msgs), adv_id, start, end)
+            out = msgs if limit is None else msgs_page(msgs, limit)
+            self.adventure_msgs[key] = (generations, out)
+            return out
+
+        async def search_msgs(adventure_url_hash, query, limit=20, cursor=None):
+            """
+            Messages in adventure matching *query*, best match first. Every message has a *snippet* of html
+            with matches in <mark>. Returns {'messages': [...], 'next': <cursor for next page or None>}
+            """
+            limit = min(int(limit), MAX_PAGE_SIZE)
+            query = (query or '').strip()
+            if not query:
+                return msgs_page([], limit)
+            adv_id, user_ids, start, end = await get_adventure_users(adventure_url_hash)
+            msgs = await db.search(user_ids, query, start=start, end=end, limit=limit + 1, before=cursor)
+            logger.debug("Found %s messages matching %r in adventure id=%s", len(msgs), query, adv_id)
+            return msgs_page(msgs, limit, cursor_fields=('rank', 'id'))
+
+        # Channel routing, looked up for every published update
+        self.user_hashes = TTLCache(USER_HASH_TTL)
+        self.active_adventures = TTLCache(ACTIVE_ADVENTURES_TTL)
+
+        async def get_user_hash(user_id):
+            try:
+                return self.user_hashes[user_id]
+            except KeyError:
+                pass
+            user_id_hash = await self.call('at.users.get_user_hash_by_id', user_id)
+            self.user_hashes[user_id] = user_id_hash
+            return user_id_hash
+
+        async def get_active_adventures(user_id):
+            try:
+                return self.active_adventures[user_id]
+            except KeyError:
+                pass
+            now = datetime.datetime.utcnow().isoformat()
+            # Only get adventures that are currently active
+            advs = await self.call('at.adventures.get_adventures_by_user_id', user_id, active_at=now) or []
+            self.active_adventures[user_id] = advs
+            return advs
 
         async def pub_msg_update(msg_id):
             msg = await db.getmsg(msg_id, exclude_sensitive=True)
+            invalidate_adventure_msgs(msg['user_id'])
             # First emit on user channel
             try:
-                user_id_hash = await self.call('at.users.get_user_hash_by_id', msg['user_id'])
+                user_id_hash = await get_user_hash(msg['user_id'])
                 # Emit event on channel at.messages.user.<id_hash>
                 userchannel = 'at.public.messages.user.{}'.format(user_id_hash)
                 # For some reason this method is synchronous
@@ -72,21 +209,42 @@ class MessagesComponent(BackendAppSession):
                 logger.exception("Failed to retrieve user hash or publish update")
             # Now emit on adventure channel(s)
             try:
-                now = datetime.datetime.utcnow().isoformat()
-                # Only get adventures that are currently active
-                advs = await self.call('at.adventures.get_adventures_by_user_id', msg['user_id'], active_at=now)
-                if advs:
-                    for adv in advs:
-                        adv_channel = 'at.public.messages.adventure.{}'.format(adv['url_hash'])
-                        self.publish(adv_channel, msg)
-                        logger.debug("Published message id=%s on channel %s for user_id %s", msg_id, adv_channel, msg['user_id'])
+                for adv in await get_active_adventures(msg['user_id']):
+                    adv_channel = 'at.public.messages.adventure.{}'.format(adv['url_hash'])
+                    self.publish(adv_channel, msg)
+                    logger.debug("Published message id=%s on channel %s for user_id %s", msg_id, adv_channel, msg['user_id'])
             except ApplicationError:
                 logger.exception("Failed to retrieve adventures or publish update")
 
+        # {<msg id>: (<asyncio.TimerHandle>, <loop time of first update>)}
+        self.pending_updates = {}
+
+        def schedule_msg_update(msg_id):
+            "Coalesce updates of the same message into one pub_msg_update"
+            loop = asyncio.get_event_loop()
+            handle, first = self.pending_updates.pop(msg_id, (None, loop.time()))
+            if handle:
+                handle.cancel()
+            delay = min(PUBLISH_DEBOUNCE, max(0, first + PUBLISH_MAX_DELAY - loop.time()))
+            handle = loop.call_later(delay, publish_pending_update, msg_id)
+            self.pending_updates[msg_id] = (handle, first)
+
+        def publish_pending_update(msg_id):
+            self.pending_updates.pop(msg_id, None)
+            asyncio.ensure_future(publish_logged(msg_id))
+
+        async def publish_logged(msg_id):
+            # Nobody awaits this, so log errors here
+            try:
+                await pub_msg_update(msg_id)
+            except Exception:
+                logger.exception("Failed publishing update of message id=%s", msg_id)
 
         async def insertmsg(msg):
             logger.debug("Inserting message...")
             msg_id = await db.insertmsg(msg)
+            # Also keeps a uniquemsgs call that is querying meanwhile from storing its result
+            invalidate_adventure_msgs(msg['user_id'])
             # Extract media and send all necessary info to transcode service
             nomedia = True
             media = []
@@ -105,20 +263,95 @@ class MessagesComponent(BackendAppSession):
                 await self.db.insertmedia(dict(m, original=True))
                 await self.call('at.transcode.transcode', m)
             # Update only if message has no media, otherwise wait for media to be transcoded
-            if nomedia:
+            if msg.get('coordinates'):
+                if nomedia:
+                    await pub_msg_update(msg_id)
+            else:
+                # Locate first so the update includes it, but don't let the sender wait for that
+                asyncio.ensure_future(locate_and_publish(msg_id, msg, publish=nomedia))
+
+        async def locate_and_publish(msg_id, msg, publish):
+            try:
+                await locate_msg(db, self.call, msg_id, msg['user_id'], msg.get('timestamp'), msg.get('image_original'))
+            except Exception:
+                logger.exception("Could not locate message id=%s", msg_id)
+            if publish:
                 await pub_msg_update(msg_id)
 
+        # {<user id>: (<asyncio.TimerHandle>, <loop time of first event>, <start>, <end>)}
+        self.pending_locates = {}
+
+        def points_inserted(evt):
+            "New GPS points might give messages around that time a (better) location, coalesced per user"
+            loop = asyncio.get_event_loop()
+            user_id = evt['user_id']
+            start, end = convert_to_datetime(evt['start']), convert_to_datetime(evt['end'])
+            handle, first, pending_start, pending_end = self.pending_locates.pop(
+                user_id, (None, loop.time(), start, end))
+            if handle:
+                handle.cancel()
+            start, end = min(start, pending_start), max(end, pending_end)
+            delay = min(LOCATE_DEBOUNCE, max(0, first + LOCATE_MAX_DELAY - loop.time()))
+            handle = loop.call_later(delay, locate_pending, user_id)
+            self.pending_locates[user_id] = (handle, first, start, end)
+
+        def locate_pending(user_id):
+            _, _, start, end = self.pending_locates.pop(user_id)
+            asyncio.ensure_future(locate_logged(user_id, start, end))
+
+        async def locate_logged(user_id, start, end):
+            # Nobody awaits this, so log errors here
+            try:
+                await locate_msgs_around(user_id, start, end)
+            except Exception:
+                logger.exception("Failed locating messages of user id=%s", user_id)
+
+        async def locate_msgs_around(user_id, start, end):
+            # Only those without a location, or interpolated without a point after them yet
+            msgs = await db.get_msgs_to_locate(user_id=user_id, start=start - LOCATE_WINDOW, end=end + LOCATE_WINDOW,
+                                               include_interpolated=True)
+            # EXIF has been tried on insert already
+            located = [m['id'] for m in msgs if await locate_msg(db, self.call, m['id'], m['user_id'], m['timestamp'])]
+            if located:
+                logger.debug("Located %s messages of user id=%s", len(located), user_id)
+                # Live clients should see them move
+                for msg_id in located:
+                    schedule_msg_update(msg_id)
+
+        async def getmsg_full(msg_id):
+            "Message including telegram message and transcoder logs, for admin use only"
+            return await db.getmsg(msg_id, exclude_sensitive=False)
+
+        async def backfill_locations(batch_size=500):
+            "One-shot for existing messages without location. Returns number of messages tried and located."
+            tried, located, after_id = 0, 0, 0
+            while True:
+                msgs = await db.get_msgs_to_locate(after_id=after_id, limit=batch_size)
+                if not msgs:
+                    break
+                for m in msgs:
+                    tried += 1
+                    located += await locate_msg(db, self.call, m['id'], m['user_id'], m['timestamp'], m['image_path'])
+                after_id = msgs[-1]['id']
+                logger.info("Backfilling locations, located %s of %s messages so far", located, tried)
+            self.adventure_msgs.invalidate()
+            return {'tried': tried, 'located': located}
+
         async def insertmedia(media):
             await db.insertmedia(media)
             # Update not when explicitly indicated in mediaconfig
             if media.get('update', True):
-                await pub_msg_update(media['msg_id'])
+                schedule_msg_update(media['msg_id'])
 
         self.register(uniquemsgs, 'at.messages.uniquemsgs')
         self.register(get_msgs_by_user_id_hash, 'at.public.messages.fetchmsgs')
         self.register(get_msgs_by_adventure_hash, 'at.public.messages.get_msgs_by_adventure_hash')
+        self.register(search_msgs, 'at.public.messages.search')
         self.register(insertmsg, 'at.messages.insertmsg')
+        self.register(backfill_locations, 'at.messages.backfill_locations')
+        self.register(getmsg_full, 'at.messages.getmsg_full')
         self.subscribe(insertmedia, 'at.transcode.finished')
+        self.subscribe(points_inserted, 'at.location.points_inserted')
 
 
 if __name__=="__main__":
@@ -42,6 +42,10 @@ JSON_SCHEMA_LOCATION_GPS_POINT = {
             "description": "Course over ground in degrees 0-360",
             "type": "number"
         },
+        "ground_m_msl": {
+            "description": "Terrain elevation at this location, from DEM",
+            "type": "number"
+        },
         "source": {
             "description": "Data source, e.g. mobile, spot",
             "type": "string",
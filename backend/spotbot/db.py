@@ -46,6 +46,15 @@ CREATE TABLE spotbot_msgs
 
 CREATE INDEX spotbot_msgs_user_id ON spotbot_msgs(user_id);
 CREATE INDEX spotbot_msgs_spot_msg_id ON spotbot_msgs(spot_msg_id);
+-- Every message only once, also used for finding new messages
+CREATE UNIQUE INDEX spotbot_msgs_user_id_spot_msg_id ON spotbot_msgs(user_id, spot_msg_id);
+'''
+
+SQL_MIGRATE_TABLE_SPOTBOT_LINK = '''
+-- Remove duplicate messages before adding unique index
+DELETE FROM spotbot_msgs a USING spotbot_msgs b
+  WHERE a.user_id = b.user_id AND a.spot_msg_id = b.spot_msg_id AND a.id > b.id;
+CREATE UNIQUE INDEX IF NOT EXISTS spotbot_msgs_user_id_spot_msg_id ON spotbot_msgs(user_id, spot_msg_id);
 '''
 
 
@@ -60,6 +69,9 @@ class Db():
     async def create_tables(self):
         return await self.conn.execute(SQL_CREATE_TABLE_SPOTBOT_LINK)
 
+    async def migrate_tables(self):
+        return await self.conn.execute(SQL_MIGRATE_TABLE_SPOTBOT_LINK)
+
     async def create_link(self, linkdict):
         created = datetime.datetime.utcnow()
         # Init to long time ago, so we can just compare and forget about the None checks
@@ -97,6 +109,44 @@ class Db():
                                       msg['spot_msg_battery_state'])
         return id
 
+    async def insert_new_msgs(self, msgs):
+        """
+        Insert the messages that we don't have yet, in two round trips.
+        Returns list of the messages that were inserted.
+        """
+        if not msgs:
+            return []
+        existing = await self.conn.fetch('''
+        SELECT user_id, spot_msg_id FROM spotbot_msgs WHERE user_id = ANY($1) AND spot_msg_id = ANY($2);
+        ''', list({m['user_id'] for m in msgs}), list({m['spot_msg_id'] for m in msgs}))
+        seen = {(r['user_id'], r['spot_msg_id']) for r in existing}
+        new = []
+        for msg in msgs:
+            key = (msg['user_id'], msg['spot_msg_id'])
+            # Also skip duplicates within this batch
+            if key not in seen:
+                seen.add(key)
+                new.append(msg)
+        if not new:
+            return []
+        now = datetime.datetime.utcnow()
+        rows = [(m['timestamp'], m['user_id'], m['spot_msg_id'], json.dumps(m['spot_msg']), m['spot_msg_type'],
+                 m['spot_msg_latitude'], m['spot_msg_longitude'], m['spot_msg_altitude'], m['spot_msg_battery_state'])
+                for m in new]
+        # One array per column for unnest
+        columns = [list(col) for col in zip(*rows)]
+        # Another poll of the same feed could have inserted some in the meantime, only return those we inserted
+        recs = await self.conn.fetch('''
+        INSERT INTO spotbot_msgs (created, timestamp, user_id, spot_msg_id, spot_msg,
+        spot_msg_type, spot_msg_latitude, spot_msg_longitude, spot_msg_altitude, spot_msg_battery_state)
+        SELECT $1, m.* FROM unnest($2::TIMESTAMP[], $3::INTEGER[], $4::INTEGER[], $5::TEXT[]::JSONB[],
+          $6::VARCHAR[], $7::FLOAT[], $8::FLOAT[], $9::FLOAT[], $10::VARCHAR[]) AS m
+        ON CONFLICT (user_id, spot_msg_id) DO NOTHING
+        RETURNING user_id, spot_msg_id;
+        ''', now, *columns)
+        inserted = {(r['user_id'], r['spot_msg_id']) for r in recs}
+        return [m for m in new if (m['user_id'], m['spot_msg_id']) in inserted]
+
     async def spot_msg_id_exists(self, user_id, spot_msg_id):
         "Returns true if msg id exists, false otherwise"
         # spot_msg_id is probably globally unique, but query for user_id too just in case
@@ -107,6 +157,16 @@ class Db():
         if id: return True
         else: return False
 
+    async def get_recent_msg_timestamps(self, n=10):
+        "Timestamps of the last *n* messages of every user, {<user_id>: [<datetime>, ...]}"
+        recs = await self.conn.fetch('''
+        SELECT user_id, array_agg(timestamp ORDER BY timestamp) AS timestamps FROM
+          (SELECT user_id, timestamp, row_number() OVER (PARTITION BY user_id ORDER BY timestamp DESC) AS rn
+           FROM spotbot_msgs) AS m
+        WHERE m.rn <= $1 GROUP BY user_id;
+        ''', n)
+        return {r['user_id']: r['timestamps'] for r in recs}
+
     async def get_spot_msgs_by_user_id(self, user_id, limit=50):
         recs = await self.conn.fetch('''
         SELECT * FROM spotbot_msgs WHERE user_id = $1 ORDER BY timestamp DESC LIMIT $2;
@@ -119,6 +179,8 @@ if __name__=="__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument('--create', action='store_true',
                         help="Create db tables and indexes")
+    parser.add_argument('--migrate', action='store_true',
+                        help="Add indexes that are missing in existing tables")
     parser.add_argument('--test', action='store_true',
                         help="Test db")
     args = parser.parse_args()
@@ -128,6 +190,11 @@ if __name__=="__main__":
         db = l.run_until_complete(Db.create())
         l.run_until_complete(db.create_tables())
 
+    if args.migrate:
+        l = asyncio.get_event_loop()
+        db = l.run_until_complete(Db.create())
+        l.run_until_complete(db.migrate_tables())
+
     if args.test:
         # Pass only system name, ignore other args
         unittest.main(verbosity=1, argv=sys.argv[:1])
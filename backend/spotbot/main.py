@@ -1,13 +1,31 @@
+import os
 import asyncio
 import aiohttp
 import datetime
 
-from ..utils import BackendAppSession, getLogger
+from autobahn.wamp.exception import ApplicationError
+
+from ..utils import BackendAppSession, getLogger, TTLCache
 from .db import Db
+from .scheduler import FeedScheduler, RateLimiter, FeedState
 
 logger = getLogger('spotbot.main')
 
-SPOT_API_URL = "https://api.findmespot.com/spot-main-web/consumer/rest-api/2.0/public/feed/{feed_id}/message.json"
+# Can point to a local stand-in for testing, see tools/spot_api_standin.py
+SPOT_API_URL = os.environ.get(
+    'AT_SPOT_API_URL',
+    "https://api.findmespot.com/spot-main-web/consumer/rest-api/2.0/public/feed/{feed_id}/message.json")
+
+# Used for feeds that we know nothing about yet, adapted per feed after polling
+FEED_INTERVAL = 3 * 60
+# ...and to leave at least 2 seconds between any two calls
+SPOT_API_RATE = float(os.environ.get('AT_SPOT_API_RATE', 0.5))
+# Number of feeds that can be requested and processed at the same time
+FEED_CONCURRENCY = int(os.environ.get('AT_SPOT_FEED_CONCURRENCY', 8))
+# How often to check the db for new or removed links
+LINKS_REFRESH_INTERVAL = 60
+# How long to remember whether a user is in an active adventure
+ACTIVE_ADVENTURE_TTL = 5 * 60
 
 
 async def parse_spot_msg(spot_msg, user_id):
@@ -28,27 +46,125 @@ async def parse_spot_msg(spot_msg, user_id):
     return msg
 
 
-async def get_spot_api_msgs(feed_id):
+class SpotApiError(Exception):
+    def __init__(self, status):
+        Exception.__init__(self, "SPOT API returned status code {}".format(status))
+        self.status = status
+
+
+async def get_spot_api_msgs(session, feed_id, start_date=None):
+    """
+    Use a shared aiohttp.ClientSession to reuse connections.
+    Pass *start_date* to only get messages from that UTC datetime onwards.
+    Raises SpotApiError on rate limits (403) and other errors.
+    """
     url = SPOT_API_URL.format(feed_id=feed_id)
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url) as resp:
-            if resp.status == 403:
-                logger.exception("Shit, we hit SPOT API's rate limits!")
-            elif resp.status != 200:
-                logger.exception("Problem other than rate limits, status code %s", resp.status)
-            else:
-                feed = await resp.json()
-                logger.debug(feed)
+    params = {}
+    if start_date:
+        params['startDate'] = start_date.strftime('%Y-%m-%dT%H:%M:%S-0000')
+    async with session.get(url, params=params) as resp:
+        if resp.status == 403:
+            logger.error("Shit, we hit SPOT API's rate limits!")
+            raise SpotApiError(resp.status)
+        elif resp.status != 200:
+            logger.error("Problem other than rate limits, status code %s", resp.status)
+            raise SpotApiError(resp.status)
+        feed = await resp.json()
+        logger.debug(feed)
+        try:
+            # No messages to display
+            if feed['response']['errors']['error']['code'] == 'E-0195':
+                logger.debug("No messages for feed %s", feed_id)
+                return []
+        except KeyError:
+            pass
+        msgs = feed['response']['feedMessageResponse']['messages']['message']
+        # Single message is not wrapped in a list
+        if isinstance(msgs, dict):
+            msgs = [msgs]
+        return msgs
+
+
+class SpotPoller():
+    """
+    Polls a feed, stores new messages and forwards their location.
+    *call* is used for RPCs, usually the WAMP session's *call*.
+    """
+    def __init__(self, db, http, call, recent_timestamps=None):
+        self.db = db
+        # Shared aiohttp.ClientSession
+        self.http = http
+        self.call = call
+        # {<user_id>: [<datetime>, ...]} of messages we already know of
+        self.recent_timestamps = recent_timestamps or {}
+        # {<link id>: FeedState}
+        self.feed_states = {}
+        # {<user id>: <True if in active adventure>}
+        self.active_users = TTLCache(ACTIVE_ADVENTURE_TTL)
+
+    async def is_active(self, user_id):
+        try:
+            return self.active_users[user_id]
+        except KeyError:
+            pass
+        try:
+            advs = await self.call('at.adventures.get_adventures_by_user_id', user_id,
+                                   active_at=datetime.datetime.utcnow().isoformat())
+        except ApplicationError:
+            logger.exception("Could not retrieve adventures for user id %s", user_id)
+            return False
+        self.active_users[user_id] = bool(advs)
+        return bool(advs)
+
+    async def poll_feed(self, link):
+        "Returns seconds until this feed should be polled again"
+        state = self.feed_states.get(link['id'])
+        if not state:
+            state = self.feed_states[link['id']] = FeedState(self.recent_timestamps.get(link['user_id'], []))
+        # Only ask for messages newer than the last one we've seen
+        start_date = state.last_msg + datetime.timedelta(seconds=1) if state.last_msg else None
+        logger.debug("Checking feed %s for user_id %s from %s", link['feed_id'], link['user_id'], start_date)
+        try:
+            # Don't let a hanging request block a worker forever
+            spot_msgs = await asyncio.wait_for(
+                get_spot_api_msgs(self.http, link['feed_id'], start_date=start_date), 30)
+            state.failures = 0
+        except (SpotApiError, aiohttp.ClientError, asyncio.TimeoutError):
+            state.failures += 1
+            interval = state.next_interval()
+            logger.warning("Failed polling feed %s %s times in a row, backing off for %.0fs",
+                           link['feed_id'], state.failures, interval, exc_info=True)
+            return interval
+        finally:
+            await self.db.update_link_last_queried(link['id'])
+        if spot_msgs:
+            # Parse message content so it's easier to handle
+            msgs = [await parse_spot_msg(spot_msg, link['user_id']) for spot_msg in spot_msgs]
+            state.add_msg_timestamps([msg['timestamp'] for msg in msgs])
+            # Insert the ones we don't have yet into our own db
+            new_msgs = await self.db.insert_new_msgs(msgs)
+            if new_msgs:
+                # Any message has location, so we send them all to location service
+                trackpts = [{
+                    "source": 'spot',
+                    "user_id": link['user_id'],
+                    "timestamp": msg['timestamp'].isoformat(),
+                    "ptz": {
+                        # Lat/lon in decimal notation
+                        "longitude": msg['spot_msg_longitude'],
+                        "latitude": msg['spot_msg_latitude'],
+                        # Altitude in meters above MSL (not geoid), 0 if not acquired
+                        "height_m_msl": msg['spot_msg_altitude'] or 0
+                    }
+                } for msg in new_msgs]
                 try:
-                    # No messages to display
-                    if feed['response']['errors']['error']['code'] == 'E-0195':
-                        logger.debug("No messages for feed %s", feed_id)
-                        return []
-                except KeyError:
-                    pass
-                msgs = feed['response']['feedMessageResponse']['messages']['message']
-                return msgs
-
+                    await self.call('at.location.insert_gps_points', trackpts)
+                except ApplicationError:
+                    logger.exception("Could not send %s points to location service", len(trackpts))
+                # TODO: Handle CUSTOM or OK messages
+            logger.debug("Retrieved %s messages from feed %s, of which %s are new",
+                         len(spot_msgs), link['feed_id'], len(new_msgs))
+        return state.next_interval(active=await self.is_active(link['user_id']))
 
 
 class SpotBotComponent(BackendAppSession):
@@ -64,51 +180,42 @@ class SpotBotComponent(BackendAppSession):
         db = await Db.create()
 
         async def get_spot_msgs_by_user_id(user_id):
-            return db.get_spot_msgs_by_user_id(user_id)
+            return await db.get_spot_msgs_by_user_id(user_id)
 
         self.register(get_spot_msgs_by_user_id, 'at.spotbot.get_spot_msgs_by_user_id')
 
-        while True:
-            # Find feed that needs to be queried
-            # Get raw records, they have datetime as datetime
-            links = await db.get_all_links(raw=True)
-            for link in links:
-                # Allow at least 2.5 minutes between calls of the same feed
-                if (link['last_queried'] + datetime.timedelta(minutes=3)
-                    < datetime.datetime.utcnow()):
-                    logger.debug("Checking feed %s for user_id %s", link['feed_id'], link['user_id'])
-                    spot_msgs = await get_spot_api_msgs(link['feed_id'])
-                    await db.update_link_last_queried(link['id'])
-                    if spot_msgs:
-                        newcount = 0
-                        for spot_msg in spot_msgs:
-                            # Parse message content so it's easier to handle
-                            msg = await parse_spot_msg(spot_msg, link['user_id'])
-                            # Find out if message is new
-                            msg_exists = await db.spot_msg_id_exists(link['user_id'], msg['spot_msg_id'])
-                            if not msg_exists:
-                                newcount += 1
-                                # Insert into our own db
-                                await db.insert_msg(msg)
-                                # Any message has location, so we send them all to location service
-                                trackpt = {
-                                    "source": 'spot',
-                                    "user_id": link['user_id'],
-                                    "timestamp": msg['timestamp'].isoformat(),
-                                    "ptz": {
-                                        # Lat/lon in decimal notation
-                                        "longitude": msg['spot_msg_longitude'],
-                                        "latitude": msg['spot_msg_latitude'],
-                                        # Altitude in meters above MSL (not geoid), no decimals
-                                        "height_m_msl": msg['spot_msg_altitude']
-                                    }
-                                }
-                                await self.call('at.location.insert_gps_point', trackpt)
-                                # TODO: Handle CUSTOM or OK messages
-                        logger.debug("Retrieved %s messages from feed %s, of which %s are new",
-                                     len(spot_msgs), link['feed_id'], newcount)
-            # Sleep for at least 2 seconds to avoid hitting rate limits
-            await asyncio.sleep(2.5)
+        # One connection pool for all feeds
+        self.http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=FEED_CONCURRENCY))
+
+        poller = SpotPoller(db, self.http, self.call, await db.get_recent_msg_timestamps())
+
+        self.scheduler = FeedScheduler(poller.poll_feed, interval=FEED_INTERVAL, concurrency=FEED_CONCURRENCY,
+                                       rate_limiter=RateLimiter(SPOT_API_RATE))
+
+        async def get_feed_staleness():
+            "Seconds since every feed was last queried, {<feed_id>: <seconds>}"
+            return self.scheduler.staleness()
+
+        self.register(get_feed_staleness, 'at.spotbot.get_feed_staleness')
+
+        async def refresh_links():
+            while True:
+                # Get raw records, they have datetime as datetime
+                links = await db.get_all_links(raw=True)
+                self.scheduler.update_links([dict(l) for l in links])
+                staleness = [s for s in self.scheduler.staleness().values() if s is not None]
+                if staleness:
+                    logger.info("Scheduling %s feeds, max staleness %.0fs",
+                                len(staleness), max(staleness))
+                await asyncio.sleep(LINKS_REFRESH_INTERVAL)
+
+        asyncio.ensure_future(refresh_links())
+        await self.scheduler.run()
+
+    async def cleanup(self, loop):
+        # Prevent AttributeError if not joined
+        if getattr(self, 'http', None):
+            await self.http.close()
 
 
 if __name__=="__main__":
@@ -0,0 +1,300 @@
+import sys
+import heapq
+import random
+import asyncio
+import logging
+import datetime
+import unittest
+from itertools import count
+from collections import deque
+
+logger = logging.getLogger('spotbot.scheduler')
+
+# SPOT asks not to query a feed more than once every 2.5 minutes
+MIN_INTERVAL = 150
+# Check feeds that have been quiet for a long time about once an hour
+MAX_INTERVAL = 3600
+# Consider a feed moving if it sent something within this many cadences
+MOVING_CADENCES = 3
+# Assume this cadence if we don't know any better, SPOT tracks every 5-10 minutes
+DEFAULT_CADENCE = 10 * 60
+
+
+class FeedState():
+    "What we know about a feed, to decide when to poll it next"
+    def __init__(self, msg_timestamps=()):
+        # Most recent message timestamps, oldest first
+        self.msg_timestamps = deque(sorted(msg_timestamps), maxlen=10)
+        # Consecutive failed polls
+        self.failures = 0
+
+    @property
+    def last_msg(self):
+        return self.msg_timestamps[-1] if self.msg_timestamps else None
+
+    def add_msg_timestamps(self, timestamps):
+        last = self.last_msg
+        for t in sorted(timestamps):
+            if last is None or t > last:
+                self.msg_timestamps.append(t)
+                last = t
+
+    def cadence(self):
+        "Median seconds between messages"
+        ts = self.msg_timestamps
+        gaps = sorted((b - a).total_seconds() for a, b in zip(ts, list(ts)[1:]))
+        if not gaps:
+            return DEFAULT_CADENCE
+        return max(gaps[len(gaps) // 2], 1)
+
+    def next_interval(self, active=False, now=None):
+        """
+        Seconds until next poll. Back off exponentially on errors, poll often when
+        the feed is in an active adventure or moving, less often the longer it's quiet.
+        """
+        if self.failures:
+            return min(MAX_INTERVAL, MIN_INTERVAL * 2 ** self.failures)
+        if active:
+            return MIN_INTERVAL
+        if not self.last_msg:
+            return MAX_INTERVAL
+        now = now or datetime.datetime.utcnow()
+        quiet = (now - self.last_msg).total_seconds()
+        cadence = self.cadence()
+        if quiet < MOVING_CADENCES * cadence:
+            # Try to be there shortly after the next message
+            return min(max(cadence, MIN_INTERVAL), MAX_INTERVAL)
+        # Device might have been switched off, check less as time passes
+        return min(max(quiet / 4, MIN_INTERVAL), MAX_INTERVAL)
+
+
+class RateLimiter():
+    "Token bucket, shared by all workers to stay within the API's rate limits"
+    def __init__(self, rate, burst=1, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        # Tokens per second
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last = self.loop.time()
+
+    async def acquire(self):
+        while True:
+            now = self.loop.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class FeedScheduler():
+    """
+    Polls feeds when they're due. Feeds are kept in a min-heap ordered by next due time,
+    a dispatcher hands due feeds to a fixed pool of workers.
+    *poll_feed* is a coroutine function that gets called with the link dict,
+    and can return the number of seconds until the next poll (or None for *interval*).
+    """
+    def __init__(self, poll_feed, interval=180, concurrency=8, rate_limiter=None, jitter=0.1, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.poll_feed = poll_feed
+        # Seconds between polls of the same feed
+        self.interval = interval
+        self.concurrency = concurrency
+        self.rate_limiter = rate_limiter
+        # Spread polls by this fraction of the interval, so feeds don't stay clumped together
+        self.jitter = jitter
+        # Entries are (<due loop time>, <unique count>, <link id>)
+        self.heap = []
+        self.cnt = count()
+        # {<link id>: <link dict>}
+        self.links = {}
+        # Link ids that are on the heap or being polled
+        self.scheduled = set()
+        # {<link id>: <datetime.datetime utc>}
+        self.last_queried = {}
+        self.queue = asyncio.Queue(maxsize=concurrency)
+        # Set when the heap changes, so the dispatcher can re-check the first due feed
+        self.wake = asyncio.Event()
+
+    def update_links(self, links):
+        "Sync with current links, new ones are scheduled based on their *last_queried*"
+        now = datetime.datetime.utcnow()
+        self.links = {l['id']: l for l in links}
+        for link_id, link in self.links.items():
+            # Prefer our own bookkeeping if we have it
+            last_queried = self.last_queried.setdefault(link_id, link.get('last_queried') or datetime.datetime.min)
+            if link_id in self.scheduled:
+                continue
+            try:
+                since = (now - last_queried).total_seconds()
+            except OverflowError:
+                since = self.interval
+            self.schedule(link_id, max(0, self.interval - since))
+        # Forget about removed links, their heap entries are skipped by the dispatcher
+        for link_id in set(self.last_queried) - set(self.links):
+            del self.last_queried[link_id]
+
+    def schedule(self, link_id, delay):
+        delay *= 1 + random.uniform(-self.jitter, self.jitter)
+        heapq.heappush(self.heap, (self.loop.time() + delay, next(self.cnt), link_id))
+        self.scheduled.add(link_id)
+        self.wake.set()
+
+    async def dispatch(self):
+        "Hand due feeds to workers, blocks when all workers are busy"
+        while True:
+            self.wake.clear()
+            if not self.heap:
+                await self.wake.wait()
+                continue
+            delay = self.heap[0][0] - self.loop.time()
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.wake.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            _, _, link_id = heapq.heappop(self.heap)
+            if link_id not in self.links:
+                self.scheduled.discard(link_id)
+                continue
+            await self.queue.put(link_id)
+
+    async def work(self):
+        while True:
+            link_id = await self.queue.get()
+            link = self.links.get(link_id)
+            delay = None
+            try:
+                if link:
+                    if self.rate_limiter:
+                        await self.rate_limiter.acquire()
+                    delay = await self.poll_feed(link)
+            except Exception:
+                logger.exception("Error polling feed for link %s", link)
+            finally:
+                self.last_queried[link_id] = datetime.datetime.utcnow()
+                self.scheduled.discard(link_id)
+                if link_id in self.links:
+                    self.schedule(link_id, self.interval if delay is None else delay)
+                self.queue.task_done()
+
+    async def run(self):
+        "Run dispatcher and workers forever"
+        workers = [asyncio.ensure_future(self.work()) for _ in range(self.concurrency)]
+        try:
+            await self.dispatch()
+        finally:
+            for w in workers:
+                w.cancel()
+
+    def staleness(self):
+        "Seconds since last poll for every feed, {<feed id>: <seconds>}"
+        now = datetime.datetime.utcnow()
+        out = {}
+        for link_id, link in self.links.items():
+            last_queried = self.last_queried.get(link_id, datetime.datetime.min)
+            try:
+                out[link['feed_id']] = (now - last_queried).total_seconds()
+            except OverflowError:
+                out[link['feed_id']] = None
+        return out
+
+
+class FeedStateTestCase(unittest.TestCase):
+    now = datetime.datetime(2017, 6, 1, 12)
+
+    def ago(self, minutes):
+        return self.now - datetime.timedelta(minutes=minutes)
+
+    def test_moving(self):
+        state = FeedState([self.ago(25), self.ago(15), self.ago(5)])
+        self.assertEqual(state.cadence(), 600)
+        self.assertEqual(state.next_interval(now=self.now), 600)
+        self.assertEqual(state.next_interval(active=True, now=self.now), MIN_INTERVAL)
+
+    def test_quiet(self):
+        state = FeedState([self.ago(60 * 24 * 7)])
+        self.assertEqual(state.next_interval(now=self.now), MAX_INTERVAL)
+        state = FeedState([self.ago(50), self.ago(40)])
+        self.assertEqual(state.next_interval(now=self.now), 40 * 60 / 4)
+        self.assertEqual(FeedState().next_interval(now=self.now), MAX_INTERVAL)
+
+    def test_backoff(self):
+        state = FeedState([self.ago(10), self.ago(5)])
+        state.failures = 1
+        self.assertEqual(state.next_interval(active=True), 2 * MIN_INTERVAL)
+        state.failures = 10
+        self.assertEqual(state.next_interval(), MAX_INTERVAL)
+
+    def test_add_msg_timestamps(self):
+        state = FeedState([self.ago(10)])
+        # Older and duplicate messages are ignored
+        state.add_msg_timestamps([self.ago(20), self.ago(10), self.ago(0)])
+        self.assertEqual(list(state.msg_timestamps), [self.ago(10), self.ago(0)])
+
+
+class FeedSchedulerTestCase(unittest.TestCase):
+    def setUp(self):
+        self.l = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.l)
+
+    def tearDown(self):
+        self.l.close()
+
+    def test_polls_due_feeds_concurrently(self):
+        polled = []
+        active = [0, 0]
+
+        async def poll_feed(link):
+            active[0] += 1
+            active[1] = max(active)
+            polled.append(link['feed_id'])
+            await asyncio.sleep(0.05)
+            active[0] -= 1
+
+        scheduler = FeedScheduler(poll_feed, interval=0.2, concurrency=3, jitter=0)
+        recent = datetime.datetime.utcnow()
+        scheduler.update_links([{'id': i, 'feed_id': 'f{}'.format(i), 'last_queried': datetime.datetime.min}
+                                for i in range(6)] +
+                               [{'id': 6, 'feed_id': 'recent', 'last_queried': recent}])
+        task = asyncio.ensure_future(scheduler.run())
+        self.l.run_until_complete(asyncio.sleep(0.15))
+        # Never-queried feeds are due immediately, and polled three at a time
+        self.assertEqual(sorted(polled), ['f{}'.format(i) for i in range(6)])
+        self.assertEqual(active[1], 3)
+        self.l.run_until_complete(asyncio.sleep(0.2))
+        self.assertIn('recent', polled)
+        self.assertLess(max(scheduler.staleness().values()), 0.4)
+        # Removed links are not polled anymore
+        scheduler.update_links([])
+        n = len(polled)
+        self.l.run_until_complete(asyncio.sleep(0.3))
+        self.assertEqual(len(polled), n)
+        task.cancel()
+        self.l.run_until_complete(asyncio.sleep(0))
+
+    def test_rate_limiter(self):
+        limiter = RateLimiter(rate=50, burst=1)
+
+        async def acquire_many():
+            t = self.l.time()
+            for _ in range(6):
+                await limiter.acquire()
+            return self.l.time() - t
+
+        self.assertGreaterEqual(self.l.run_until_complete(acquire_many()), 0.09)
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--test', action='store_true',
+                        help="Test scheduler with fake feeds")
+    args = parser.parse_args()
+
+    if args.test:
+        # Pass only system name, ignore other args
+        unittest.main(verbosity=1, argv=sys.argv[:1])
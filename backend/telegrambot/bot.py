@@ -156,7 +156,7 @@ def main(wampsess, loop):
                 'ptz': {
                     'longitude': t.location.longitude,
                     'latitude': t.location.latitude,
-                    # Indicate that no height is provided
+                    # Indicate that no height is provided, location service fills in ground elevation
                     'height_m_msl': 0
                 }
             }
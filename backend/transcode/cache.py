@@ -0,0 +1,263 @@
+import os
+import json
+import shutil
+import asyncio
+import hashlib
+import unittest
+import tempfile
+import os.path as osp
+
+from ..utils import getLogger, TTLCache
+from .mediaconfig import config_version
+
+logger = getLogger('transcode.cache')
+
+# Read sources in chunks of this many bytes when hashing
+HASH_CHUNK = 1 << 20
+
+
+def content_hash(path):
+    "sha256 of file content, blocking"
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def conf_version(conf):
+    "Changes when the conf or mediaconfig.config_version changes, so outdated outputs aren't used"
+    conf = json.dumps(conf, sort_keys=True).encode('utf-8')
+    return '{}-{}'.format(config_version, hashlib.sha256(conf).hexdigest()[:8])
+
+
+def link_or_copy(src, dest):
+    "Hard link if on the same filesystem, so cached outputs don't take extra space"
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+def companion_dir(path):
+    "Directory that belongs to output *path*, e.g. segments of an HLS playlist, see transcoder.hls_cmd"
+    return osp.splitext(path)[0]
+
+
+def link_or_copy_tree(src, dest):
+    shutil.copytree(src, dest, copy_function=link_or_copy)
+
+
+def dir_size(path):
+    return sum(osp.getsize(osp.join(dirpath, fn)) for dirpath, _, filenames in os.walk(path) for fn in filenames)
+
+
+def lru_policy(entries, max_bytes):
+    """
+    Default eviction policy: least recently used entries, until the rest fits in *max_bytes*.
+    *entries* are dicts with key, bytes and last_used, return those to evict.
+    """
+    total = sum(e['bytes'] for e in entries)
+    evict = []
+    for e in sorted(entries, key=lambda e: e['last_used']):
+        if total <= max_bytes:
+            break
+        evict.append(e)
+        total -= e['bytes']
+    return evict
+
+
+class TranscodeCache():
+    """
+    Outputs of earlier transcodes, stored by (source content hash, conf name, conf version),
+    so the same file uploaded again is not transcoded again.
+    Every entry is the output file, its companion directory if it has one, and a json file
+    with its transcode result, and is marked as used by touching the json file.
+    *policy* decides what to evict when the cache is larger than *max_bytes*, see lru_policy,
+    *on_evict* is called with every evicted key.
+    """
+    def __init__(self, root, max_bytes=None, policy=lru_policy, on_evict=None, loop=None):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.on_evict = on_evict
+        self.loop = loop or asyncio.get_event_loop()
+        # Hashes of recent sources, {(<path>, <mtime>, <size>): <hash>}
+        self.hashes = TTLCache(3600, maxsize=1000)
+        self.counters = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'hash_seconds': 0.}
+        os.makedirs(root, exist_ok=True)
+
+    def paths(self, key):
+        "Output, result json and companion directory path of key"
+        digest, name, version = key
+        base = osp.join(self.root, digest[:2], '{}-{}-{}'.format(digest, name, version))
+        return base + '.out', base + '.json', base + '.dir'
+
+    async def key(self, src, conf):
+        st = os.stat(src)
+        k = (src, st.st_mtime, st.st_size)
+        try:
+            digest = self.hashes[k]
+        except KeyError:
+            start = self.loop.time()
+            # hashlib releases the GIL, so a thread is fine
+            digest = self.hashes[k] = await self.loop.run_in_executor(None, content_hash, src)
+            self.counters['hash_seconds'] += self.loop.time() - start
+        return digest, conf['name'], conf_version(conf)
+
+    def get(self, key, dest):
+        """
+        Transcode result of key with its output put at *dest*, or None on a miss.
+        Skipped renditions have a result of {'skipped': True}.
+        """
+        out, meta, out_dir = self.paths(key)
+        try:
+            with open(meta) as f:
+                stat = json.load(f)
+            if not stat.get('skipped'):
+                if osp.isdir(out_dir):
+                    link_or_copy_tree(out_dir, companion_dir(dest))
+                link_or_copy(out, dest)
+            # Mark as recently used
+            os.utime(meta)
+        except (OSError, ValueError):
+            self.counters['misses'] += 1
+            return None
+        self.counters['hits'] += 1
+        return stat
+
+    def put(self, key, src, stat):
+        "Store output at *src* with its transcode *stat*, None for a skipped rendition"
+        out, meta, out_dir = self.paths(key)
+        os.makedirs(osp.dirname(out), exist_ok=True)
+        if stat is None:
+            stat = {'skipped': True}
+        else:
+            if osp.isdir(companion_dir(src)):
+                shutil.rmtree(out_dir, ignore_errors=True)
+                link_or_copy_tree(companion_dir(src), out_dir)
+            link_or_copy(src, out + '.tmp')
+            os.replace(out + '.tmp', out)
+        # Json last, so an entry is only used when complete
+        with open(meta + '.tmp', 'w') as f:
+            json.dump(stat, f)
+        os.replace(meta + '.tmp', meta)
+        self.counters['stored'] += 1
+
+    def entries(self):
+        out = []
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            # Don't walk into companion directories
+            dirnames[:] = [d for d in dirnames if not d.endswith('.dir')]
+            for fn in filenames:
+                if not fn.endswith('.json'):
+                    continue
+                meta = osp.join(dirpath, fn)
+                digest, name, version = fn[:-len('.json')].split('-', 2)
+                try:
+                    st = os.stat(meta)
+                except OSError:
+                    continue
+                size = st.st_size
+                out_path, _, out_dir = self.paths((digest, name, version))
+                # Skipped renditions have no output
+                if osp.exists(out_path):
+                    size += osp.getsize(out_path)
+                if osp.isdir(out_dir):
+                    size += dir_size(out_dir)
+                out.append({'key': (digest, name, version), 'bytes': size, 'last_used': st.st_mtime})
+        return out
+
+    def evict(self):
+        "Apply eviction policy, blocking. Returns number of evicted entries."
+        if self.max_bytes is None:
+            return 0
+        evicted = self.policy(self.entries(), self.max_bytes)
+        for e in evicted:
+            out, meta, out_dir = self.paths(e['key'])
+            for path in (meta, out):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            shutil.rmtree(out_dir, ignore_errors=True)
+            if self.on_evict:
+                self.on_evict(e['key'])
+        self.counters['evicted'] += len(evicted)
+        if evicted:
+            logger.info("Evicted %s entries from transcode cache", len(evicted))
+        return len(evicted)
+
+    def metrics(self):
+        lookups = self.counters['hits'] + self.counters['misses']
+        return dict(self.counters, hit_rate=self.counters['hits'] / lookups if lookups else None)
+
+
+class TranscodeCacheTestCase(unittest.TestCase):
+    conf = {'name': '360', 'wh': [640, 360], 'ext': 'mp4'}
+
+    def setUp(self):
+        self.l = asyncio.new_event_loop()
+        self.tmp = tempfile.mkdtemp(prefix='transcode-cache-test-')
+        self.cache = TranscodeCache(osp.join(self.tmp, 'cache'), loop=self.l)
+
+    def tearDown(self):
+        self.l.close()
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, content):
+        path = osp.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    def test_hit_by_content(self):
+        src = self.write('a.mp4', b'video' * 100000)
+        key = self.l.run_until_complete(self.cache.key(src, self.conf))
+        self.assertIsNone(self.cache.get(key, osp.join(self.tmp, 'miss.mp4')))
+        self.cache.put(key, self.write('out.mp4', b'small'), {'width': 640, 'height': 360})
+        # Same content under another name is a hit
+        copy = self.write('b.mp4', b'video' * 100000)
+        key_copy = self.l.run_until_complete(self.cache.key(copy, self.conf))
+        self.assertEqual(key, key_copy)
+        dest = osp.join(self.tmp, 'hit.mp4')
+        self.assertEqual(self.cache.get(key_copy, dest), {'width': 640, 'height': 360})
+        with open(dest, 'rb') as f:
+            self.assertEqual(f.read(), b'small')
+        # Other conf or content is a miss
+        key_other = self.l.run_until_complete(self.cache.key(copy, dict(self.conf, wh=[320, 180])))
+        self.assertIsNone(self.cache.get(key_other, dest + '2'))
+        self.assertEqual(self.cache.metrics()['hit_rate'], 1 / 3)
+        # Skipped renditions are remembered too
+        self.cache.put(key_other, None, None)
+        self.assertEqual(self.cache.get(key_other, dest + '2'), {'skipped': True})
+
+    def test_companion_dir(self):
+        src = self.write('a.mp4', b'video')
+        key = self.l.run_until_complete(self.cache.key(src, self.conf))
+        os.makedirs(osp.join(self.tmp, 'out'))
+        self.write(osp.join('out', 'segment.m4s'), b'segment')
+        self.cache.put(key, self.write('out.m3u8', b'playlist'), {})
+        dest = osp.join(self.tmp, 'hit.m3u8')
+        self.assertEqual(self.cache.get(key, dest), {})
+        with open(osp.join(self.tmp, 'hit', 'segment.m4s'), 'rb') as f:
+            self.assertEqual(f.read(), b'segment')
+        self.assertEqual(self.cache.entries()[0]['bytes'], len('{}playlistsegment'))
+
+    def test_evict_least_recently_used(self):
+        evicted = []
+        self.cache.max_bytes = 2500
+        self.cache.on_evict = evicted.append
+        keys = [('{:064x}'.format(i), '360', 'v') for i in range(3)]
+        for i, key in enumerate(keys):
+            self.cache.put(key, self.write('out{}'.format(i), b'x' * 1000), {})
+            os.utime(self.cache.paths(key)[1], (i, i))
+        # Using the oldest makes it the most recent
+        self.cache.get(keys[0], osp.join(self.tmp, 'used'))
+        self.assertEqual(self.cache.evict(), 1)
+        self.assertEqual(evicted, [keys[1]])
+        self.assertIsNone(self.cache.get(keys[1], osp.join(self.tmp, 'gone')))
+
+
+if __name__=="__main__":
+    unittest.main(verbosity=1)
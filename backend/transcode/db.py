@@ -0,0 +1,291 @@
+import os
+import sys
+import socket
+import asyncio
+import unittest
+
+from ..utils import db_test_case_factory, getLogger, MicroserviceDb
+
+logger = getLogger('transcode.db')
+
+# Postgres' clock, so instances on different hosts agree on when jobs are due
+NOW = "(now() AT TIME ZONE 'UTC')"
+
+SQL_CREATE_TABLE_TRANSCODE_JOBS = '''
+CREATE TABLE transcode_jobs
+(
+  id                SERIAL PRIMARY KEY,
+  -- Name of queue, e.g. 'video' or 'image', see TranscodeComponent
+  queue             VARCHAR(32) NOT NULL,
+  -- Lowest first, renditions of a media are numbered in mediaconfig order
+  priority          SMALLINT NOT NULL,
+  media             JSONB NOT NULL,
+  conf              JSONB NOT NULL,
+  created           TIMESTAMP NOT NULL,
+  -- Job isn't handed out before this time. While it runs this is the visibility timeout,
+  -- after a failure the retry backoff.
+  run_after         TIMESTAMP NOT NULL,
+  attempts          SMALLINT NOT NULL DEFAULT 0,
+  -- Worker that claimed the job, <hostname>-<pid>
+  locked_by         VARCHAR(255),
+  last_error        TEXT,
+  -- Given up after too many attempts, kept for inspection
+  failed            BOOLEAN NOT NULL DEFAULT FALSE
+);
+
+CREATE INDEX transcode_jobs_next ON transcode_jobs (queue, priority, id) WHERE NOT failed;
+'''
+
+# Workers are woken up on new jobs, on any host
+NOTIFY_CHANNEL = 'transcode_jobs'
+
+# Seconds a claimed job is invisible to other workers, extended while it runs
+VISIBILITY_TIMEOUT = 120
+# Retry failed jobs after 30s, 60s, 120s...
+RETRY_BACKOFF = 30
+MAX_RETRY_BACKOFF = 3600
+MAX_ATTEMPTS = 5
+# Check for due jobs even if not notified, e.g. for retries and expired visibility timeouts
+POLL_INTERVAL = 5
+
+
+def worker_name():
+    return '{}-{}'.format(socket.gethostname(), os.getpid())
+
+
+class Db(MicroserviceDb):
+
+    async def create_tables(self):
+        return await self.pool.execute(SQL_CREATE_TABLE_TRANSCODE_JOBS)
+
+    async def add_job(self, queue, priority, media, conf):
+        "Returns job id"
+        return await self.pool.fetchval('''
+        WITH job AS (
+          INSERT INTO transcode_jobs (queue, priority, media, conf, created, run_after)
+          VALUES ($1, $2, $3, $4, {now}, {now}) RETURNING id, queue
+        )
+        SELECT id FROM job, pg_notify('{channel}', job.queue);
+        '''.format(now=NOW, channel=NOTIFY_CHANNEL), queue, priority, media, conf)
+
+    async def claim_job(self, queue, worker, visibility_timeout=VISIBILITY_TIMEOUT):
+        """
+        Take due job with lowest priority from queue, None if there's none.
+        Jobs other workers are claiming at the same time are skipped instead of waited for.
+        *waited* is the number of seconds the job has been due.
+        """
+        rec = await self.pool.fetchrow('''
+        WITH next AS (
+          SELECT id, run_after FROM transcode_jobs
+          WHERE queue = $1 AND NOT failed AND run_after <= {now}
+          ORDER BY priority, id LIMIT 1
+          FOR UPDATE SKIP LOCKED
+        )
+        UPDATE transcode_jobs SET attempts = attempts + 1, locked_by = $2,
+          run_after = {now} + $3 * interval '1 second'
+        FROM next WHERE transcode_jobs.id = next.id
+        RETURNING transcode_jobs.id, priority, media, conf, attempts,
+          extract(epoch FROM {now} - next.run_after)::FLOAT AS waited;
+        '''.format(now=NOW), queue, worker, visibility_timeout)
+        return dict(rec) if rec else None
+
+    async def extend_job(self, job_id, worker, visibility_timeout=VISIBILITY_TIMEOUT):
+        "Keep running job from other workers, False if it's not ours anymore"
+        stat = await self.pool.execute('''
+        UPDATE transcode_jobs SET run_after = {now} + $3 * interval '1 second' WHERE id = $1 AND locked_by = $2;
+        '''.format(now=NOW), job_id, worker, visibility_timeout)
+        return stat == 'UPDATE 1'
+
+    async def finish_job(self, job_id, worker):
+        await self.pool.execute('DELETE FROM transcode_jobs WHERE id = $1 AND locked_by = $2;', job_id, worker)
+
+    async def fail_job(self, job_id, worker, error, backoff=RETRY_BACKOFF, max_backoff=MAX_RETRY_BACKOFF,
+                       max_attempts=MAX_ATTEMPTS):
+        "Retry later with exponential backoff, or give up. Returns True if it will be retried."
+        return await self.pool.fetchval('''
+        UPDATE transcode_jobs SET locked_by = NULL, last_error = $3, failed = attempts >= $6,
+          run_after = {now} + least($4 * 2 ^ (attempts - 1), $5) * interval '1 second'
+        WHERE id = $1 AND locked_by = $2
+        RETURNING NOT failed;
+        '''.format(now=NOW), job_id, worker, error, backoff, max_backoff, max_attempts)
+
+    async def release_job(self, job_id, worker):
+        "Hand back unfinished job on shutdown, doesn't count as an attempt"
+        await self.pool.execute('''
+        UPDATE transcode_jobs SET locked_by = NULL, run_after = {now}, attempts = attempts - 1
+        WHERE id = $1 AND locked_by = $2;
+        '''.format(now=NOW), job_id, worker)
+
+    async def queue_depths(self):
+        "Jobs waiting to be claimed, {<queue>: <count>}"
+        recs = await self.pool.fetch('''
+        SELECT queue, count(*) AS depth FROM transcode_jobs WHERE NOT failed AND locked_by IS NULL GROUP BY queue;
+        ''')
+        return {r['queue']: r['depth'] for r in recs}
+
+    async def listen(self, callback):
+        "Call *callback* with queue name when a job is added, keeps a connection until *unlisten*"
+        self.listen_conn = await self.pool.acquire()
+        await self.listen_conn.add_listener(NOTIFY_CHANNEL, lambda conn, pid, channel, queue: callback(queue))
+
+    async def unlisten(self):
+        if getattr(self, 'listen_conn', None):
+            await self.pool.release(self.listen_conn)
+            self.listen_conn = None
+
+
+class JobQueue():
+    """
+    Queue of one media type in the transcode_jobs table, with the parts of asyncio.PriorityQueue's
+    interface that Transcoder.consume uses. Items are (<priority>, <job id>, <media>, <conf>, <loop time due>).
+    Several transcoders, also in other processes or on other hosts, can consume the same queue.
+    """
+    def __init__(self, db, name, worker=None, loop=None):
+        self.db = db
+        self.name = name
+        self.worker = worker or worker_name()
+        self.loop = loop or asyncio.get_event_loop()
+        # Set when a job is added to this queue, see TranscodeComponent
+        self.wake = asyncio.Event()
+        # {<job id>: <heartbeat future>}
+        self.heartbeats = {}
+        # Updated by TranscodeComponent for metrics
+        self.depth = 0
+
+    def qsize(self):
+        return self.depth
+
+    async def put(self, item):
+        "Same item as for asyncio.PriorityQueue, ordering count and time are set by the db"
+        priority, _, media, conf = item[:4]
+        await self.db.add_job(self.name, priority, media, conf)
+
+    async def get(self):
+        while True:
+            self.wake.clear()
+            job = await self.db.claim_job(self.name, self.worker)
+            if job:
+                break
+            try:
+                await asyncio.wait_for(self.wake.wait(), POLL_INTERVAL)
+            except asyncio.TimeoutError:
+                pass
+        self.heartbeats[job['id']] = asyncio.ensure_future(self.heartbeat(job['id']))
+        return (job['priority'], job['id'], job['media'], job['conf'], self.loop.time() - job['waited'])
+
+    async def heartbeat(self, job_id):
+        while True:
+            await asyncio.sleep(VISIBILITY_TIMEOUT / 3)
+            try:
+                if not await self.db.extend_job(job_id, self.worker):
+                    logger.warning("Lost transcode job %s to another worker, it took too long", job_id)
+                    return
+            except Exception:
+                logger.exception("Could not extend transcode job %s", job_id)
+
+    def stop_heartbeat(self, job_id):
+        hb = self.heartbeats.pop(job_id, None)
+        if hb:
+            hb.cancel()
+
+    async def done(self, item, error=None):
+        "Remove job, or retry it later if there's an *error*"
+        job_id = item[1]
+        self.stop_heartbeat(job_id)
+        if error is None:
+            await self.db.finish_job(job_id, self.worker)
+        elif await self.db.fail_job(job_id, self.worker, error):
+            logger.warning("Transcode job %s failed, will retry", job_id)
+        else:
+            logger.error("Transcode job %s failed too often, giving up", job_id)
+
+    async def release(self, item):
+        job_id = item[1]
+        self.stop_heartbeat(job_id)
+        await self.db.release_job(job_id, self.worker)
+
+
+class TranscodeDbTestCase(db_test_case_factory(Db)):
+    media = {'msg_id': -1, 'type': 'video', 'path': 'video/test.mp4'}
+    conf = {'name': '360', 'wh': [640, 360], 'ext': 'mp4'}
+
+    def setUp(self):
+        super().setUp()
+        self.queue = 'test-{}'.format(os.getpid())
+
+    def test_priority_and_claimed_jobs(self):
+        for priority in (2, 1, 3):
+            self.lru(self.db.add_job(self.queue, priority, self.media, dict(self.conf, p=priority)))
+        job = self.lru(self.db.claim_job(self.queue, 'a'))
+        self.assertEqual(job['priority'], 1)
+        self.assertEqual(job['conf']['p'], 1)
+        self.assertEqual(job['media'], self.media)
+        self.assertEqual(job['attempts'], 1)
+        # Claimed job isn't handed out again until its visibility timeout expires
+        self.assertEqual(self.lru(self.db.claim_job(self.queue, 'b'))['priority'], 2)
+        self.assertEqual(self.lru(self.db.queue_depths())[self.queue], 1)
+        self.lru(self.db.finish_job(job['id'], 'a'))
+        self.assertEqual(self.lru(self.db.claim_job(self.queue, 'a'))['priority'], 3)
+        self.assertIsNone(self.lru(self.db.claim_job(self.queue, 'a')))
+
+    def test_skip_locked(self):
+        "A job another worker is claiming right now is skipped, not waited for"
+        # Needs committed jobs and two connections, rows locked in the test transaction aren't locked for itself
+        other = self.lru(Db.create())
+
+        async def claim_concurrently():
+            async with other.pool.acquire() as conn:
+                async with conn.transaction():
+                    first = await (await Db.create(existingconn=conn)).claim_job(self.queue, 'a')
+                    # Row of the first job stays locked until this transaction ends
+                    second = await other.claim_job(self.queue, 'b')
+            return first['id'], second['id']
+
+        try:
+            ids = tuple(self.lru(other.add_job(self.queue, priority, self.media, self.conf)) for priority in (1, 2))
+            self.assertEqual(self.lru(claim_concurrently()), ids)
+        finally:
+            self.lru(other.pool.execute('DELETE FROM transcode_jobs WHERE queue = $1;', self.queue))
+            self.lru(other.pool.close())
+
+    def test_retry_and_visibility(self):
+        job_id = self.lru(self.db.add_job(self.queue, 1, self.media, self.conf))
+        job = self.lru(self.db.claim_job(self.queue, 'a'))
+        # Retried only after backoff
+        self.assertTrue(self.lru(self.db.fail_job(job_id, 'a', 'Oops')))
+        self.assertIsNone(self.lru(self.db.claim_job(self.queue, 'a')))
+        self.lru(self.conn.execute("UPDATE transcode_jobs SET run_after = '2000-01-01' WHERE id = $1", job_id))
+        job = self.lru(self.db.claim_job(self.queue, 'a', visibility_timeout=0))
+        self.assertEqual(job['attempts'], 2)
+        # Visibility timeout expired, so another worker takes over
+        job = self.lru(self.db.claim_job(self.queue, 'b'))
+        self.assertEqual(job['id'], job_id)
+        self.assertFalse(self.lru(self.db.extend_job(job_id, 'a')))
+        self.assertTrue(self.lru(self.db.extend_job(job_id, 'b')))
+        # Released jobs are due again right away, without counting the attempt
+        self.lru(self.db.release_job(job_id, 'b'))
+        job = self.lru(self.db.claim_job(self.queue, 'a'))
+        self.assertEqual(job['attempts'], 3)
+        # Give up after max attempts
+        self.assertFalse(self.lru(self.db.fail_job(job_id, 'a', 'Oops', max_attempts=3)))
+        self.lru(self.conn.execute("UPDATE transcode_jobs SET run_after = '2000-01-01' WHERE id = $1", job_id))
+        self.assertIsNone(self.lru(self.db.claim_job(self.queue, 'a')))
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--create', action='store_true',
+                        help="Create db tables and indexes")
+    parser.add_argument('--test', action='store_true',
+                        help="Test db")
+    args = parser.parse_args()
+
+    if args.create:
+        l = asyncio.get_event_loop()
+        db = l.run_until_complete(Db.create())
+        l.run_until_complete(db.create_tables())
+
+    if args.test:
+        # Pass only system name, ignore other args
+        unittest.main(verbosity=1, argv=sys.argv[:1])
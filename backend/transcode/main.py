@@ -1,48 +1,130 @@
+import os
 import asyncio
+import os.path as osp
 from itertools import count
+from concurrent.futures import ProcessPoolExecutor
 cnt = count()
 
 from ..utils import BackendAppSession, getLogger
-from .transcoder import VidThumbTranscoder, VidTranscoder, ImageTranscoder, AudioTranscoder
-from .mediaconfig import video_thumb_resolutions, video_resolutions, image_resolutions, audio_resolutions
+from .db import Db, JobQueue
+from .cache import TranscodeCache
+from .transcoder import VidThumbTranscoder, VidTranscoder, MultiVidTranscoder, ImageTranscoder, AudioTranscoder, \
+    QueueStats
+from .mediaconfig import video_thumb_resolutions, video_resolutions, image_resolutions, audio_resolutions, \
+    queue_workers, video_single_pass, cache_max_bytes, video_hls_resolutions, video_hls
 
 logger = getLogger('transcode.main')
 
+CPU_COUNT = os.cpu_count() or 1
+# Jobs running at the same time over all queues, so transcoders don't fight over cores
+MAX_JOBS = int(os.environ.get('AT_TRANSCODE_MAX_JOBS', CPU_COUNT))
+SINGLE_PASS = bool(int(os.environ.get('AT_TRANSCODE_SINGLE_PASS', video_single_pass)))
+HLS = bool(int(os.environ.get('AT_TRANSCODE_HLS', video_hls)))
+CACHE = bool(int(os.environ.get('AT_TRANSCODE_CACHE', 1)))
+CACHE_MAX_BYTES = int(os.environ.get('AT_TRANSCODE_CACHE_MAX_BYTES', cache_max_bytes))
+# Seconds between applying the cache's eviction policy
+CACHE_EVICT_INTERVAL = 600
+
+
+def worker_count(queue_name):
+    "Transcoders for queue, from environment or mediaconfig.queue_workers"
+    n = os.environ.get('AT_TRANSCODE_WORKERS_{}'.format(queue_name.upper()))
+    if n is None:
+        n = queue_workers.get(queue_name)
+    return max(1, int(n or CPU_COUNT))
+
 
 class TranscodeComponent(BackendAppSession):
 
     async def onJoin(self, details):
         logger.info("session joined")
 
-        # Set up queues
-        queue_video_thumb = asyncio.PriorityQueue()
-        queue_video = asyncio.PriorityQueue()
-        queue_image = asyncio.PriorityQueue()
-        queue_audio = asyncio.PriorityQueue()
+        # Set up queues, jobs are stored in the db so they survive restarts and can be shared by instances
+        self.db = db = await Db.create()
+        queue_video_thumb = JobQueue(db, 'video_thumb')
+        queue_video = JobQueue(db, 'video')
+        queue_image = JobQueue(db, 'image')
+        queue_audio = JobQueue(db, 'audio')
+        queues = {q.name: q for q in (queue_video_thumb, queue_video, queue_image, queue_audio)}
 
-        # Remember for when shutting down
-        self.queues = [queue_video_thumb, queue_video, queue_image, queue_audio]
+        def job_added(queue_name):
+            if queue_name in queues:
+                queues[queue_name].wake.set()
+
+        await db.listen(job_added)
 
         queue_results = asyncio.Queue()
         self.queue_results = queue_results
 
-        # Note: can set up multiple queue consumers per queue if needed
-        vtt = await VidThumbTranscoder.create()
-        vt  = await VidTranscoder.create()
-        it  = await ImageTranscoder.create()
-        at  = await AudioTranscoder.create()
-
+        limiter = asyncio.Semaphore(MAX_JOBS)
+        # Give every ffmpeg its share of cores when all job slots are in use
+        threads = max(1, CPU_COUNT // MAX_JOBS)
+        # Pillow runs in other processes, so images don't hold up the event loop or each other
+        self.image_executor = ProcessPoolExecutor(worker_count('image'))
+        # Cache in media root, so outputs can be hard linked instead of copied
+        self.cache = None
+        if CACHE:
+            cache_dir = os.environ.get('AT_TRANSCODE_CACHE_DIR',
+                                       osp.join(os.environ['AT_MEDIA_ROOT'], '.transcode-cache'))
+            self.cache = TranscodeCache(cache_dir, CACHE_MAX_BYTES)
+
+        def publish_progress(progress):
+            "Percent, fps and speed of running ffmpegs, to spot slow encodes"
+            self.publish('at.transcode.progress', progress)
+
+        # {<queue name>: QueueStats}
+        self.stats = {}
         # Remember for when shutting down
-        self.transcoders = [vtt, vt, it, at]
-
-        # Schedule all queue consumers
-        tfs = []
-        tfs += [asyncio.ensure_future(vtt.consume(queue_video_thumb, queue_results))]
-        tfs += [asyncio.ensure_future(vt.consume(queue_video, queue_results))]
-        tfs += [asyncio.ensure_future(it.consume(queue_image, queue_results))]
-        tfs += [asyncio.ensure_future(at.consume(queue_audio, queue_results))]
+        self.transcoders = []
         # Remember so we can wait on them to finish when cleaning up
-        self.transcoder_futures = tfs
+        self.transcoder_futures = []
+        for name, cls, q, executor in (('video_thumb', VidThumbTranscoder, queue_video_thumb, None),
+                                       ('video', MultiVidTranscoder if SINGLE_PASS else VidTranscoder,
+                                        queue_video, None),
+                                       ('image', ImageTranscoder, queue_image, self.image_executor),
+                                       ('audio', AudioTranscoder, queue_audio, None)):
+            n = worker_count(name)
+            stats = self.stats[name] = QueueStats(q, n)
+            # Schedule all queue consumers
+            for _ in range(n):
+                tc = await cls.create(limiter=limiter, stats=stats, executor=executor, threads=threads,
+                                      cache=self.cache, on_progress=publish_progress)
+                self.transcoders.append(tc)
+                self.transcoder_futures.append(asyncio.ensure_future(tc.consume(q, queue_results)))
+        logger.info("Started transcoders %s, at most %s jobs at a time",
+                    {name: s.workers for name, s in self.stats.items()}, MAX_JOBS)
+
+        async def get_metrics():
+            """
+            Depth, wait time in seconds, active workers and average ffmpeg speed per queue, depth is of all instances.
+            Progress of running ffmpegs of this instance.
+            """
+            depths = await db.queue_depths()
+            for name, q in queues.items():
+                q.depth = depths.get(name, 0)
+            stats = {name: s.as_dict() for name, s in self.stats.items()}
+            return {
+                'queues': stats,
+                'max_jobs': MAX_JOBS,
+                'active_jobs': sum(q['active'] for q in stats.values()),
+                'running': [t.progress for t in self.transcoders if t.progress],
+                'cache': self.cache.metrics() if self.cache else None,
+            }
+
+        self.register(get_metrics, 'at.transcode.get_metrics')
+
+        loop = asyncio.get_event_loop()
+
+        async def evict_cache():
+            while True:
+                try:
+                    # Walks the cache directory, so not in the event loop
+                    await loop.run_in_executor(None, self.cache.evict)
+                except Exception:
+                    logger.exception("Could not evict from transcode cache")
+                await asyncio.sleep(CACHE_EVICT_INTERVAL)
+
+        self.evict_future = asyncio.ensure_future(evict_cache()) if self.cache else None
 
         async def transcode(m):
 
@@ -50,14 +132,22 @@ class TranscodeComponent(BackendAppSession):
                 for i, res in enumerate(resolutions):
                     # Priority from 1 to len(resolutions)
                     # Use unique count to make sure never to compare dict m or res when i is equal
-                    await q.put((i+1, next(cnt), m, res))
+                    # Last is time queued, for wait time metrics
+                    await q.put((i+1, next(cnt), m, res, loop.time()))
             # Put tasks on queues
             mt = m['type']
-            if mt == 'video':
+            # After the progressive renditions, those play everywhere
+            hls = video_hls_resolutions if HLS else []
+            if mt == 'video' and SINGLE_PASS:
+                # One job for all outputs
+                await put_queue(queue_video, [{'name': 'all',
+                                               'outputs': video_thumb_resolutions + video_resolutions}] + hls)
+            elif mt == 'video':
                 await put_queue(queue_video_thumb, video_thumb_resolutions)
-                await put_queue(queue_video, video_resolutions)
+                await put_queue(queue_video, video_resolutions + hls)
             elif mt == 'image':
-                await put_queue(queue_image, image_resolutions)
+                # One job, the image is decoded once for all outputs
+                await put_queue(queue_image, [{'name': 'all', 'outputs': image_resolutions}])
             elif mt == 'audio':
                 await put_queue(queue_audio, audio_resolutions)
             else:
@@ -78,44 +168,34 @@ class TranscodeComponent(BackendAppSession):
             queue_results.task_done()
 
     async def cleanup(self, loop):
-        # TODO: Clean up, this code works but is pretty unwieldy
-        logger.info("Cleaning up, stopping transcodes and saving non-completed ones...")
-        unfinished_business = []
-        for t in self.transcoders:
-            m = t.stop()
-            unfinished_business.append(m)
+        logger.info("Cleaning up, stopping transcodes and handing back their jobs...")
+        unfinished = [(t, t.stop()) for t in self.transcoders]
         for f in self.transcoder_futures:
             f.cancel()
-        # Empty all queues
-        unfinished_queues = []
-        for q in self.queues:
-            try:
-                # Empty entire queue
-                while True:
-                    unfinished_queues.append(q.get_nowait())
-            except asyncio.QueueEmpty:
-                pass
-
+        if self.evict_future:
+            self.evict_future.cancel()
+        # Jobs stay in the db, so another instance or the next start picks them up
+        for t, m in unfinished:
+            if m:
+                try:
+                    await t.pq.release(m)
+                except Exception:
+                    logger.exception("Could not release job %s, it's redone after its visibility timeout", m)
         unsent_results = []
         try:
             while True:
                 unsent_results.append(self.queue_results.get_nowait())
         except asyncio.QueueEmpty:
             pass
-        # Should save unfinished business to file or db, and check on startup
-        # For now just log err
-        # unfinished_business can contain Nones
-        if any(unfinished_business) or unfinished_queues or unsent_results:
-            logger.error("Unfinished business! Unfinished queues: %s\n"
-                         "Transcodes that failed because of exit: %s\n"
-                         "Unsent results: %s",
-                         unfinished_queues, unfinished_business, unsent_results)
+        if unsent_results:
+            logger.warning("Results that weren't published, their jobs are redone: %s", unsent_results)
         logger.info("Waiting for onJoin to exit...")
         # Exit signal
         await self.queue_results.put(None)
         logger.debug("Waiting for transcoders to exit...")
         await asyncio.wait(self.transcoder_futures)
-
+        await self.db.unlisten()
+        self.image_executor.shutdown(wait=False)
 
 if __name__=="__main__":
     TranscodeComponent.run_forever()
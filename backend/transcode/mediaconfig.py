@@ -4,12 +4,38 @@ video_thumb_resolutions = [
 
 video_resolutions = [
     # Priority ordering: first one gets encoded, then the rest
-    {'name': '360', 'wh': [640, 360], 'ext': 'mp4'},
-    {'name': '720', 'wh': [1280, 720], 'ext': 'mp4'},
-    {'name': '1080', 'wh': [1920, 1080], 'ext': 'mp4'},
+    # H.264 sources up to max-bitrate kb/s that fit are copied instead of encoded
+    {'name': '360', 'wh': [640, 360], 'ext': 'mp4', 'max-bitrate': 1000},
+    {'name': '720', 'wh': [1280, 720], 'ext': 'mp4', 'max-bitrate': 3000},
+    {'name': '1080', 'wh': [1920, 1080], 'ext': 'mp4', 'max-bitrate': 6000},
 ]
 
+# Adaptive streaming, players switch between rungs of the ladder depending on bandwidth.
+# All rungs are made in a single encode, rungs larger than the source are left out, see transcoder.hls_cmd.
+# The playlist is one media entry with conf_name 'hls'. Segment type is 'fmp4' or 'mpegts'.
+video_hls_resolutions = [
+    {'name': 'hls', 'ext': 'm3u8', 'segment-seconds': 4, 'segment-type': 'fmp4', 'ladder': [
+        # Bitrates in kb/s
+        {'name': '240', 'wh': [426, 240], 'bitrate': 400},
+        {'name': '360', 'wh': [640, 360], 'bitrate': 800},
+        {'name': '720', 'wh': [1280, 720], 'bitrate': 2500},
+        {'name': '1080', 'wh': [1920, 1080], 'bitrate': 5000},
+    ]},
+]
+
+# Make video_hls_resolutions as well as the progressive MP4s of video_resolutions.
+# Needs ffmpeg 4.0 or newer for fmp4 segments, master playlist and variant streams of the hls muxer,
+# the distro ffmpeg of the Vagrant box (Ubuntu 17.04, ffmpeg 3.2) is too old.
+# Override with AT_TRANSCODE_HLS=1 or 0
+video_hls = False
+
+# Decode videos once for all of video_resolutions and the thumbnail, see MultiVidTranscoder.
+# Uses less CPU, but the smallest rendition isn't available before the largest is done.
+# Override with AT_TRANSCODE_SINGLE_PASS=1 or 0
+video_single_pass = False
+
 image_resolutions = [
+    # All are made from a single decode of the image, see transcoder.transcode_images
     # For display in list
     {'name': 'thumb', 'wh': [640, 480], 'ext': 'jpg', 'update': False},
     # Half-screen
@@ -18,7 +44,32 @@ image_resolutions = [
     {'name': '1080', 'wh': [1920, 1080], 'ext': 'jpg'},
 ]
 
+# Pillow save options of image renditions by ext, a conf with 'ext': 'webp' is saved as WebP.
+# Progressive JPEGs show a blurry version while loading, set progressive False for baseline JPEGs.
+image_formats = {
+    'jpg': {'format': 'JPEG', 'quality': 85, 'optimize': True, 'progressive': True},
+    'webp': {'format': 'WEBP', 'quality': 80, 'method': 4},
+}
+
 # Not implemented yet
 audio_resolutions = [
     {'name': 'std', 'max-bitrate': 128, 'ext': 'm4a'}
 ]
+
+# Transcoders consuming each queue at the same time, None for one per CPU core.
+# Override with e.g. AT_TRANSCODE_WORKERS_VIDEO=2
+queue_workers = {
+    'video_thumb': 1,
+    'video': None,
+    'image': None,
+    'audio': 1,
+}
+
+# Bump when transcoding changes in a way mediaconfig doesn't show, e.g. other ffmpeg options,
+# so outputs in the transcode cache made the old way aren't used anymore
+config_version = 2
+
+# Outputs of recent sources are kept to be reused when the same file is uploaded again, see cache.py.
+# Least recently used are removed above this size. Override with AT_TRANSCODE_CACHE_MAX_BYTES,
+# or disable the cache with AT_TRANSCODE_CACHE=0
+cache_max_bytes = 20 * 1024 ** 3
@@ -1,30 +1,248 @@
 import os
 import re
+import json
+import shutil
 import asyncio
 import tempfile
+import traceback
 import os.path as osp
 import asyncio.subprocess
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor
 
 from PIL import Image
 
-from ..utils import getLogger
+import dateutil.parser
+
+from ..utils import getLogger, TTLCache, localtime_to_utc
 from .mediaconfig import *
+from .cache import companion_dir
 
 logger = getLogger('transcode.transcoder')
 
 
+# Keep aspect ratio and never upscale, see https://trac.ffmpeg.org/wiki/Scaling%20(resizing)%20with%20ffmpeg
+# Then round down to even sizes, libx264 fails on odd ones like 854x480 scaled to 426x239.
+# (force_divisible_by of scale would do both at once, but needs ffmpeg 4.3, distro ffmpeg is older)
+SCALE_FILTER = ("scale=w='min(iw,{wh[0]})':h='min(ih,{wh[1]})':force_original_aspect_ratio=decrease,"
+                "scale=trunc(iw/2)*2:trunc(ih/2)*2")
+# Streams that can go into our mp4 and m4a files as they are
+COPY_VIDEO_CODECS = {'h264'}
+COPY_AUDIO_CODECS = {'aac'}
+# Browsers don't play e.g. 10 bit or 4:2:2 H.264
+COPY_PIX_FMTS = {'yuv420p', 'yuvj420p'}
+# Bitrate of audio we encode, in kb/s
+AUDIO_BITRATE = 128
+# ffprobe results of recent sources, so all renditions of a source are probed once
+PROBES = TTLCache(3600, maxsize=1000)
+# Seconds a subprocess may run before it's killed and the job is retried, so a hung ffmpeg doesn't
+# block its queue forever. At least TIMEOUT_MIN, plus TIMEOUT_PER_SECOND per second of source.
+TIMEOUT_MIN = 120
+TIMEOUT_PER_SECOND = 10
+# If the duration of the source isn't known
+TIMEOUT_DEFAULT = 3600
+PROBE_TIMEOUT = 60
+# Seconds between progress reports of a running ffmpeg
+PROGRESS_INTERVAL = 2
+
+
+def parse_probe(probe):
+    "Metadata we need from ffprobe's json, of the first video and audio stream"
+    def num(v, typ=float):
+        try:
+            return typ(v)
+        except (TypeError, ValueError):
+            return None
+
+    fmt = probe.get('format', {})
+    streams = probe.get('streams', [])
+    # Cover art is a video stream too
+    video = next((s for s in streams if s.get('codec_type') == 'video'
+                  and not s.get('disposition', {}).get('attached_pic')), {})
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), {})
+    width, height = num(video.get('width'), int), num(video.get('height'), int)
+    # Phones store portrait video as landscape with a rotation, which ffmpeg applies when transcoding
+    rotation = num(video.get('tags', {}).get('rotate'), int)
+    for side_data in video.get('side_data_list', []):
+        if rotation is None and 'rotation' in side_data:
+            rotation = num(side_data['rotation'], int)
+    if rotation and rotation % 180:
+        width, height = height, width
+    created = fmt.get('tags', {}).get('creation_time') or video.get('tags', {}).get('creation_time')
+    try:
+        timestamp = localtime_to_utc(dateutil.parser.parse(created), remove_tzinfo=True).isoformat()
+    except (TypeError, ValueError, OverflowError):
+        timestamp = None
+    kbps = lambda s: num(s.get('bit_rate')) / 1000 if num(s.get('bit_rate')) else None
+    audio_bitrate = kbps(audio)
+    # Ogg streams, e.g. Opus voice notes, have no bitrate of their own. Without video the
+    # container's bitrate is about the audio's.
+    if audio and audio_bitrate is None and not video:
+        audio_bitrate = kbps(fmt)
+    return {
+        'width': width,
+        'height': height,
+        'duration': num(fmt.get('duration')),
+        'timestamp': timestamp,
+        'video_codec': video.get('codec_name'),
+        'pix_fmt': video.get('pix_fmt'),
+        'video_bitrate': kbps(video),
+        'audio_codec': audio.get('codec_name'),
+        'audio_bitrate': audio_bitrate,
+    }
+
+
+def subprocess_timeout(duration):
+    if not duration:
+        return TIMEOUT_DEFAULT
+    return TIMEOUT_MIN + duration * TIMEOUT_PER_SECOND
+
+
+def parse_progress(block, duration=None):
+    "Progress from a block of ffmpeg's -progress key=value lines, *duration* of the source for percent"
+    def num(v):
+        try:
+            return float(v)
+        except (TypeError, ValueError):
+            return None
+
+    # out_time_ms is in microseconds as well
+    out_time = num(block.get('out_time_us') or block.get('out_time_ms'))
+    out_time = out_time / 1e6 if out_time is not None and out_time >= 0 else None
+    percent = None
+    if out_time is not None and duration:
+        percent = round(min(100., out_time / duration * 100), 1)
+    return {
+        'out_time': out_time,
+        'fps': num(block.get('fps')),
+        # E.g. '2.5x' or 'N/A'
+        'speed': num(block.get('speed', '').rstrip('x')),
+        'percent': percent,
+        'done': block.get('progress') == 'end',
+    }
+
+
+def fits(width, height, wh):
+    return width <= wh[0] and height <= wh[1]
+
+
+def is_upscale(conf, confs, width, height):
+    """
+    True if a smaller conf of *confs* already fits the whole source, so *conf* would only make a copy of it.
+    Thumbnails are always made, and are not taken into account.
+    """
+    if not width or not height or conf['name'] == 'thumb':
+        return False
+    area = conf['wh'][0] * conf['wh'][1]
+    return any(c['name'] != 'thumb' and c['wh'][0] * c['wh'][1] < area and fits(width, height, c['wh'])
+               for c in confs)
+
+
+def can_copy_video(info, conf):
+    "Source video can be used as it is, it's H.264 that browsers play, fits and has a bitrate we can afford"
+    return bool(info and info['video_codec'] in COPY_VIDEO_CODECS and info['pix_fmt'] in COPY_PIX_FMTS
+                and info['width'] and fits(info['width'], info['height'], conf['wh'])
+                and info['video_bitrate'] and info['video_bitrate'] <= conf.get('max-bitrate', 0))
+
+
+def audio_args(info):
+    "Copy AAC audio, encode anything else. Keep the audio as it is if the source couldn't be probed."
+    if info is None:
+        return ['-c:a', 'copy']
+    if not info['audio_codec']:
+        return ['-an']
+    if info['audio_codec'] in COPY_AUDIO_CODECS:
+        return ['-c:a', 'copy']
+    return ['-c:a', 'aac', '-b:a', '{}k'.format(AUDIO_BITRATE)]
+
+
+def video_args(info, conf, threads=None, scale=True):
+    "ffmpeg output options of an H.264 rendition, pass *scale* False if it's scaled in a filter graph already"
+    if can_copy_video(info, conf):
+        args = ['-c:v', 'copy']
+    else:
+        args = ['-vf', SCALE_FILTER.format(wh=conf['wh'])] if scale else []
+        args += ['-c:v', 'libx264', '-crf', '26']
+        # Leave cores to other jobs running at the same time
+        if threads:
+            args += ['-threads', str(threads)]
+    return args + audio_args(info)
+
+
+class QueueStats():
+    "Queue depth, wait time and busy workers of one transcode queue, shared by its transcoders"
+    def __init__(self, queue, workers):
+        self.queue = queue
+        self.workers = workers
+        self.active = 0
+        self.done = 0
+        self.failed = 0
+        # Seconds between putting a job on the queue and starting to transcode it
+        self.wait_total = 0.
+        self.wait_max = 0.
+        # Sum of ffmpeg speeds, seconds of source per second, of finished ffmpeg runs
+        self.speed_total = 0.
+        self.encodes = 0
+
+    def started(self, wait):
+        self.active += 1
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+
+    def encoded(self, speed):
+        self.encodes += 1
+        self.speed_total += speed
+
+    def finished(self, ok):
+        self.active -= 1
+        if ok:
+            self.done += 1
+        else:
+            self.failed += 1
+
+    def as_dict(self):
+        started = self.done + self.failed + self.active
+        return {
+            'depth': self.queue.qsize(),
+            'workers': self.workers,
+            'active': self.active,
+            'done': self.done,
+            'failed': self.failed,
+            'wait_avg': self.wait_total / started if started else None,
+            'wait_max': self.wait_max,
+            'speed_avg': self.speed_total / self.encodes if self.encodes else None,
+        }
+
+
 class Transcoder:
     "Nice object-oriented style transcoder implementation"
     @classmethod
-    async def create(cls, loop=None):
+    async def create(cls, loop=None, limiter=None, stats=None, executor=None, threads=None, cache=None,
+                     on_progress=None):
+        """
+        Transcoders of all queues share the *limiter* semaphore, so together they don't run more jobs
+        than there are cores. *stats* is the QueueStats of the queue this transcoder consumes.
+        *threads* is passed to ffmpeg, and *executor* is used for work done in Python.
+        Outputs are taken from and stored in the TranscodeCache *cache* if given.
+        *on_progress* is called with the progress of running ffmpegs every PROGRESS_INTERVAL seconds.
+        """
         tc = cls()
         tc.loop = loop or asyncio.get_event_loop()
-        # Call this method to allow subclasses to initialize specific things, e.g. ThreadPoolExecutor
+        tc.limiter = limiter
+        tc.stats = stats
+        tc.executor = executor
+        tc.threads = threads
+        tc.cache = cache
+        tc.on_progress = on_progress
+        # Call this method to allow subclasses to initialize specific things, e.g. an executor
         tc.init()
         tc.media_root = osp.abspath(os.environ['AT_MEDIA_ROOT'])
+        # Outputs are made in the media root's filesystem, so they can be moved there and hard linked
+        # into the cache instead of copied
+        tc.tmp_root = osp.join(tc.media_root, '.transcode-tmp')
         tc.proc = None
         tc.m = None
+        # Of running ffmpeg, see read_progress
+        tc.progress = None
         return tc
 
     def init(self):
@@ -32,48 +250,89 @@ class Transcoder:
         pass
 
     async def consume(self, pq, resq):
-        "Priority queue for input, result queue for output"
+        """
+        Job queue for input, see db.JobQueue, result queue for output.
+        Jobs are done when their results have been taken from the result queue.
+        """
         self.pq = pq
         logger.debug("%s consuming from queue", self)
         while True:
             # Store on self for retrieval on unexpected exit
             self.m = await self.pq.get()
             logger.debug("Consumed from queue: %s", self.m)
+            if self.limiter:
+                await self.limiter.acquire()
+            if self.stats:
+                # Last item is the loop time it was queued at
+                self.stats.started(self.loop.time() - self.m[-1])
+            error = None
+            tmpdir = None
             try:
                 media = self.m[2]
-                media_transcoded = media.copy()
                 conf = self.m[3]
-                media_transcoded['update'] = conf.get('update', True)
                 src = media['path']
                 # Paths can be absolute or relative to media root
                 if not osp.isabs(src):
                     src = osp.abspath(osp.join(os.environ['AT_MEDIA_ROOT'], media['path']))
-                tmpdir = tempfile.mkdtemp(prefix='transcode-')
+                os.makedirs(self.tmp_root, exist_ok=True)
+                tmpdir = tempfile.mkdtemp(prefix='transcode-', dir=self.tmp_root)
                 # Construct entire filename
                 n, ext = osp.splitext(osp.basename(src))
+                # A job can have several outputs, see MultiVidTranscoder
+                confs = conf.get('outputs', [conf])
                 # Make <tmpdir>/<originalname>-video.<newext>
-                dest_tmp = osp.join(tmpdir, '{}-{}.{}'.format(n, conf['name'], conf['ext']))
-                # Returns dict with possible keys: timestamp, duration, width, height, log
+                dests_tmp = [osp.join(tmpdir, '{}-{}.{}'.format(n, c['name'], c['ext'])) for c in confs]
+                # Returns dict with possible keys: timestamp, duration, width, height, log for every conf,
+                # or None if the conf is skipped
                 logger.debug("Starting transcode for %s with conf %s", media, conf)
-                stat = await self.transcode(src, dest_tmp, conf)
+                stats = await self.cached_transcode_many(src, dests_tmp, confs)
                 logger.debug("Finished transcode for %s with conf %s", media, conf)
-                media_transcoded.update(stat)
-                # Move from temp folder to e.g. <media_root>/video/<filename>
-                dest_perm = osp.join(self.media_root, media['type'], osp.basename(dest_tmp))
-                # Make dir if non-existent
-                os.makedirs(osp.dirname(dest_perm), exist_ok=True)
-                # Use replace instead of rename to overwrite target
-                os.replace(dest_tmp, dest_perm)
-                # Make path relative to media root and store in media obj
-                media_transcoded['path'] = osp.relpath(dest_perm, self.media_root)
-                media_transcoded['conf_name'] = conf['name']
-                # Put in result queue
-                await resq.put(media_transcoded)
+                for c, dest_tmp, stat in zip(confs, dests_tmp, stats):
+                    if stat is None:
+                        logger.info("Skipped %s for %s, source isn't larger than a smaller rendition", c['name'], src)
+                        continue
+                    media_transcoded = media.copy()
+                    media_transcoded['update'] = c.get('update', True)
+                    media_transcoded.update(stat)
+                    # Move from temp folder to e.g. <media_root>/video/<filename>
+                    dest_perm = osp.join(self.media_root, media['type'], osp.basename(dest_tmp))
+                    # Make dir if non-existent
+                    os.makedirs(osp.dirname(dest_perm), exist_ok=True)
+                    # Segments of HLS playlists, before the playlist so it never refers to missing ones
+                    if osp.isdir(companion_dir(dest_tmp)):
+                        shutil.rmtree(companion_dir(dest_perm), ignore_errors=True)
+                        os.replace(companion_dir(dest_tmp), companion_dir(dest_perm))
+                    # Use replace instead of rename to overwrite target
+                    os.replace(dest_tmp, dest_perm)
+                    # Make path relative to media root and store in media obj
+                    media_transcoded['path'] = osp.relpath(dest_perm, self.media_root)
+                    media_transcoded['conf_name'] = c['name']
+                    # Put in result queue
+                    await resq.put(media_transcoded)
+            except asyncio.CancelledError:
+                # Shutting down, job is handed back by TranscodeComponent.cleanup
+                raise
             except Exception:
                 logger.exception("Error in transcoding process for media %s", self.m)
-            # Let queue counter decrease
-            self.pq.task_done()
+                error = traceback.format_exc()
+            finally:
+                # Whatever wasn't moved to the media root, e.g. outputs of a failed job
+                if tmpdir:
+                    shutil.rmtree(tmpdir, ignore_errors=True)
+                if self.limiter:
+                    self.limiter.release()
+                if self.stats:
+                    self.stats.finished(error is None)
+            if error is None:
+                # Don't lose results if we're stopped before they're published
+                await resq.join()
+            try:
+                await self.pq.done(self.m, error)
+            except Exception:
+                # Job becomes visible again after its timeout and is redone
+                logger.exception("Could not mark job %s as done", self.m)
             self.m = None
+            self.progress = None
 
     def stop(self):
         "Stops any process, returns any unfinished business or None"
@@ -84,10 +343,67 @@ class Transcoder:
     async def transcode(self, *args, **kwargs):
         raise Warning("Method not implemented")
 
-    async def run_subprocess(self, cmd_list, ignore_returncode=False):
-        "Run a subprocess as coroutine"
+    async def transcode_many(self, src, dests, confs):
+        "List of transcode results, one per conf. Override to do them all at once."
+        return [await self.transcode(src, dest, conf) for dest, conf in zip(dests, confs)]
+
+    async def cached_transcode_many(self, src, dests, confs):
+        "transcode_many, but outputs of confs this source has been transcoded with before come from the cache"
+        if not self.cache:
+            return await self.transcode_many(src, dests, confs)
+        keys = [await self.cache.key(src, conf) for conf in confs]
+        # Copies whole videos if hard links aren't possible, so not in the event loop
+        out = [await self.loop.run_in_executor(None, self.cache.get, key, dest) for key, dest in zip(keys, dests)]
+        todo = [i for i, stat in enumerate(out) if stat is None]
+        if len(todo) < len(confs):
+            logger.info("Transcode cache hit for %s of %s: %s", src, [c['name'] for c in confs],
+                        [confs[i]['name'] for i in range(len(confs)) if i not in todo])
+        if todo:
+            stats = await self.transcode_many(src, [dests[i] for i in todo], [confs[i] for i in todo])
+            for i, stat in zip(todo, stats):
+                await self.loop.run_in_executor(None, self.cache.put, keys[i], dests[i], stat)
+                out[i] = stat
+        # Skipped confs are None, as from transcode_many
+        return [None if stat and stat.get('skipped') else stat for stat in out]
+
+    async def probe(self, path, cache=True):
+        "parse_probe of ffprobe's info on file, None if it can't be probed"
+        key = (path, osp.getmtime(path))
+        if cache:
+            try:
+                return PROBES[key]
+            except KeyError:
+                pass
+        try:
+            out = await self.run_subprocess(['ffprobe', '-v', 'error', '-print_format', 'json', '-show_format',
+                                             '-show_streams', path], return_stdout=True, timeout=PROBE_TIMEOUT)
+            info = parse_probe(json.loads(out))
+        except (Warning, ValueError):
+            logger.exception("Could not probe %s", path)
+            info = None
+        if cache:
+            PROBES[key] = info
+        return info
+
+    async def output_stat(self, src_info, dest, log):
+        "Result of a transcode, with metadata of the output"
+        info = await self.probe(dest, cache=False) or {}
+        return {'timestamp': (src_info or {}).get('timestamp'), 'duration': info.get('duration'),
+                'width': info.get('width'), 'height': info.get('height'), 'log': log}
+
+    async def run_subprocess(self, cmd_list, ignore_returncode=False, return_stdout=False, duration=None,
+                             timeout=None):
+        """
+        Run a subprocess as coroutine, killed after *timeout* seconds, by default proportional to the
+        *duration* of the source. ffmpeg reports its progress on stdout, see read_progress.
+        """
+        if timeout is None:
+            timeout = subprocess_timeout(duration)
+        progress = cmd_list[0] == 'ffmpeg' and not return_stdout
+        if progress:
+            # No stats on stderr, they'd only make the log long
+            cmd_list = cmd_list[:1] + ['-progress', 'pipe:1', '-nostats'] + cmd_list[1:]
         logger.info("Running command > {}".format(' '.join(cmd_list)))
-        # TODO: Use asyncio.wait_for to specify a timeout
         proc = await asyncio.create_subprocess_exec(
             *cmd_list,
             # Capture stdout, stderr to avoid dirty logs
@@ -96,26 +412,132 @@ class Transcoder:
         )
         # Save proc to be able to end it
         self.proc = proc
-        await proc.wait()
-        # Process is over now
-        self.proc = None
-        stdout, stderr = await proc.communicate()
+
+        async def read_stdout():
+            if progress:
+                await self.read_progress(proc.stdout, duration)
+                return b''
+            return await proc.stdout.read()
+
+        try:
+            # Read both pipes while it runs, a full pipe would block the process
+            stdout, stderr, _ = await asyncio.wait_for(
+                asyncio.gather(read_stdout(), proc.stderr.read(), proc.wait()), timeout)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+            raise Warning("Killed after {}s > {}".format(timeout, ' '.join(cmd_list)))
+        finally:
+            # Process is over now
+            self.proc = None
         if proc.returncode and not ignore_returncode:
             raise Warning("Return code {} is nonzero, stdout={} stderr={}".format(proc.returncode, stdout, stderr))
         # stdout is bytes, conver to string for json serialization
-        return stderr.decode('utf-8')
+        return (stdout if return_stdout else stderr).decode('utf-8')
+
+    async def read_progress(self, stream, duration=None):
+        "Keep progress of ffmpeg from its -progress output, and report it every PROGRESS_INTERVAL seconds"
+        block = {}
+        reported = None
+        while True:
+            line = await stream.readline()
+            if not line:
+                break
+            key, _, value = line.decode('utf-8', 'replace').strip().partition('=')
+            block[key] = value
+            # Last line of every block
+            if key != 'progress':
+                continue
+            self.progress = dict(self.job_info(), **parse_progress(block, duration))
+            block = {}
+            now = self.loop.time()
+            if self.progress['done'] and self.stats and self.progress['speed']:
+                self.stats.encoded(self.progress['speed'])
+            if self.on_progress and (self.progress['done'] or reported is None or
+                                     now - reported >= PROGRESS_INTERVAL):
+                reported = now
+                try:
+                    self.on_progress(self.progress)
+                except Exception:
+                    logger.exception("Could not report progress %s", self.progress)
+
+    def job_info(self):
+        "Identifies the running job in progress reports"
+        if not self.m:
+            return {}
+        media, conf = self.m[2], self.m[3]
+        return {
+            'job_id': self.m[1],
+            'queue': self.stats.queue.name if self.stats else None,
+            'msg_id': media.get('msg_id'),
+            'path': media.get('path'),
+            'conf_name': conf['name'],
+        }
 
 
 class VidThumbTranscoder(Transcoder):
     async def transcode(self, src, dest, conf):
         "Generate thumbnail for video"
-        cmd = ("ffmpeg -y -i {src} -vf "
-               "thumbnail,scale=w='min(iw,{conf[wh][0]})':h='min(ih,{conf[wh][1]})':force_original_aspect_ratio=decrease "
-               "-frames:v 1 -an {dest}").format(
-            src=src, dest=dest, conf=conf)
-        stdout = await self.run_subprocess(cmd.split())
-        width, height = None, None
-        return {'width': width, 'height': height, 'log': stdout}
+        info = await self.probe(src)
+        cmd = ['ffmpeg', '-y', '-i', src, '-vf', 'thumbnail,' + SCALE_FILTER.format(wh=conf['wh']),
+               '-frames:v', '1', '-an', dest]
+        log = await self.run_subprocess(cmd, duration=(info or {}).get('duration'))
+        return await self.output_stat(info, dest, log)
+
+
+# Written by ffmpeg next to the variant playlists, and moved to the output path, see hls_cmd
+HLS_MASTER = 'master.m3u8'
+
+
+def hls_cmd(src, outdir, conf, threads=None, info=None):
+    """
+    ffmpeg command that encodes *src* once into all rungs of the HLS ladder of *conf* that aren't
+    larger than the source, with keyframes at the same times so players can switch between rungs at
+    every segment. Writes segments, variant playlists and master playlist HLS_MASTER into *outdir*.
+    Returns command and the rungs it makes.
+    """
+    ladder = conf['ladder']
+    rungs = [r for r in ladder if not (info and is_upscale(r, ladder, info['width'], info['height']))]
+    audio = bool(info and info['audio_codec'])
+    seconds = conf.get('segment-seconds', 4)
+    fmp4 = conf.get('segment-type', 'fmp4') == 'fmp4'
+    graph = ['[0:v]split={}{}'.format(len(rungs), ''.join('[v{}]'.format(i) for i in range(len(rungs))))]
+    graph += ['[v{0}]{1}[out{0}]'.format(i, SCALE_FILTER.format(wh=r['wh'])) for i, r in enumerate(rungs)]
+    cmd = ['ffmpeg', '-y', '-i', src, '-filter_complex', ';'.join(graph)]
+    for i in range(len(rungs)):
+        cmd += ['-map', '[out{}]'.format(i)]
+        if audio:
+            cmd += ['-map', '0:a:0']
+    cmd += ['-c:v', 'libx264']
+    for i, rung in enumerate(rungs):
+        cmd += ['-b:v:{}'.format(i), '{}k'.format(rung['bitrate']),
+                '-maxrate:v:{}'.format(i), '{}k'.format(rung['bitrate']),
+                '-bufsize:v:{}'.format(i), '{}k'.format(2 * rung['bitrate'])]
+    # Keyframes only at segment boundaries, the same in all rungs
+    cmd += ['-force_key_frames', 'expr:gte(t,n_forced*{})'.format(seconds), '-sc_threshold', '0']
+    if threads:
+        cmd += ['-threads', str(threads)]
+    if audio:
+        cmd += audio_args(info)
+    cmd += ['-f', 'hls', '-hls_time', str(seconds), '-hls_playlist_type', 'vod',
+            '-hls_flags', 'independent_segments', '-hls_segment_type', 'fmp4' if fmp4 else 'mpegts',
+            '-master_pl_name', HLS_MASTER,
+            '-var_stream_map', ' '.join(('v:{0},a:{0}' if audio else 'v:{0}').format(i) for i in range(len(rungs))),
+            '-hls_segment_filename', osp.join(outdir, 'stream_%v_%03d.{}'.format('m4s' if fmp4 else 'ts'))]
+    if fmp4:
+        cmd += ['-hls_fmp4_init_filename', 'stream_%v_init.mp4']
+    cmd.append(osp.join(outdir, 'stream_%v.m3u8'))
+    return cmd, rungs
+
+
+def move_hls_master(outdir, dest):
+    "Master playlist from *outdir* to *dest* next to it, with URIs of variant playlists relative to *dest*"
+    prefix = osp.basename(outdir) + '/'
+    with open(osp.join(outdir, HLS_MASTER)) as f:
+        lines = [l if l.startswith('#') or not l.strip() else prefix + l for l in f]
+    with open(dest, 'w') as f:
+        f.writelines(lines)
+    os.remove(osp.join(outdir, HLS_MASTER))
 
 
 class VidTranscoder(Transcoder):
@@ -130,67 +552,206 @@ class VidTranscoder(Transcoder):
         :param input:   Video file
         :param cutfrom: Skip to this time [seconds]
         :param cutto:   Until this time [seconds]
-        :return:
+        :return: None if a smaller rendition already has the source's resolution
         """
-        # TODO: copy audio stream if correct format, otherwise transcode
-        # TODO: Find src file timestamp, duration, resolution
-        # TODO: Only transcode if resolution smaller than original
-        cut = "-ss {cut[0]} -to {cut[1]}".format(cut=cutfromto) if cutfromto else ''
-        # See https://trac.ffmpeg.org/wiki/Scaling%20(resizing)%20with%20ffmpeg for info on keeping aspect ratio
-        cmd = ("ffmpeg -y -i {src} {cut} -c:v libx264 -movflags +faststart -vf "
-               "scale=w='min(iw,{conf[wh][0]})':h='min(ih,{conf[wh][1]})':force_original_aspect_ratio=decrease -crf 26 -c:a copy {dest}"
-                .format(src=src, cut=cut, conf=conf, dest=dest))
-        stdout = await self.run_subprocess(cmd.split())
-        # TODO: Find dest file width, height
-        return {'timestamp': None, 'duration': None, 'width': None, 'height': None, 'log': stdout}
+        if conf['ext'] == 'm3u8':
+            return await self.transcode_hls(src, dest, conf)
+        info = await self.probe(src)
+        if info and is_upscale(conf, video_resolutions, info['width'], info['height']):
+            return None
+        cut = ['-ss', str(cutfromto[0]), '-to', str(cutfromto[1])] if cutfromto else []
+        cmd = ['ffmpeg', '-y', '-i', src] + cut + video_args(info, conf, self.threads) + \
+            ['-movflags', '+faststart', dest]
+        log = await self.run_subprocess(cmd, duration=(info or {}).get('duration'))
+        return await self.output_stat(info, dest, log)
+
+    async def transcode_hls(self, src, dest, conf):
+        """
+        HLS playlist at *dest* with all rungs of the ladder in *conf*, from a single encode.
+        Segments and variant playlists go in its companion directory, so the media has one entry for streaming.
+        """
+        info = await self.probe(src)
+        outdir = companion_dir(dest)
+        os.makedirs(outdir, exist_ok=True)
+        cmd, rungs = hls_cmd(src, outdir, conf, self.threads, info)
+        log = await self.run_subprocess(cmd, duration=(info or {}).get('duration'))
+        move_hls_master(outdir, dest)
+        # Size of the largest rung
+        stat = await self.output_stat(info, osp.join(outdir, 'stream_{}.m3u8'.format(len(rungs) - 1)), log)
+        stat['rungs'] = [r['name'] for r in rungs]
+        return stat
+
+
+# EXIF orientation of photos taken with the camera turned, and how to turn them upright
+ORIENTATION_TAG = 274
+ORIENTATION_TRANSPOSES = {
+    2: Image.FLIP_LEFT_RIGHT,
+    3: Image.ROTATE_180,
+    4: Image.FLIP_TOP_BOTTOM,
+    5: Image.TRANSPOSE,
+    6: Image.ROTATE_270,
+    7: Image.TRANSVERSE,
+    8: Image.ROTATE_90,
+}
+
+
+def image_orientation(im):
+    "EXIF orientation, 1 if upright or unknown"
+    try:
+        exif = im._getexif() if hasattr(im, '_getexif') else None
+    except Exception:
+        exif = None
+    return (exif or {}).get(ORIENTATION_TAG, 1)
+
+
+def fit_size(width, height, wh):
+    "Size of image scaled to fit in *wh* keeping aspect ratio, never larger than it is"
+    scale = min(1, wh[0] / width, wh[1] / height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def transcode_images(src, dests, confs, all_confs=image_resolutions):
+    """
+    All renditions of an image from a single decode, largest first and every next one scaled
+    down from the one before. JPEGs are decoded at the smallest of 1/1, 1/2, 1/4 or 1/8
+    scale that's still large enough for the largest rendition, so a 48 MP photo isn't decoded fully.
+    Blocking, run this in a ProcessPoolExecutor so Pillow doesn't hold the event loop's GIL.
+    Module level function, so it can be pickled.
+    Returns result per conf, None for confs that a smaller conf of *all_confs* already has the resolution for.
+    """
+    logger.debug("Running transcode_images")
+    out = [None] * len(confs)
+    with Image.open(src) as im:
+        orientation = image_orientation(im)
+        turned = orientation in (5, 6, 7, 8)
+        width, height = im.size[::-1] if turned else im.size
+        todo = [i for i, conf in enumerate(confs) if not is_upscale(conf, all_confs, width, height)]
+        if not todo:
+            return out
+        sizes = {i: fit_size(width, height, confs[i]['wh']) for i in todo}
+        todo.sort(key=lambda i: sizes[i][0] * sizes[i][1], reverse=True)
+        largest = sizes[todo[0]]
+        im.draft('RGB', largest[::-1] if turned else largest)
+        # E.g. CMYK JPEGs and palette PNGs, browsers and resizing want RGB
+        img = im if im.mode in ('RGB', 'L') else im.convert('RGB')
+        if orientation in ORIENTATION_TRANSPOSES:
+            img = img.transpose(ORIENTATION_TRANSPOSES[orientation])
+        for i in todo:
+            if img.size != sizes[i]:
+                img = img.resize(sizes[i], Image.LANCZOS)
+            img.save(dests[i], **image_formats[confs[i]['ext']])
+            # EXIF has local time without a time zone, so no timestamp
+            out[i] = {'timestamp': None, 'width': img.width, 'height': img.height}
+    return out
+
+
+# Every libx264 encoder logs its average bitrate when done, in order of outputs
+X264_BITRATE = re.compile(r'\[libx264 @ [^\]]+\] kb/s:([\d.]+)')
+
+
+def multi_rendition_cmd(src, dests, confs, threads=None, info=None):
+    """
+    ffmpeg command that decodes *src* once and splits it into one output per conf.
+    Confs with ext jpg get a thumbnail, the others an H.264 rendition like VidTranscoder's,
+    copied if *info* of the source allows.
+    """
+    # Copied renditions take the source stream, others an output of the filter graph
+    filtered = [i for i, conf in enumerate(confs) if conf['ext'] == 'jpg' or not can_copy_video(info, conf)]
+    graph = []
+    if filtered:
+        graph.append('[0:v]split={}{}'.format(len(filtered), ''.join('[v{}]'.format(i) for i in filtered)))
+    for i in filtered:
+        scale = SCALE_FILTER.format(wh=confs[i]['wh'])
+        if confs[i]['ext'] == 'jpg':
+            scale = 'thumbnail,' + scale
+        graph.append('[v{0}]{1}[out{0}]'.format(i, scale))
+    cmd = ['ffmpeg', '-y', '-i', src]
+    if graph:
+        cmd += ['-filter_complex', ';'.join(graph)]
+    for i, (dest, conf) in enumerate(zip(dests, confs)):
+        if conf['ext'] == 'jpg':
+            cmd += ['-map', '[out{}]'.format(i), '-frames:v', '1', '-an']
+        else:
+            # Audio is optional, there might be none
+            cmd += ['-map', '[out{}]'.format(i) if i in filtered else '0:v:0', '-map', '0:a:0?']
+            cmd += video_args(info, conf, threads, scale=False) + ['-movflags', '+faststart']
+        cmd.append(dest)
+    return cmd
+
+
+class MultiVidTranscoder(VidTranscoder):
+    """
+    Video renditions and thumbnail in a single ffmpeg process, so the source is decoded only once.
+    Put one job with all confs under 'outputs' on the queue, see mediaconfig.video_single_pass.
+    HLS confs are done as VidTranscoder does them, in their own single pass.
+    """
+    async def transcode(self, src, dest, conf):
+        return (await self.transcode_many(src, [dest], [conf]))[0]
+
+    async def transcode_many(self, src, dests, confs):
+        hls = [i for i, conf in enumerate(confs) if conf['ext'] == 'm3u8']
+        if hls:
+            rest = [i for i in range(len(confs)) if i not in hls]
+            out = [None] * len(confs)
+            for i in hls:
+                out[i] = await self.transcode_hls(src, dests[i], confs[i])
+            if rest:
+                for i, stat in zip(rest, await self.transcode_many(src, [dests[i] for i in rest],
+                                                                   [confs[i] for i in rest])):
+                    out[i] = stat
+            return out
+        info = await self.probe(src)
+        # None for skipped confs. Against all of video_resolutions like VidTranscoder, *confs* might be only
+        # those that weren't in the transcode cache.
+        todo = [i for i, conf in enumerate(confs)
+                if not (info and is_upscale(conf, video_resolutions, info['width'], info['height']))]
+        log = await self.run_subprocess(multi_rendition_cmd(
+            src, [dests[i] for i in todo], [confs[i] for i in todo], self.threads, info),
+            duration=(info or {}).get('duration'))
+        bitrates = iter(X264_BITRATE.findall(log))
+        out = [None] * len(confs)
+        for i in todo:
+            dest, conf = dests[i], confs[i]
+            stat = await self.output_stat(info, dest, log)
+            stat['bytes'] = osp.getsize(dest)
+            if conf['ext'] != 'jpg' and not can_copy_video(info, conf):
+                bitrate = next(bitrates, None)
+                stat['bitrate_kbps'] = float(bitrate) if bitrate else None
+            logger.info("Output %s of %s: %sx%s, %s bytes, %s kb/s", conf['name'], src, stat['width'],
+                        stat['height'], stat['bytes'], stat.get('bitrate_kbps'))
+            out[i] = stat
+        return out
 
 
 class ImageTranscoder(Transcoder):
     def init(self):
-        # Just one thread, make concurrent by instantiating multiple ImageTranscoder classes
-        self.executor = ThreadPoolExecutor(1)
+        # Usually one executor is shared by all image transcoders, see TranscodeComponent
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(1)
 
-    def _transcode(self, src, dest, conf):
-        """
-        Run this blocking function in ThreadPoolExecutor.
-        Not sure how and when the termination signal propagates to child threads.
-        """
-        logger.debug("Running _transcode")
-        im = Image.open(src)
-        newim = im.copy()
-        # Modifies in-place
-        newim.thumbnail(conf['wh'])
-        newim.save(dest, format='JPEG')
-        # TODO: Find src file timestamp
-        # TODO: Find dest file width/height
-        return {'timestamp': None, 'width': None, 'height': None}
-
-    async def transcode(self, *args):
+    async def transcode(self, src, dest, conf):
+        return (await self.transcode_many(src, [dest], [conf]))[0]
+
+    async def transcode_many(self, src, dests, confs):
+        "Decodes the image once for all confs, put one job with all confs under 'outputs' on the queue"
         # Avoid blocking eventloop
-        logger.debug("Running transcode in ThreadPoolExecutor")
-        return await self.loop.run_in_executor(self.executor, self._transcode, *args)
+        logger.debug("Running transcode in ProcessPoolExecutor")
+        return await self.loop.run_in_executor(self.executor, transcode_images, src, dests, confs)
 
 
 class AudioTranscoder(Transcoder):
     async def transcode(self, src, dest, conf):
-        "Keep same bitrate preferably"
-        # Ignore returncode as ffmpeg will show info but exit saying it needs output file
-        info = await self.run_subprocess(['ffmpeg', '-i', src], ignore_returncode=True)
-        bitrate = 1000
-        try:
-            res = re.search('bitrate:\s*([\d\.]+)\s*kb\/s', info)
-            bitrate = int(res.group(1))
-        except (AttributeError, ValueError) as e:
-            logger.warning("Could not find audio bitrate in ffmpeg info string: %s\nError: %s", info, str(e))
-        bitrate = min(bitrate, conf.get('max-bitrate', 128))
-        # Encode as AAC, add some flags to move metadata to start of file for fast playback start
-        log = await self.run_subprocess(
-            ['ffmpeg', '-i', src, '-c:a', 'aac', '-movflags', '+faststart', '-b:a', '{:.0f}k'.format(bitrate), dest])
-        duration = None
-        try:
-            res = re.search('Duration:\s*(\d+):(\d+):([\d\.]+)', log)
-            # The simplicity, I love it!
-            duration = float(res.group(1))*3600 + float(res.group(2))*60 + float(res.group(3))
-        except (AttributeError, ValueError):
-            logger.warning("Could not find duration of audio file in log %s", log)
-        return {'timestamp': None, 'duration': duration, 'log': log}
+        "Keep same bitrate preferably, and the stream itself if it's AAC already"
+        info = await self.probe(src) or {}
+        max_bitrate = conf.get('max-bitrate', AUDIO_BITRATE)
+        bitrate = info.get('audio_bitrate')
+        if info.get('audio_codec') in COPY_AUDIO_CODECS and bitrate and bitrate <= max_bitrate:
+            codec = ['-c:a', 'copy']
+        else:
+            codec = ['-c:a', 'aac', '-b:a', '{:.0f}k'.format(min(bitrate or max_bitrate, max_bitrate))]
+        # Add some flags to move metadata to start of file for fast playback start
+        log = await self.run_subprocess(['ffmpeg', '-y', '-i', src, '-vn'] + codec + ['-movflags', '+faststart', dest],
+                                        duration=info.get('duration'))
+        stat = await self.output_stat(info, dest, log)
+        del stat['width'], stat['height']
+        return stat
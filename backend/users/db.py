@@ -1,3 +1,4 @@
+import io
 import logging
 import asyncio
 import datetime
@@ -9,7 +10,8 @@ import unittest
 import dateutil.parser
 import asyncpg
 
-from ..utils import record_to_dict, friendlyhash, getLogger, friendly_auth_code, db_test_case_factory
+from ..utils import record_to_dict, friendlyhash, getLogger, friendly_auth_code, db_test_case_factory, \
+    iter_json_records, import_chunks
 
 logger = getLogger('users.db')
 
@@ -63,6 +65,31 @@ CREATE TABLE users_bio
 CREATE INDEX users_bio_user_id on users_bio(user_id);
 '''
 
+USER_IMPORT_COLUMNS = ('id_hash', 'auth_code', 'created', 'first_name', 'last_name', 'email', 'telephone_mobile')
+
+
+def user_row(userjson, id_hash, auth_code):
+    "Values of user columns in USER_IMPORT_COLUMNS order from user json"
+    created = userjson.get('created', datetime.datetime.utcnow())
+    # Parse if ISO string time
+    created = created if type(created) == datetime.datetime else dateutil.parser.parse(created)
+    return (id_hash, auth_code, created, userjson.get('first_name'), userjson.get('last_name'), userjson['email'],
+            userjson.get('telephone_mobile'))
+
+
+async def unique_codes(conn, column, n, generate):
+    """
+    *n* distinct codes from coroutine function *generate* that are not in *column* of users yet.
+    Checked in bulk, instead of retrying every insert on a collision.
+    """
+    codes = set()
+    while len(codes) < n:
+        while len(codes) < n:
+            codes.add(await generate())
+        taken = await conn.fetch('SELECT {0} FROM users WHERE {0} = ANY($1::BPCHAR[]);'.format(column), list(codes))
+        codes.difference_update(r[column] for r in taken)
+    return list(codes)
+
 
 class Db():
     @classmethod
@@ -153,6 +180,24 @@ class Db():
 
         return id
 
+    async def import_users(self, users, chunk_size=1000, existingconn=None):
+        """
+        Bulk insert an iterable of user json, e.g. from iter_json_records, with COPY in chunks
+        of *chunk_size* users. Every chunk is a transaction. Returns number of users imported.
+        """
+        async def import_chunk(conn, chunk):
+            async with conn.transaction():
+                id_hashes = await unique_codes(conn, 'id_hash', len(chunk), friendlyhash)
+                auth_codes = await unique_codes(conn, 'auth_code', len(chunk), friendly_auth_code)
+                rows = [user_row(u, h, a) for u, h, a in zip(chunk, id_hashes, auth_codes)]
+                await conn.copy_records_to_table('users', records=rows, columns=USER_IMPORT_COLUMNS)
+            return len(rows)
+
+        if existingconn:
+            return await import_chunks(users, lambda chunk: import_chunk(existingconn, chunk), chunk_size, 'users')
+        async with self.pool.acquire() as conn:
+            return await import_chunks(users, lambda chunk: import_chunk(conn, chunk), chunk_size, 'users')
+
 
 class TestDb(db_test_case_factory(Db)):
     def test_basics(self):
@@ -177,6 +222,30 @@ class TestDb(db_test_case_factory(Db)):
         # Insert identical id_hash
         self.assertRaises(asyncpg.exceptions.UniqueViolationError, self.awrap(db.insertuser), user_1, id_hash=fh)
 
+    def test_import(self):
+        users = [{'first_name': 'Athlete {}'.format(i), 'email': 'import-{}@there431-9581345098-2435.com'.format(i),
+                  'created': '2017-06-01T12:00:00'} for i in range(1500)]
+        ndjson = io.StringIO(''.join(json.dumps(u) + '\n' for u in users))
+        n = self.lru(self.db.import_users(iter_json_records(ndjson), chunk_size=1000, existingconn=self.conn))
+        self.assertEqual(n, 1500)
+        rows = self.lru(self.conn.fetch("SELECT id_hash, auth_code, created FROM users WHERE email LIKE 'import-%'"))
+        self.assertEqual(len(rows), 1500)
+        self.assertEqual(len({r['id_hash'] for r in rows}), 1500)
+        self.assertEqual(len({r['auth_code'] for r in rows}), 1500)
+        self.assertEqual(rows[0]['created'], datetime.datetime(2017, 6, 1, 12))
+        # Imported users can log in
+        self.assertTrue(self.lru(self.db.check_auth(rows[0]['auth_code'])))
+
+    def test_import_testdata(self):
+        path = 'testdata/stjean/athletes.json'
+        with open(path) as f:
+            if f.read(40).startswith('version https://git-lfs'):
+                self.skipTest("{} not fetched from git LFS".format(path))
+        with open(path) as f:
+            n = len(json.load(f))
+        with open(path) as f:
+            self.assertEqual(self.lru(self.db.import_users(iter_json_records(f), existingconn=self.conn)), n)
+
 
 if __name__=="__main__":
     logging.basicConfig(
@@ -191,7 +260,9 @@ if __name__=="__main__":
     parser.add_argument('--test', action='store_true',
                         help="Test on real db using nested transactions")
     parser.add_argument('--importusers',
-                        help="Import json file with list of users into db")
+                        help="Import json file with list of users, or one user per line, into db")
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help="Users per COPY when importing")
     args = parser.parse_args()
 
     l = asyncio.get_event_loop()
@@ -207,13 +278,10 @@ if __name__=="__main__":
 
     if args.importusers:
         try:
-            with open(args.importusers, 'r') as f:
-                users = json.load(f)
-            if not 'y' in input("Continue loading {} messages? [y/N] ".format(len(users))).lower():
+            if not 'y' in input("Continue loading users from {}? [y/N] ".format(args.importusers)).lower():
                 raise Warning("Exiting...")
-            coros = [db.insertuser(u) for u in users]
-            l.run_until_complete(asyncio.wait(coros))
-            logger.info("Inserted all users")
+            with open(args.importusers, 'r') as f:
+                l.run_until_complete(db.import_users(iter_json_records(f), chunk_size=args.chunk_size))
         finally:
             l.close()
         logger.info("Completed successfully")
@@ -3,6 +3,7 @@ import re
 import sys
 import uuid
 import json
+import time
 import signal
 import asyncio
 import asyncpg
@@ -10,6 +11,7 @@ import logging
 import datetime
 import unittest
 import pytz
+from collections import OrderedDict
 
 import dateutil.parser
 from hashids import Hashids
@@ -58,25 +60,31 @@ def ptz_wkt_to_dict(ptz_wkt):
     }
 
 
+def media_to_dict(ml, exclude=set()):
+    "From json list of media rows to {<media_type>: {<conf_name>: {...}}, ...}"
+    # Already decoded if the connection has json codecs
+    if isinstance(ml, str):
+        ml = json.loads(ml)
+    mo = dict()
+    for m in ml:
+        typ = m['type']
+        if not mo.get(typ):
+            mo[typ] = dict()
+        conf_name = m['conf_name']
+        # Exclude None config names
+        if conf_name:
+            # Exclude sensitive keys in media dict as well
+            mo[typ][conf_name] = {k:v for k,v in m.items() if k not in exclude}
+    return mo
+
+
 async def record_to_dict(record, exclude=set(), parse_media=True, parse_ptz=True):
     "Transform record to json, exclude keys if needed"
     out = {}
     for k,v in record.items():
         # Parse media if not None
         if k == 'media' and parse_media and v:
-            ml = json.loads(v)
-            mo = dict()
-            for m in ml:
-                typ = m['type']
-                if not mo.get(typ):
-                    mo[typ] = dict()
-                # {<media_type>: {<conf_name>: {...}}, ...}
-                conf_name = m['conf_name']
-                # Exclude None config names
-                if conf_name:
-                    # Exclude sensitive keys in media dict as well
-                    mo[typ][conf_name] = {k:v for k,v in m.items() if k not in exclude}
-            out[k] = mo
+            out[k] = media_to_dict(v, exclude)
         elif parse_ptz and k == 'ptz':
             # Convert WKT to custom dict
             out[k] = ptz_wkt_to_dict(v)
@@ -99,6 +107,73 @@ async def records_to_dict(records, **kwargs):
     return out
 
 
+class RecordConverter():
+    """
+    Synchronous version of record_to_dict for connections with json codecs (see create_pool),
+    so json columns are decoded already and strings are not sniffed.
+    Which columns to skip or transform is worked out from the first record,
+    so use one converter per query shape.
+    """
+    def __init__(self, exclude=set(), parse_media=True, parse_ptz=True):
+        self.exclude = set(exclude)
+        self.parse_media = parse_media
+        self.parse_ptz = parse_ptz
+        # [(<column name>, <transform function or None>), ...]
+        self.columns = None
+
+    def plan(self, record):
+        columns = []
+        for k in record.keys():
+            if k == 'media' and self.parse_media:
+                columns.append((k, self.media))
+            elif k == 'ptz' and self.parse_ptz:
+                columns.append((k, ptz_wkt_to_dict))
+            elif k not in self.exclude:
+                columns.append((k, None))
+        return columns
+
+    def media(self, ml):
+        return media_to_dict(ml, self.exclude)
+
+    def __call__(self, record):
+        columns = self.columns
+        # Re-plan if used for another shape after all, e.g. after a migration added a column
+        if columns is None or len(record) != self.ncolumns:
+            columns = self.columns = self.plan(record)
+            self.ncolumns = len(record)
+        out = {}
+        for k, fn in columns:
+            v = record[k]
+            if v is None:
+                pass
+            elif fn is not None:
+                v = fn(v)
+            # Json parser cannot serialize datetime by default
+            elif type(v) is datetime.datetime:
+                v = v.isoformat()
+            out[k] = v
+        return out
+
+    def many(self, records):
+        return [self(r) for r in records]
+
+
+def encode_json(v):
+    "Strings are passed as-is, so callers that json.dumps themselves keep working"
+    return v if isinstance(v, str) else json.dumps(v)
+
+
+async def init_connection(conn):
+    "Decode json and jsonb columns on every connection, instead of sniffing strings afterwards"
+    for typ in ('json', 'jsonb'):
+        await conn.set_type_codec(typ, encoder=encode_json, decoder=json.loads, schema='pg_catalog')
+
+
+async def create_pool(dsn=None, **kwargs):
+    "Pool with json codecs, defaults to the site database"
+    return await asyncpg.create_pool(dsn=dsn or os.environ["DB_URI_ATSITE"], init=init_connection, **kwargs)
+
+
 async def friendlyhash(length=8):
     "Generate random hash"
     h = Hashids(salt=str(uuid.uuid4()), min_length=length)
@@ -112,6 +187,112 @@ async def friendly_auth_code(length=12):
     return h.encode(456)[:length]
 
 
+JSON_SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_json_records(f, bufsize=1 << 16):
+    """
+    Yield records from a file with a json list of objects or with one json object per line (NDJSON),
+    without loading the whole file.
+    """
+    decoder = json.JSONDecoder()
+    buf = f.read(bufsize).lstrip()
+    if not buf.startswith('['):
+        # NDJSON
+        for line in (buf + f.readline()).splitlines() if buf else ():
+            if line.strip():
+                yield json.loads(line)
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+        return
+    pos = 1
+    while True:
+        # Skip whitespace and separators between records
+        pos = JSON_SEPARATORS.match(buf, pos).end()
+        if buf.startswith(']', pos):
+            return
+        try:
+            record, end = decoder.raw_decode(buf, pos)
+        except ValueError:
+            more = f.read(bufsize)
+            if not more:
+                raise
+            buf = buf[pos:] + more
+            pos = 0
+            continue
+        yield record
+        pos = end
+
+
+async def import_chunks(records, import_chunk, chunk_size=1000, name='records'):
+    """
+    Pass *records* to coroutine function *import_chunk* in lists of *chunk_size*, one at a time,
+    logging progress in rows per second. Returns number of rows imported.
+    """
+    start = time.monotonic()
+    n = 0
+    chunk = []
+    for record in records:
+        chunk.append(record)
+        if len(chunk) < chunk_size:
+            continue
+        n += await import_chunk(chunk)
+        chunk = []
+        logger.info("Imported %s %s, %.0f/s", n, name, n / max(time.monotonic() - start, 1e-6))
+    if chunk:
+        n += await import_chunk(chunk)
+    elapsed = time.monotonic() - start
+    logger.info("Imported %s %s in %.1fs, %.0f/s", n, name, elapsed, n / max(elapsed, 1e-6))
+    return n
+
+
+class TTLCache():
+    """
+    In-process cache where entries expire after *ttl* seconds.
+    Falsy values (e.g. a failed lookup) are cached as well, for *negative_ttl* seconds.
+    Raises KeyError on missing or expired keys, like a dict.
+    """
+    def __init__(self, ttl, negative_ttl=None, maxsize=10000):
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.maxsize = maxsize
+        # {<key>: (<value>, <expiry monotonic time>)}, oldest first
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __getitem__(self, key):
+        try:
+            value, expires = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            raise
+        if expires < time.monotonic():
+            del self.entries[key]
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        return value
+
+    def __setitem__(self, key, value):
+        ttl = self.ttl if value else self.negative_ttl
+        self.entries.pop(key, None)
+        self.entries[key] = (value, time.monotonic() + ttl)
+        if len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def invalidate(self, key=None):
+        "Remove one key, or everything if no key given"
+        if key is None:
+            self.entries.clear()
+        else:
+            self.entries.pop(key, None)
+
+
 class BackendAppSession(ApplicationSession):
     def __init__(self, config=None):
         ApplicationSession.__init__(self, config)
@@ -178,11 +359,14 @@ class BackendAppSession(ApplicationSession):
 
 class MicroserviceDb():
     "Inherit from this class to create service Db"
+    # Connections decode json and jsonb columns
+    json_codecs = True
+
     @classmethod
     async def create(cls, existingconn=None):
         "Pass existingconn for unittesting"
         db = cls()
-        db.pool = existingconn or await asyncpg.create_pool(dsn=os.environ["DB_URI_ATSITE"])
+        db.pool = existingconn or await create_pool()
         return db
 
 
@@ -198,6 +382,9 @@ def db_test_case_factory(db_cls):
             # Easy access
             self.lru = self.l.run_until_complete
             self.conn = self.lru(asyncpg.connect(dsn=os.environ["DB_URI_ATSITE"]))
+            # Same codecs as the pools, if the service uses them
+            if getattr(db_cls, 'json_codecs', False):
+                self.lru(init_connection(self.conn))
             self.t = self.conn.transaction()
             self.lru(self.t.start())
             self.db = self.lru(db_cls.create(existingconn=self.conn))
@@ -20,6 +20,18 @@ function widthMax(w) {
     return window.matchMedia(`(max-device-width: ${w}px)`).matches;
 }
 
+/*
+ * Rendition by conf_name, or the largest one that is smaller if it wasn't made,
+ * e.g. no 1080 of a 480p video because it wouldn't be larger than the 720
+ */
+function pickRendition(renditions, res) {
+    if (renditions[res]) return renditions[res];
+    let sizes = Object.keys(renditions).map(Number).filter(n => !isNaN(n)).sort((a, b) => a - b);
+    if (!sizes.length) return renditions.thumb;
+    let smaller = sizes.filter(n => n <= Number(res));
+    return renditions[smaller.length ? smaller[smaller.length - 1] : sizes[0]];
+}
+
 /*
  * Wire up db, map and timeline
  */
@@ -277,10 +289,12 @@ let overlay = new Ractive({
             } else if (widthMax(800)) {
                 res = '360';
             }
-            if (msg.media.video) {
-                this.set('vidsrc', '/media/'+msg.media.video[res].path);
-            } else if (msg.media.image) {
-                this.set('imgsrc', '/media/'+msg.media.image[res].path);
+            let video = msg.media.video && pickRendition(msg.media.video, res);
+            let image = msg.media.image && pickRendition(msg.media.image, res);
+            if (video) {
+                this.set('vidsrc', '/media/'+video.path);
+            } else if (image) {
+                this.set('imgsrc', '/media/'+image.path);
             }
             this.set('visible', true);
             return false;
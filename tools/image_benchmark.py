@@ -0,0 +1,112 @@
+"""
+Benchmark of making all image renditions of mediaconfig from large phone-sized JPEGs, the earlier way
+of decoding the full image for every rendition against transcoder.transcode_images' single draft decode.
+
+Every method and image size runs in a fresh process, so peak RSS is of that run only. Needs Pillow, e.g.
+> python -m tools.image_benchmark --megapixels 12 24 48 --repeat 5
+"""
+import os
+import json
+import time
+import resource
+import tempfile
+import multiprocessing
+import os.path as osp
+
+# Avoid Sentry being loaded
+os.environ.setdefault('AT_SENTRY_DSN', '')
+
+from PIL import Image
+
+from backend.utils import getLogger
+from backend.transcode.transcoder import transcode_images, is_upscale, ORIENTATION_TAG
+from backend.transcode.mediaconfig import image_resolutions
+
+logger = getLogger('image_benchmark')
+
+
+def generate_photo(path, megapixels, orientation=6):
+    "4:3 JPEG with some texture, stored turned like a portrait phone photo"
+    width = int((megapixels * 1e6 * 4 / 3) ** .5)
+    height = width * 3 // 4
+    noise = Image.effect_noise((width // 8, height // 8), 64).resize((width, height))
+    gradient = Image.linear_gradient('L').resize((width, height))
+    im = Image.merge('RGB', (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+    exif = Image.Exif()
+    exif[ORIENTATION_TAG] = orientation
+    im.save(path, quality=92, exif=exif.tobytes())
+
+
+def legacy(src, dests, confs):
+    "Full decode and copy per rendition, as done before transcode_images"
+    out = []
+    for dest, conf in zip(dests, confs):
+        im = Image.open(src)
+        if is_upscale(conf, confs, *im.size):
+            out.append(None)
+            continue
+        newim = im.copy()
+        newim.thumbnail(conf['wh'])
+        newim.save(dest, format='JPEG')
+        out.append({'width': newim.width, 'height': newim.height})
+    return out
+
+
+METHODS = {'legacy': legacy, 'single_decode': transcode_images}
+
+
+def run_method(name, src, outdir, repeat, results):
+    "In a child process"
+    dests = [osp.join(outdir, '{}-{}.{}'.format(name, c['name'], c['ext'])) for c in image_resolutions]
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        METHODS[name](src, dests, image_resolutions)
+        times.append((time.perf_counter() - start) * 1000)
+    results.put({
+        'ms_per_image': round(min(times), 1),
+        'ms_per_image_avg': round(sum(times) / len(times), 1),
+        # Kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        'bytes': {osp.basename(d): osp.getsize(d) for d in dests if osp.exists(d)},
+    })
+
+
+def measure(name, src, outdir, repeat):
+    # Spawn, so the child doesn't start with our memory
+    ctx = multiprocessing.get_context('spawn')
+    results = ctx.Queue()
+    proc = ctx.Process(target=run_method, args=(name, src, outdir, repeat, results))
+    proc.start()
+    result = results.get()
+    proc.join()
+    logger.info("%s: %s", name, result)
+    return result
+
+
+def run(args):
+    tmpdir = tempfile.mkdtemp(prefix='image-benchmark-')
+    report = {'args': vars(args), 'images': {}}
+    for mp in args.megapixels:
+        src = osp.join(tmpdir, '{}mp.jpg'.format(mp))
+        generate_photo(src, mp)
+        result = {'source_bytes': osp.getsize(src)}
+        for name in METHODS:
+            result[name] = measure(name, src, tmpdir, args.repeat)
+        result['speedup'] = round(result['legacy']['ms_per_image'] / result['single_decode']['ms_per_image'], 2)
+        report['images']['{}mp'.format(mp)] = result
+    return report
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare per-rendition and single-decode image transcoding")
+    parser.add_argument('--megapixels', type=float, nargs='+', default=[12, 24, 48], help="Sizes of test photos")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per method and size, best is reported")
+    parser.add_argument('--report', default='image_benchmark_report.json', help="Write JSON report here")
+    args = parser.parse_args()
+
+    report = run(args)
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Report written to %s:\n%s", args.report, json.dumps(report, indent=2))
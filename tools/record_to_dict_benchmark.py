@@ -0,0 +1,105 @@
+"""
+Microbenchmark of converting query results to dicts, the async record_to_dict path
+versus the synchronous RecordConverter with json codecs.
+
+Uses in-memory rows shaped like public message rows by default, or pass --db to fetch
+the same shape from Postgres (needs DB_URI_ATSITE), with and without json codecs.
+E.g. > python -m tools.record_to_dict_benchmark --rows 10000 --db
+"""
+import os
+import json
+import time
+import asyncio
+import datetime
+
+# Avoid Sentry being loaded
+os.environ.setdefault('AT_SENTRY_DSN', '')
+
+import asyncpg
+
+from backend.utils import getLogger, records_to_dict, RecordConverter, init_connection
+
+logger = getLogger('record_to_dict_benchmark')
+
+EXCLUDE = {'telegram_message', 'log'}
+
+SQL_ROWS = '''
+SELECT i AS id, -1 AS user_id, '2017-06-01 12:00'::TIMESTAMP AS received,
+  '2017-06-01 12:00'::TIMESTAMP - i * interval '1 minute' AS timestamp,
+  'Message ' || i AS title, repeat('Lorem ipsum ', 20) AS text, 1.5 + i / 1e5 AS lon, 43.2 AS lat,
+  'interpolated' AS location_source,
+  json_build_array(
+    json_build_object('id', i * 2, 'msg_id', i, 'type', 'image', 'conf_name', 'thumb', 'path', 'img/' || i || '.jpg',
+                      'width', 320, 'height', 240, 'original', FALSE),
+    json_build_object('id', i * 2 + 1, 'msg_id', i, 'type', 'image', 'conf_name', '1080', 'path', 'img/' || i || '.jpg',
+                      'width', 1920, 'height', 1440, 'original', FALSE)) AS media
+FROM generate_series(1, $1) AS i;
+'''
+
+
+def fake_rows(n, decoded):
+    "Message-like rows as dicts, media as json string like without codecs, or decoded like with codecs"
+    now = datetime.datetime(2017, 6, 1, 12)
+    rows = []
+    for i in range(n):
+        media = [{'id': i * 2, 'msg_id': i, 'type': 'image', 'conf_name': 'thumb', 'path': 'img/{}.jpg'.format(i),
+                  'width': 320, 'height': 240, 'original': False},
+                 {'id': i * 2 + 1, 'msg_id': i, 'type': 'image', 'conf_name': '1080', 'path': 'img/{}.jpg'.format(i),
+                  'width': 1920, 'height': 1440, 'original': False}]
+        rows.append({'id': i, 'user_id': -1, 'received': now, 'timestamp': now - datetime.timedelta(minutes=i),
+                     'title': 'Message {}'.format(i), 'text': 'Lorem ipsum ' * 20, 'lon': 1.5 + i / 1e5, 'lat': 43.2,
+                     'location_source': 'interpolated', 'media': media if decoded else json.dumps(media)})
+    return rows
+
+
+async def fetch_rows(n, codecs):
+    conn = await asyncpg.connect(dsn=os.environ["DB_URI_ATSITE"])
+    try:
+        if codecs:
+            await init_connection(conn)
+        return await conn.fetch(SQL_ROWS, n)
+    finally:
+        await conn.close()
+
+
+def rate(n, seconds):
+    return round(n / seconds) if seconds else None
+
+
+async def run(args):
+    if args.db:
+        legacy_rows = await fetch_rows(args.rows, codecs=False)
+        codec_rows = await fetch_rows(args.rows, codecs=True)
+    else:
+        legacy_rows = fake_rows(args.rows, decoded=False)
+        codec_rows = fake_rows(args.rows, decoded=True)
+    results = {'rows': args.rows, 'source': 'postgres' if args.db else 'memory'}
+    best = {}
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        legacy = await records_to_dict(legacy_rows, exclude=EXCLUDE)
+        t_legacy = time.perf_counter() - start
+        # Converter is built once per query shape, so include planning in the timing
+        start = time.perf_counter()
+        fast = RecordConverter(exclude=EXCLUDE).many(codec_rows)
+        t_fast = time.perf_counter() - start
+        best['legacy'] = min(best.get('legacy', t_legacy), t_legacy)
+        best['converter'] = min(best.get('converter', t_fast), t_fast)
+    if legacy != fast:
+        raise AssertionError("Both paths should give the same output")
+    results['legacy_rows_per_sec'] = rate(args.rows, best['legacy'])
+    results['converter_rows_per_sec'] = rate(args.rows, best['converter'])
+    results['speedup'] = round(best['legacy'] / best['converter'], 2)
+    return results
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark record_to_dict against RecordConverter")
+    parser.add_argument('--rows', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5, help="Report best of this many runs")
+    parser.add_argument('--db', action='store_true', help="Fetch rows from Postgres instead of building them")
+    args = parser.parse_args()
+
+    results = asyncio.get_event_loop().run_until_complete(run(args))
+    logger.info("Results:\n%s", json.dumps(results, indent=2))
@@ -0,0 +1,341 @@
+"""
+Load generator for the SkyLines live tracking ingest.
+
+Simulates pilots flying synthetic circles or an IGC track, sending fix and ping packets
+in the SkyLines UDP protocol (see *backend/location/livetracking_skylines*).
+Measures ping packet loss and round trip time, and, if tracking keys are mapped to user hashes,
+subscribes to the ``at.public.location.user.<hash>`` channels to measure fix-to-publish latency
+and how many fixes per second make it through the server.
+
+E.g. > python -m tools.skylines_loadgen --pilots 50 --rate 1 --duration 60 --igc testdata/stjean/stjean.igc
+"""
+import os
+import json
+import math
+import time
+import struct
+import random
+import asyncio
+import datetime
+
+# Avoid Sentry being loaded
+os.environ.setdefault('AT_SENTRY_DSN', '')
+
+from backend.utils import getLogger, convert_to_datetime
+
+logger = getLogger('skylines_loadgen')
+
+# Protocol constants, see backend/location/livetracking_skylines/server.py
+MAGIC = 0x5df4b67b
+TYPE_PING = 1
+TYPE_ACK = 2
+TYPE_FIX = 3
+
+FLAG_LOCATION = 0x1
+FLAG_TRACK = 0x2
+FLAG_GROUND_SPEED = 0x4
+FLAG_ALTITUDE = 0x10
+FLAG_VARIO = 0x20
+
+FLAG_ACK_BAD_KEY = 0x1
+
+# Somewhere above the Pyrenees, used for synthetic tracks
+DEFAULT_CENTER = (43.16, -1.24)
+
+
+def _crc16_table():
+    table = []
+    for i in range(256):
+        crc = i << 8
+        for _ in range(8):
+            crc = ((crc << 1) ^ 0x1021) if crc & 0x8000 else (crc << 1)
+        table.append(crc & 0xffff)
+    return table
+
+CRC16_TABLE = _crc16_table()
+
+
+def crc16xmodem(data, crc=0):
+    "Pure python version of crc16.crc16xmodem, to avoid the C extension dependency"
+    for b in data:
+        crc = ((crc << 8) & 0xffff) ^ CRC16_TABLE[((crc >> 8) ^ b) & 0xff]
+    return crc
+
+
+def set_crc(data):
+    "Same as livetracking_skylines.crc.set_crc, CRC is calculated with zeroed CRC field"
+    crc = crc16xmodem(data[:4])
+    crc = crc16xmodem(b'\0\0', crc)
+    crc = crc16xmodem(data[6:], crc)
+    return data[:4] + struct.pack('!H', crc) + data[6:]
+
+
+def ms_of_day(dt):
+    return ((dt.hour * 60 + dt.minute) * 60 + dt.second) * 1000 + dt.microsecond // 1000
+
+
+def fix_packet(tracking_key, time_ms, latitude, longitude, altitude, track, ground_speed, vario):
+    flags = FLAG_LOCATION | FLAG_TRACK | FLAG_GROUND_SPEED | FLAG_ALTITUDE | FLAG_VARIO
+    data = struct.pack(
+        '!IHHQIIiiIHHHhhH', MAGIC, 0, TYPE_FIX, tracking_key,
+        flags, time_ms, int(latitude * 1000000), int(longitude * 1000000), 0, int(track) % 360,
+        int(ground_speed * 16), 0, int(altitude), int(vario * 256), 0)
+    return set_crc(data)
+
+
+def ping_packet(tracking_key, ping_id):
+    return set_crc(struct.pack('!IHHQHHI', MAGIC, 0, TYPE_PING, tracking_key, ping_id, 0, 0))
+
+
+def read_igc_track(fn):
+    "Returns list of (latitude, longitude, gps altitude) from IGC B records"
+    pts = []
+    with open(fn, 'r', errors='ignore') as f:
+        for line in f:
+            # B HHMMSS DDMMmmmN DDDMMmmmE V PPPPP GGGGG
+            if not line.startswith('B') or len(line) < 35:
+                continue
+            try:
+                lat = int(line[7:9]) + int(line[9:14]) / 60000
+                if line[14] == 'S':
+                    lat = -lat
+                lon = int(line[15:18]) + int(line[18:23]) / 60000
+                if line[23] == 'W':
+                    lon = -lon
+                alt = int(line[30:35])
+            except ValueError:
+                continue
+            pts.append((lat, lon, alt))
+    if not pts:
+        raise Warning("No B records found in {}".format(fn))
+    return pts
+
+
+def synthetic_track(center, n=3600, radius_km=2.0, seed=0):
+    "Thermalling-like drift: circles that slowly move downwind while climbing and gliding"
+    rnd = random.Random(seed)
+    lat0, lon0 = center[0] + rnd.uniform(-0.1, 0.1), center[1] + rnd.uniform(-0.1, 0.1)
+    km_per_deg_lon = 111.32 * math.cos(math.radians(lat0))
+    pts = []
+    for i in range(n):
+        a = 2 * math.pi * i / 30
+        drift = i * 0.005
+        pts.append((lat0 + radius_km * math.sin(a) / 111.32,
+                    lon0 + (radius_km * math.cos(a) + drift) / km_per_deg_lon,
+                    1500 + 500 * math.sin(2 * math.pi * i / 600)))
+    return pts
+
+
+def bearing_and_speed(p1, p2, dt):
+    "Course in degrees and ground speed in m/s between two points"
+    dlat = (p2[0] - p1[0]) * 111320
+    dlon = (p2[1] - p1[1]) * 111320 * math.cos(math.radians(p1[0]))
+    return math.degrees(math.atan2(dlon, dlat)) % 360, math.hypot(dlat, dlon) / dt
+
+
+def percentiles(values, ps=(50, 90, 95, 99)):
+    "Dict of percentiles and max in milliseconds, None if no values"
+    if not values:
+        return None
+    s = sorted(values)
+    out = {'p{}'.format(p): round(1000 * s[min(len(s) - 1, int(len(s) * p / 100))], 3) for p in ps}
+    out['max'] = round(1000 * s[-1], 3)
+    out['mean'] = round(1000 * sum(s) / len(s), 3)
+    return out
+
+
+class LoadgenProtocol(asyncio.DatagramProtocol):
+    "Receives ACKs for pings"
+    def __init__(self, stats):
+        self.stats = stats
+
+    def datagram_received(self, data, addr):
+        if len(data) < 24:
+            return
+        magic, _, typ, _ = struct.unpack('!IHHQ', data[:16])
+        if magic != MAGIC or typ != TYPE_ACK:
+            return
+        ping_id, _, flags = struct.unpack('!HHI', data[16:24])
+        sent = self.stats['pings_in_flight'].pop(ping_id, None)
+        if sent is None:
+            return
+        self.stats['acks_received'] += 1
+        self.stats['ack_rtts'].append(time.monotonic() - sent)
+        if flags & FLAG_ACK_BAD_KEY:
+            self.stats['acks_bad_key'] += 1
+
+    def error_received(self, exc):
+        self.stats['send_errors'] += 1
+
+
+class Pilot:
+    def __init__(self, tracking_key, track, user_id_hash=None, phase=0):
+        self.tracking_key = tracking_key
+        self.track = track
+        self.user_id_hash = user_id_hash
+        self.phase = phase
+        # {<ms of day>: <monotonic send time>} to match published fixes
+        self.sent = {}
+
+    def point(self, i):
+        return self.track[(self.phase + i) % len(self.track)]
+
+
+async def fly(pilot, transport, stats, rate, duration, ping_interval):
+    "Send fixes at *rate* Hz for *duration* seconds"
+    interval = 1 / rate
+    start = time.monotonic()
+    i = 0
+    next_ping = start
+    # Spread pilots over the first interval to avoid bursts
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.monotonic() - start < duration:
+        now = datetime.datetime.utcnow()
+        p1, p2 = pilot.point(i), pilot.point(i + 1)
+        track, speed = bearing_and_speed(p1, p2, 1)
+        t_ms = ms_of_day(now)
+        transport.sendto(fix_packet(pilot.tracking_key, t_ms, p1[0], p1[1], p1[2], track, speed, p2[2] - p1[2]))
+        pilot.sent[t_ms] = time.monotonic()
+        stats['fixes_sent'] += 1
+        if ping_interval and time.monotonic() >= next_ping:
+            stats['ping_counter'] = (stats['ping_counter'] + 1) & 0xffff
+            stats['pings_in_flight'][stats['ping_counter']] = time.monotonic()
+            transport.sendto(ping_packet(pilot.tracking_key, stats['ping_counter']))
+            stats['pings_sent'] += 1
+            next_ping += ping_interval
+        i += 1
+        # Keep schedule instead of drifting with the loop lag
+        await asyncio.sleep(max(0, start + i * interval - time.monotonic()))
+
+
+async def connect_wamp(loop):
+    "Returns joined WAMP session, requires a running crossbar router"
+    from autobahn.asyncio.wamp import ApplicationRunner
+    from backend.utils import BackendAppSession
+    joined = asyncio.Future()
+
+    class LoadgenSession(BackendAppSession):
+        async def onJoin(self, details):
+            joined.set_result(self)
+
+    runner = ApplicationRunner(url="ws://localhost:8080/ws", realm="realm1")
+    await runner.run(LoadgenSession, start_loop=False)
+    return await asyncio.wait_for(joined, 10)
+
+
+async def subscribe_pilots(wampsess, pilots, stats):
+    "Measure time from sending a fix until it is published on the user channel"
+    def handler_factory(pilot):
+        def on_points(gps_points):
+            received = time.monotonic()
+            for ts in gps_points.get('timestamps', []):
+                sent = pilot.sent.pop(ms_of_day(convert_to_datetime(ts)), None)
+                if sent is not None:
+                    stats['fixes_published'] += 1
+                    stats['publish_latencies'].append(received - sent)
+                    stats['publish_times'].append(received)
+        return on_points
+    for pilot in pilots:
+        if pilot.user_id_hash:
+            await wampsess.subscribe(handler_factory(pilot),
+                                     'at.public.location.user.{}'.format(pilot.user_id_hash))
+
+
+def make_report(args, pilots, stats, elapsed):
+    tracked = [p for p in pilots if p.user_id_hash]
+    fixes_tracked = stats['fixes_sent'] * len(tracked) / len(pilots) if pilots else 0
+    pt = stats['publish_times']
+    return {
+        'created': datetime.datetime.utcnow().isoformat(),
+        'config': {'host': args.host, 'port': args.port, 'pilots': len(pilots), 'rate_hz': args.rate,
+                   'duration_s': args.duration, 'igc': args.igc, 'subscribed_pilots': len(tracked)},
+        'elapsed_s': round(elapsed, 3),
+        'fixes_sent': stats['fixes_sent'],
+        'send_rate': round(stats['fixes_sent'] / elapsed, 1),
+        'send_errors': stats['send_errors'],
+        'pings_sent': stats['pings_sent'],
+        'acks_received': stats['acks_received'],
+        'acks_bad_key': stats['acks_bad_key'],
+        'ping_loss': round(1 - stats['acks_received'] / stats['pings_sent'], 4) if stats['pings_sent'] else None,
+        'ack_rtt_ms': percentiles(stats['ack_rtts']),
+        'fixes_published': stats['fixes_published'] if tracked else None,
+        'fix_loss': round(1 - stats['fixes_published'] / fixes_tracked, 4) if tracked and fixes_tracked else None,
+        # Rate at which fixes come out of the ingest pipeline
+        'publish_rate': round(len(pt) / (max(pt) - min(pt)), 1) if len(pt) > 1 and max(pt) > min(pt) else None,
+        'publish_latency_ms': percentiles(stats['publish_latencies']),
+    }
+
+
+def compare_reports(old, new, keys=('send_rate', 'ping_loss', 'fix_loss', 'publish_rate')):
+    "Log differences of main metrics with a previous report"
+    for k in keys:
+        logger.info("%s: %s -> %s", k, old.get(k), new.get(k))
+    for k in ('ack_rtt_ms', 'publish_latency_ms'):
+        o, n = old.get(k) or {}, new.get(k) or {}
+        logger.info("%s p95: %s -> %s", k, o.get('p95'), n.get('p95'))
+
+
+async def run(args, loop):
+    if args.igc:
+        base_track = read_igc_track(args.igc)
+    pilots = []
+    if args.keys:
+        # List of {"tracking_key": <hex string>, "user_id_hash": <user id hash>}
+        with open(args.keys, 'r') as f:
+            keys = json.load(f)
+        keys = [(int(k['tracking_key'], 16), k.get('user_id_hash')) for k in keys[:args.pilots]]
+    else:
+        # Unknown keys still exercise decoding, but the server won't store the fixes
+        keys = [(random.getrandbits(63) or 1, None) for _ in range(args.pilots)]
+    for i, (key, user_id_hash) in enumerate(keys):
+        track = base_track if args.igc else synthetic_track(DEFAULT_CENTER, seed=i)
+        # Offset pilots along the same track so they're not on top of each other
+        pilots.append(Pilot(key, track, user_id_hash, phase=i * 17))
+
+    stats = {'fixes_sent': 0, 'send_errors': 0, 'pings_sent': 0, 'acks_received': 0, 'acks_bad_key': 0,
+             'ping_counter': 0, 'pings_in_flight': {}, 'ack_rtts': [],
+             'fixes_published': 0, 'publish_latencies': [], 'publish_times': []}
+
+    if any(p.user_id_hash for p in pilots):
+        wampsess = await connect_wamp(loop)
+        await subscribe_pilots(wampsess, pilots, stats)
+
+    transport, _ = await loop.create_datagram_endpoint(lambda: LoadgenProtocol(stats),
+                                                       remote_addr=(args.host, args.port))
+    logger.info("Flying %s pilots at %s Hz for %ss", len(pilots), args.rate, args.duration)
+    t1 = time.monotonic()
+    await asyncio.gather(*[fly(p, transport, stats, args.rate, args.duration, args.ping_interval)
+                           for p in pilots])
+    # Give the pipeline some time to publish the last fixes
+    await asyncio.sleep(args.drain)
+    elapsed = time.monotonic() - t1
+    transport.close()
+    return make_report(args, pilots, stats, elapsed)
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="SkyLines UDP ingest load generator")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5597)
+    parser.add_argument('--pilots', type=int, default=10, help="Number of simulated pilots")
+    parser.add_argument('--rate', type=float, default=1, help="Fixes per second per pilot")
+    parser.add_argument('--duration', type=float, default=30, help="Seconds to send fixes")
+    parser.add_argument('--ping-interval', type=float, default=5,
+                        help="Seconds between pings per pilot, used for measuring packet loss, 0 to disable")
+    parser.add_argument('--drain', type=float, default=5,
+                        help="Seconds to wait for publishes after sending stops")
+    parser.add_argument('--igc', help="Fly this IGC track instead of synthetic ones")
+    parser.add_argument('--keys', help="JSON file with list of {tracking_key, user_id_hash} to subscribe to")
+    parser.add_argument('--report', default='skylines_loadgen_report.json', help="Write JSON report here")
+    parser.add_argument('--compare', help="Previous JSON report to compare with")
+    args = parser.parse_args()
+
+    l = asyncio.get_event_loop()
+    report = l.run_until_complete(run(args, l))
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Report written to %s:\n%s", args.report, json.dumps(report, indent=2))
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            compare_reports(json.load(f), report)
@@ -0,0 +1,202 @@
+"""
+Local stand-in for the SPOT API, so spotbot can be tested without hitting api.findmespot.com.
+
+Serves ``/feed/{feed_id}/message.json`` in the same shape as the real API, for any number of feeds.
+Feeds named ``bench-<number>`` get deterministic synthetic tracks, a message every *cadence* seconds,
+and some of them are switched off (they return the ``E-0195`` empty response).
+Can add latency and answer 403 like the real API does when rate limits are hit.
+
+Point spotbot to it with something like
+> AT_SPOT_API_URL=http://localhost:5003/feed/{feed_id}/message.json python -m backend.spotbot.main
+"""
+import os
+import math
+import time
+import random
+import asyncio
+import datetime
+from collections import deque
+
+from aiohttp import web
+
+# Avoid Sentry being loaded
+os.environ.setdefault('AT_SENTRY_DSN', '')
+
+from backend.utils import getLogger
+
+logger = getLogger('spot_api_standin')
+
+# Real API returns at most this many messages
+MAX_MESSAGES = 50
+
+def empty_response(feed_id):
+    "What the real API returns if a feed has no messages in the last 7 days"
+    return {
+        "response": {
+            "errors": {
+                "error": {
+                    "code": "E-0195",
+                    "text": "No Messages to display",
+                    "description": "No displayable messages found found for feed: {}".format(feed_id)
+                }
+            }
+        }
+    }
+
+
+def feed_index(feed_id):
+    "Number of bench feed, or a stable number for any other feed id"
+    try:
+        return int(feed_id.rsplit('-', 1)[1])
+    except (IndexError, ValueError):
+        return sum(ord(c) * 31 ** i for i, c in enumerate(feed_id)) % 20000
+
+
+class SpotApiStandin():
+    def __init__(self, cadence=600, history=6 * 3600, latency=0.05, latency_jitter=0.02,
+                 quiet_fraction=0.2, feed_min_interval=0, max_rate=None):
+        # Seconds between messages of a feed
+        self.cadence = cadence
+        # Feeds have messages from this many seconds before the stand-in started
+        self.history = history
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        # Fraction of feeds that never have messages
+        self.quiet_fraction = quiet_fraction
+        # Answer 403 if the same feed is requested more often than this, SPOT asks for 150 seconds
+        self.feed_min_interval = feed_min_interval
+        # Answer 403 if more than this many requests per second are made in total
+        self.max_rate = max_rate
+        self.t0 = time.time() - history
+        self.last_request = {}
+        self.request_times = deque()
+        self.counters = {'requests': 0, 'rate_limited': 0, 'empty': 0, 'messages': 0}
+
+    def message(self, idx, k, feed_id):
+        "k-th message of feed"
+        rnd = random.Random(idx * 100003 + k)
+        start = random.Random(idx)
+        heading = start.uniform(0, 2 * math.pi)
+        unix_time = int(self.t0 + self.phase(idx) + k * self.cadence)
+        return {
+            "@clientUnixTime": "0",
+            # Must stay within a 32 bit integer
+            "id": idx * 100000 + k,
+            "messengerId": "0-{}".format(idx),
+            "messengerName": feed_id,
+            "unixTime": unix_time,
+            "messageType": "TRACK",
+            "latitude": round(start.uniform(42.5, 43.5) + 0.002 * k * math.cos(heading), 5),
+            "longitude": round(start.uniform(-2, 2) + 0.002 * k * math.sin(heading), 5),
+            "modelId": "SPOT3",
+            "showCustomMsg": "Y",
+            "dateTime": datetime.datetime.utcfromtimestamp(unix_time).strftime('%Y-%m-%dT%H:%M:%S+0000'),
+            "batteryState": "GOOD" if rnd.random() > 0.05 else "LOW",
+            "hidden": 0,
+            # 0 is failure to acquire
+            "altitude": int(rnd.uniform(500, 3000)) if rnd.random() > 0.3 else 0
+        }
+
+    def phase(self, idx):
+        return random.Random(idx).uniform(0, self.cadence)
+
+    def messages(self, feed_id, start_date=None):
+        "Newest first, like the real API"
+        idx = feed_index(feed_id)
+        if random.Random(-idx - 1).random() < self.quiet_fraction:
+            return []
+        now = time.time()
+        last_k = math.floor((now - self.t0 - self.phase(idx)) / self.cadence)
+        first_k = 0
+        if start_date:
+            first_k = max(0, math.ceil((start_date - self.t0 - self.phase(idx)) / self.cadence))
+        ks = range(max(first_k, last_k - MAX_MESSAGES + 1), last_k + 1)
+        return [self.message(idx, k, feed_id) for k in reversed(ks)]
+
+    def rate_limited(self, feed_id):
+        now = time.monotonic()
+        last = self.last_request.get(feed_id)
+        self.last_request[feed_id] = now
+        if self.feed_min_interval and last and now - last < self.feed_min_interval:
+            return True
+        if self.max_rate:
+            self.request_times.append(now)
+            while self.request_times[0] < now - 1:
+                self.request_times.popleft()
+            if len(self.request_times) > self.max_rate:
+                return True
+        return False
+
+    async def feed(self, request):
+        feed_id = request.match_info['feed_id']
+        self.counters['requests'] += 1
+        await asyncio.sleep(max(0, random.gauss(self.latency, self.latency_jitter)))
+        if self.rate_limited(feed_id):
+            self.counters['rate_limited'] += 1
+            return web.Response(status=403)
+        start_date = request.query.get('startDate')
+        if start_date:
+            try:
+                start_date = datetime.datetime.strptime(start_date, '%Y-%m-%dT%H:%M:%S-0000')
+            except ValueError:
+                return web.Response(status=400, text="Invalid startDate")
+            start_date = (start_date - datetime.datetime(1970, 1, 1)).total_seconds()
+        msgs = self.messages(feed_id, start_date)
+        if not msgs:
+            self.counters['empty'] += 1
+            return web.json_response(empty_response(feed_id))
+        self.counters['messages'] += len(msgs)
+        return web.json_response({
+            "response": {
+                "feedMessageResponse": {
+                    "count": len(msgs),
+                    "feed": {"id": feed_id, "name": feed_id, "description": feed_id, "status": "ACTIVE",
+                             "usage": 0, "daysRange": 7, "detailedMessageShown": True, "type": "SHARED_PAGE"},
+                    "totalCount": len(msgs),
+                    "activityCount": 0,
+                    "messages": {"message": msgs}
+                }
+            }
+        })
+
+    async def stats(self, request):
+        return web.json_response(self.counters)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get(r'/feed/{feed_id}/message.json', self.feed)
+        app.router.add_get(r'/stats', self.stats)
+        return app
+
+
+async def start_standin(standin, host='127.0.0.1', port=5003):
+    "Start serving on the running loop, returns the server"
+    loop = asyncio.get_event_loop()
+    return await loop.create_server(standin.app().make_handler(), host, port)
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Local SPOT API stand-in")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5003)
+    parser.add_argument('--cadence', type=float, default=600, help="Seconds between messages of a feed")
+    parser.add_argument('--latency', type=float, default=0.05, help="Mean response latency in seconds")
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--quiet-fraction', type=float, default=0.2, help="Fraction of feeds without messages")
+    parser.add_argument('--feed-min-interval', type=float, default=0,
+                        help="Answer 403 when a feed is requested more often, SPOT asks for 150 seconds")
+    parser.add_argument('--max-rate', type=float, help="Answer 403 above this many requests per second")
+    args = parser.parse_args()
+
+    standin = SpotApiStandin(cadence=args.cadence, latency=args.latency, latency_jitter=args.latency_jitter,
+                             quiet_fraction=args.quiet_fraction, feed_min_interval=args.feed_min_interval,
+                             max_rate=args.max_rate)
+    l = asyncio.get_event_loop()
+    l.run_until_complete(start_standin(standin, args.host, args.port))
+    logger.info("Serving SPOT API stand-in on http://%s:%s/feed/{feed_id}/message.json", args.host, args.port)
+    try:
+        l.run_forever()
+    except KeyboardInterrupt:
+        pass
+    logger.info("Stats: %s", standin.counters)
@@ -0,0 +1,180 @@
+"""
+Benchmark of spotbot's feed polling against the local SPOT API stand-in.
+
+Seeds the database with links to thousands of synthetic feeds, then runs the same
+FeedScheduler and SpotPoller as SpotBotComponent, with RPCs recorded locally instead of sent over WAMP.
+Reports how long it takes to poll every feed once, feeds per second, database queries per message
+and the latency from message timestamp to the points being forwarded to the location service.
+Benchmark links and messages use negative user ids and are removed afterwards.
+
+Needs DB_URI_ATSITE, e.g.
+> python -m tools.spotbot_benchmark --feeds 2000 --concurrency 16 --rate 200 --duration 60
+"""
+import os
+import json
+import time
+import asyncio
+import datetime
+
+# Avoid Sentry being loaded
+os.environ.setdefault('AT_SENTRY_DSN', '')
+
+import aiohttp
+import asyncpg
+
+from backend.utils import getLogger
+from tools.skylines_loadgen import percentiles
+from tools.spot_api_standin import SpotApiStandin, start_standin
+
+logger = getLogger('spotbot_benchmark')
+
+FEED_PREFIX = 'bench-'
+
+
+class QueryCounter():
+    "Wraps an asyncpg pool and counts round trips, can be passed to Db.create as existingconn"
+    def __init__(self, pool):
+        self.pool = pool
+        self.counters = {'queries': 0, 'executemany_rows': 0}
+
+    def __getattr__(self, name):
+        attr = getattr(self.pool, name)
+        if name not in ('fetch', 'fetchrow', 'fetchval', 'execute', 'executemany'):
+            return attr
+
+        async def counted(query, *args, **kwargs):
+            self.counters['queries'] += 1
+            if name == 'executemany':
+                self.counters['executemany_rows'] += len(args[0])
+            return await attr(query, *args, **kwargs)
+        return counted
+
+
+async def seed_links(pool, n):
+    "Returns links of *n* never-queried benchmark feeds"
+    await cleanup(pool)
+    now = datetime.datetime.utcnow()
+    await pool.executemany('''
+    INSERT INTO spotbot_link (user_id, feed_id, created, last_queried) VALUES ($1, $2, $3, $4);
+    ''', [(-i - 1, '{}{:05d}'.format(FEED_PREFIX, i), now, datetime.datetime.min) for i in range(n)])
+    recs = await pool.fetch("SELECT * FROM spotbot_link WHERE feed_id LIKE $1;", FEED_PREFIX + '%')
+    return [dict(r) for r in recs]
+
+
+async def cleanup(pool):
+    await pool.execute("DELETE FROM spotbot_msgs WHERE user_id < 0;")
+    await pool.execute("DELETE FROM spotbot_link WHERE user_id < 0 AND feed_id LIKE $1;", FEED_PREFIX + '%')
+
+
+async def run(args):
+    if args.standin_url:
+        os.environ['AT_SPOT_API_URL'] = args.standin_url
+        standin = None
+    else:
+        standin = SpotApiStandin(cadence=args.cadence, latency=args.latency, max_rate=args.standin_max_rate)
+        await start_standin(standin, port=args.standin_port)
+        os.environ['AT_SPOT_API_URL'] = 'http://127.0.0.1:{}/feed/{{feed_id}}/message.json'.format(args.standin_port)
+
+    # Import only now, SPOT_API_URL is read on import
+    from backend.spotbot.db import Db
+    from backend.spotbot.main import SpotPoller
+    from backend.spotbot.scheduler import FeedScheduler, RateLimiter
+
+    pool = await asyncpg.create_pool(dsn=os.environ["DB_URI_ATSITE"])
+    links = await seed_links(pool, args.feeds)
+    counter = QueryCounter(pool)
+    db = await Db.create(existingconn=counter)
+
+    stats = {'polls': 0, 'batches': 0, 'forwarded': 0, 'first_cycle': None}
+    # Seconds between message timestamp and forwarding, for messages sent during the benchmark
+    latencies = []
+    bench_start = datetime.datetime.utcnow()
+
+    async def call(procedure, *a, **kw):
+        "Records RPCs instead of sending them over WAMP"
+        if procedure == 'at.location.insert_gps_points':
+            now = datetime.datetime.utcnow()
+            stats['batches'] += 1
+            stats['forwarded'] += len(a[0])
+            for pt in a[0]:
+                ts = datetime.datetime.strptime(pt['timestamp'], '%Y-%m-%dT%H:%M:%S')
+                if ts >= bench_start:
+                    latencies.append((now - ts).total_seconds())
+        elif procedure == 'at.adventures.get_adventures_by_user_id':
+            return []
+
+    http = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=args.concurrency))
+    poller = SpotPoller(db, http, call, await db.get_recent_msg_timestamps())
+    polled = set()
+    t0 = time.monotonic()
+
+    async def poll_feed(link):
+        interval = await poller.poll_feed(link)
+        stats['polls'] += 1
+        polled.add(link['id'])
+        if stats['first_cycle'] is None and len(polled) == len(links):
+            stats['first_cycle'] = time.monotonic() - t0
+            logger.info("Polled all %s feeds in %.1fs", len(links), stats['first_cycle'])
+        return interval
+
+    scheduler = FeedScheduler(poll_feed, concurrency=args.concurrency,
+                              rate_limiter=RateLimiter(args.rate, burst=args.concurrency))
+    scheduler.update_links(links)
+    task = asyncio.ensure_future(scheduler.run())
+    try:
+        while stats['first_cycle'] is None or time.monotonic() - t0 < stats['first_cycle'] + args.duration:
+            await asyncio.sleep(1)
+            if stats['first_cycle'] is None and time.monotonic() - t0 > args.timeout:
+                logger.error("Could not poll all feeds within %ss", args.timeout)
+                break
+    finally:
+        task.cancel()
+        elapsed = time.monotonic() - t0
+        # Let running polls finish
+        await asyncio.sleep(1)
+        await http.close()
+        await cleanup(pool)
+        await pool.close()
+
+    feed_errors = sum(1 for s in poller.feed_states.values() if s.failures)
+    report = {
+        'timestamp': bench_start.isoformat(),
+        'args': vars(args),
+        'elapsed': round(elapsed, 3),
+        'feeds': len(links),
+        'first_cycle_seconds': round(stats['first_cycle'], 3) if stats['first_cycle'] else None,
+        'polls': stats['polls'],
+        'feeds_per_sec': round(stats['polls'] / elapsed, 2),
+        'feeds_failing': feed_errors,
+        'forwarded_points': stats['forwarded'],
+        'forward_batches': stats['batches'],
+        'db_queries': counter.counters['queries'],
+        'db_queries_per_poll': round(counter.counters['queries'] / max(stats['polls'], 1), 3),
+        'db_queries_per_message': round(counter.counters['queries'] / max(stats['forwarded'], 1), 3),
+        'forward_latency_ms': percentiles(latencies),
+        'standin': standin.counters if standin else None,
+    }
+    return report
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Benchmark spotbot polling against the SPOT API stand-in")
+    parser.add_argument('--feeds', type=int, default=1000, help="Number of synthetic feeds")
+    parser.add_argument('--concurrency', type=int, default=8, help="Feeds polled at the same time")
+    parser.add_argument('--rate', type=float, default=100, help="Max SPOT API requests per second")
+    parser.add_argument('--duration', type=float, default=0,
+                        help="Keep polling this many seconds after all feeds have been polled once")
+    parser.add_argument('--timeout', type=float, default=600, help="Give up on polling all feeds after this")
+    parser.add_argument('--cadence', type=float, default=300, help="Seconds between synthetic messages")
+    parser.add_argument('--latency', type=float, default=0.05, help="Mean stand-in response latency")
+    parser.add_argument('--standin-port', type=int, default=5003)
+    parser.add_argument('--standin-max-rate', type=float, help="Let stand-in answer 403 above this rate")
+    parser.add_argument('--standin-url', help="Use an already running stand-in at this feed URL template")
+    parser.add_argument('--report', default='spotbot_benchmark_report.json', help="Write JSON report here")
+    args = parser.parse_args()
+
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Report written to %s:\n%s", args.report, json.dumps(report, indent=2))
@@ -0,0 +1,105 @@
+"""
+Benchmark of transcoding a video into all renditions of mediaconfig, one ffmpeg per rendition
+(VidThumbTranscoder and VidTranscoder) against a single decode split into all outputs (MultiVidTranscoder).
+
+Generates test clips with ffmpeg's lavfi sources, so only needs ffmpeg with libx264, e.g.
+> python -m tools.transcode_benchmark --duration 20 --size 1920x1080 --repeat 3
+"""
+import os
+import json
+import time
+import asyncio
+import resource
+import tempfile
+import subprocess
+import os.path as osp
+
+# Avoid Sentry being loaded
+os.environ.setdefault('AT_SENTRY_DSN', '')
+
+from backend.utils import getLogger
+from backend.transcode.transcoder import VidThumbTranscoder, VidTranscoder, MultiVidTranscoder
+from backend.transcode.mediaconfig import video_thumb_resolutions, video_resolutions
+
+logger = getLogger('transcode_benchmark')
+
+
+def generate_clip(path, duration, size, rate=30):
+    "Moving test pattern with a tone, like a phone video"
+    subprocess.run(['ffmpeg', '-y', '-loglevel', 'error',
+                    '-f', 'lavfi', '-i', 'testsrc2=size={}:rate={}'.format(size, rate),
+                    '-f', 'lavfi', '-i', 'sine=frequency=440:sample_rate=44100',
+                    '-t', str(duration), '-c:v', 'libx264', '-preset', 'veryfast', '-pix_fmt', 'yuv420p',
+                    '-c:a', 'aac', path], check=True)
+
+
+def children_cpu():
+    "CPU seconds used by finished child processes, ffmpeg in this case"
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def per_rendition(src, outdir, threads):
+    vtt = await VidThumbTranscoder.create(threads=threads)
+    vt = await VidTranscoder.create(threads=threads)
+    out = []
+    for tc, confs in ((vtt, video_thumb_resolutions), (vt, video_resolutions)):
+        for conf in confs:
+            dest = osp.join(outdir, 'per-{}.{}'.format(conf['name'], conf['ext']))
+            await tc.transcode(src, dest, conf)
+            out.append(dest)
+    return out
+
+
+async def single_pass(src, outdir, threads):
+    mvt = await MultiVidTranscoder.create(threads=threads)
+    confs = video_thumb_resolutions + video_resolutions
+    dests = [osp.join(outdir, 'single-{}.{}'.format(c['name'], c['ext'])) for c in confs]
+    await mvt.transcode_many(src, dests, confs)
+    return dests
+
+
+async def measure(name, coro_func, *args):
+    cpu = children_cpu()
+    start = time.perf_counter()
+    dests = await coro_func(*args)
+    result = {
+        'wall_seconds': round(time.perf_counter() - start, 2),
+        'cpu_seconds': round(children_cpu() - cpu, 2),
+        'bytes': {osp.basename(d): osp.getsize(d) for d in dests},
+    }
+    logger.info("%s: %s", name, result)
+    return result
+
+
+async def run(args):
+    tmpdir = tempfile.mkdtemp(prefix='transcode-benchmark-')
+    os.environ.setdefault('AT_MEDIA_ROOT', tmpdir)
+    src = osp.join(tmpdir, 'clip.mp4')
+    generate_clip(src, args.duration, args.size)
+    report = {'args': vars(args), 'runs': []}
+    for i in range(args.repeat):
+        result = {}
+        for name, coro_func in (('per_rendition', per_rendition), ('single_pass', single_pass)):
+            result[name] = await measure(name, coro_func, src, tmpdir, args.threads)
+        report['runs'].append(result)
+    for name in ('per_rendition', 'single_pass'):
+        report[name] = {k: min(r[name][k] for r in report['runs']) for k in ('wall_seconds', 'cpu_seconds')}
+    report['cpu_saved'] = round(1 - report['single_pass']['cpu_seconds'] / report['per_rendition']['cpu_seconds'], 3)
+    return report
+
+
+if __name__=="__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Compare per-rendition and single-pass video transcoding")
+    parser.add_argument('--duration', type=float, default=10, help="Seconds of test clip")
+    parser.add_argument('--size', default='1920x1080', help="Resolution of test clip")
+    parser.add_argument('--threads', type=int, help="ffmpeg -threads per encode, default is ffmpeg's choice")
+    parser.add_argument('--repeat', type=int, default=3, help="Best of this many runs")
+    parser.add_argument('--report', default='transcode_benchmark_report.json', help="Write JSON report here")
+    args = parser.parse_args()
+
+    report = asyncio.get_event_loop().run_until_complete(run(args))
+    with open(args.report, 'w') as f:
+        json.dump(report, f, indent=2)
+    logger.info("Report written to %s:\n%s", args.report, json.dumps(report, indent=2))